@@ -0,0 +1,264 @@
+"""
+A compact binary encoding for streams of events, for when bandwidth matters more than being able to
+read what is sent (see memdam.common.client.BINARY_CONTENT_TYPE).
+
+A stream is MAGIC followed by frames. Every frame is a 4 byte length and then that many bytes, the
+first of which says what kind of frame it is:
+
+    L  a layout: the namespace, the number of fields, and the name of each field. Layouts are
+       numbered in the order that they appear in the stream, starting at 0.
+    E  an event: the number of its layout, and then one value per field, in the order of the layout.
+
+So the names of the fields are only sent once per stream, rather than once per event. Values are
+encoded according to the type of their field:
+
+    NUMBER                          8 byte double
+    LONG                            8 byte signed integer
+    TIME                            8 byte signed integer, microseconds since the epoch (UTC)
+    BOOL                            1 byte
+    ID                              the 16 bytes of the UUID
+    RAW                             4 byte length, then the bytes
+    STRING, TEXT, ENUM, NAMESPACE   4 byte length, then UTF-8
+    FILE                            4 byte length, then the UTF-8 file name of the blob (uuid.extension)
+
+Everything is big-endian. Decoding a value always gives the right type of value for its field, so
+the only values that still have to be checked (see Event.validate) are namespaces.
+"""
+
+import uuid
+import struct
+
+import memdam.common.field
+import memdam.common.event
+import memdam.common.timeutils
+
+MAGIC = 'MDE\x01'
+
+LAYOUT_FRAME = 'L'
+EVENT_FRAME = 'E'
+
+_UINT32 = struct.Struct('>I')
+_INT64 = struct.Struct('>q')
+_DOUBLE = struct.Struct('>d')
+
+def _pack_bytes(value):
+    """:returns: the string, prefixed with its length"""
+    return _UINT32.pack(len(value)) + value
+
+def _unpack_bytes(data, offset):
+    """:returns: (the string that starts at offset, the offset after it)"""
+    length = _UINT32.unpack_from(data, offset)[0]
+    offset += _UINT32.size
+    value = data[offset:offset + length]
+    assert len(value) == length, "Truncated value"
+    return value, offset + length
+
+def _pack_unicode(value):
+    """:returns: the UTF-8 encoding of the string, prefixed with its length"""
+    return _pack_bytes(value.encode('utf-8'))
+
+def _unpack_unicode(data, offset):
+    """:returns: (the unicode string that starts at offset, the offset after it)"""
+    value, offset = _unpack_bytes(data, offset)
+    return value.decode('utf-8'), offset
+
+def _pack_number(value):
+    """:returns: the float as 8 bytes"""
+    return _DOUBLE.pack(value)
+
+def _unpack_number(data, offset):
+    """:returns: (the float at offset, the offset after it)"""
+    return _DOUBLE.unpack_from(data, offset)[0], offset + _DOUBLE.size
+
+def _pack_long(value):
+    """:returns: the integer as 8 bytes"""
+    return _INT64.pack(value)
+
+def _unpack_long(data, offset):
+    """:returns: (the integer at offset, the offset after it)"""
+    return long(_INT64.unpack_from(data, offset)[0]), offset + _INT64.size
+
+def _pack_time(value):
+    """:returns: the time as 8 bytes of microseconds"""
+    return _INT64.pack(memdam.common.timeutils.time_to_long(value))
+
+def _unpack_time(data, offset):
+    """:returns: (the time at offset, the offset after it)"""
+    value = _INT64.unpack_from(data, offset)[0]
+    return memdam.common.timeutils.long_to_time(value), offset + _INT64.size
+
+def _pack_bool(value):
+    """:returns: the bool as a single byte"""
+    if value:
+        return '\x01'
+    return '\x00'
+
+def _unpack_bool(data, offset):
+    """:returns: (the bool at offset, the offset after it)"""
+    value = data[offset:offset + 1]
+    assert value in ('\x00', '\x01'), "Not a bool: %r" % (value)
+    return value == '\x01', offset + 1
+
+def _pack_id(value):
+    """:returns: the 16 bytes of the UUID"""
+    return value.bytes
+
+def _unpack_id(data, offset):
+    """:returns: (the UUID at offset, the offset after it)"""
+    value = data[offset:offset + 16]
+    assert len(value) == 16, "Truncated id"
+    return uuid.UUID(bytes=value), offset + 16
+
+def _pack_raw(value):
+    """:returns: the buffer, prefixed with its length"""
+    return _pack_bytes(str(value))
+
+def _unpack_raw(data, offset):
+    """:returns: (the buffer that starts at offset, the offset after it)"""
+    value, offset = _unpack_bytes(data, offset)
+    return buffer(value), offset
+
+def _pack_file(value):
+    """:returns: the file name of the BlobReference, prefixed with its length"""
+    return _pack_unicode(value.name)
+
+def _unpack_file(data, offset):
+    """:returns: (the BlobReference that starts at offset, the offset after it)"""
+    import memdam.common.blob
+    name, offset = _unpack_unicode(data, offset)
+    blob_id, extension = name.split(u'.', 1)
+    return memdam.common.blob.BlobReference(uuid.UUID(blob_id), extension), offset
+
+#FieldType -> (pack, unpack)
+_CODECS = {
+    memdam.common.field.FieldType.NUMBER: (_pack_number, _unpack_number),
+    memdam.common.field.FieldType.STRING: (_pack_unicode, _unpack_unicode),
+    memdam.common.field.FieldType.TEXT: (_pack_unicode, _unpack_unicode),
+    memdam.common.field.FieldType.ENUM: (_pack_unicode, _unpack_unicode),
+    memdam.common.field.FieldType.RAW: (_pack_raw, _unpack_raw),
+    memdam.common.field.FieldType.BOOL: (_pack_bool, _unpack_bool),
+    memdam.common.field.FieldType.TIME: (_pack_time, _unpack_time),
+    memdam.common.field.FieldType.ID: (_pack_id, _unpack_id),
+    memdam.common.field.FieldType.LONG: (_pack_long, _unpack_long),
+    memdam.common.field.FieldType.FILE: (_pack_file, _unpack_file),
+    memdam.common.field.FieldType.NAMESPACE: (_pack_unicode, _unpack_unicode),
+}
+
+def _frame(body):
+    """:returns: the frame with this body"""
+    return _UINT32.pack(len(body)) + body
+
+def encode_events(events):
+    """
+    :param events: the events to encode
+    :type  events: iterable(memdam.common.event.Event)
+    :returns: the stream of encoded events, a few bytes at a time (so that it can be streamed)
+    :rtype: generator(string)
+    """
+    yield MAGIC
+    #memdam.common.event.FieldLayout -> (number, pack function for each field)
+    layouts = {}
+    for event in events:
+        # pylint: disable=W0212
+        layout = event._layout
+        known = layouts.get(layout)
+        if known is None:
+            known = (len(layouts), tuple(_CODECS[field_type][0] for field_type in layout.types))
+            layouts[layout] = known
+            parts = [LAYOUT_FRAME, _pack_unicode(layout.namespace), _UINT32.pack(len(layout.names))]
+            parts.extend(_pack_unicode(name) for name in layout.names)
+            yield _frame(''.join(parts))
+        number, packers = known
+        parts = [EVENT_FRAME, _UINT32.pack(number)]
+        parts.extend(pack(value) for pack, value in zip(packers, event._values))
+        yield _frame(''.join(parts))
+
+def encode_event_list(events):
+    """
+    :returns: all of the events, encoded as a single string
+    :rtype: string
+    """
+    return ''.join(encode_events(events))
+
+def decode_events(chunks):
+    """
+    :param chunks: the encoded stream, split up any way at all (eg, as it arrives)
+    :type  chunks: iterable(string)
+    :returns: the events, as soon as each one has completely arrived
+    :rtype: generator(memdam.common.event.Event)
+    :throws: AssertionError if the stream is not valid, is truncated, or has invalid events
+    """
+    pending = ''
+    started = False
+    #number -> (layout, where each value goes in the layout, (unpack function, whether to check) for each value)
+    layouts = []
+    for chunk in chunks:
+        pending += chunk
+        offset = 0
+        if not started:
+            if len(pending) < len(MAGIC):
+                continue
+            assert pending[:len(MAGIC)] == MAGIC, "Not a stream of binary events"
+            started = True
+            offset = len(MAGIC)
+        while len(pending) - offset >= _UINT32.size:
+            length = _UINT32.unpack_from(pending, offset)[0]
+            end = offset + _UINT32.size + length
+            if end > len(pending):
+                break
+            try:
+                event = _decode_frame(pending[offset + _UINT32.size:end], layouts)
+            except struct.error, e:
+                assert False, "Invalid frame: %s" % (e)
+            if event is not None:
+                yield event
+            offset = end
+        pending = pending[offset:]
+    assert started and len(pending) == 0, "Truncated stream of binary events"
+
+def decode_event_list(data):
+    """
+    :param data: a whole encoded stream
+    :type  data: string
+    :returns: the events
+    :rtype: list(memdam.common.event.Event)
+    """
+    return list(decode_events([data]))
+
+def _decode_frame(frame, layouts):
+    """
+    :returns: the event in the frame, or None if it was a layout (which is added to layouts)
+    :rtype: memdam.common.event.Event
+    """
+    kind = frame[:1]
+    if kind == LAYOUT_FRAME:
+        namespace, offset = _unpack_unicode(frame, 1)
+        count = _UINT32.unpack_from(frame, offset)[0]
+        offset += _UINT32.size
+        names = []
+        for _ in xrange(count):
+            name, offset = _unpack_unicode(frame, offset)
+            names.append(name)
+        assert offset == len(frame), "Unexpected data after layout"
+        assert len(set(names)) == len(names), "Duplicated fields in layout"
+        layout = memdam.common.event.FieldLayout.get(namespace, names)
+        fields = [memdam.common.field.describe(name) for name in names]
+        positions = tuple(layout.indices[name] for name in names)
+        unpackers = tuple((_CODECS[field.type][1], field.type == memdam.common.field.FieldType.NAMESPACE) \
+                          for field in fields)
+        layouts.append((layout, positions, unpackers))
+        return None
+    assert kind == EVENT_FRAME, "Unknown frame %r" % (kind)
+    number = _UINT32.unpack_from(frame, 1)[0]
+    assert number < len(layouts), "Event refers to unknown layout %s" % (number)
+    layout, positions, unpackers = layouts[number]
+    offset = 1 + _UINT32.size
+    values = [None] * len(positions)
+    for position, (unpack, is_namespace) in zip(positions, unpackers):
+        value, offset = unpack(frame, offset)
+        if is_namespace:
+            memdam.common.event.Event.validate(value, memdam.common.field.FieldType.NAMESPACE)
+        values[position] = value
+    assert offset == len(frame), "Unexpected data after event"
+    # pylint: disable=W0212
+    return memdam.common.event.Event._from_layout(layout, tuple(values))
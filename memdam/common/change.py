@@ -0,0 +1,129 @@
+import uuid
+
+class Change(object):
+    """
+    One entry in the change feed of an Eventstore (see memdam.eventstore.api.Eventstore.changes_since)
+
+    :attr feed: the feed that this change is from. Every feed has its own sequence numbers. For sqlite
+    there is one feed per table, so this is the namespace unless the namespace is partitioned.
+    :type feed: unicode
+    :attr sequence: where this change is in its feed. Later changes always have larger numbers.
+    :type sequence: int
+    :attr namespace: the namespace of the event
+    :type namespace: unicode
+    :attr event_id: the id of the event that was saved or deleted
+    :type event_id: uuid.UUID
+    :attr deleted: True if the event was deleted, False if it was saved
+    :type deleted: bool
+    """
+
+    def __init__(self, feed, sequence, namespace, event_id, deleted):
+        self.feed = feed
+        self.sequence = sequence
+        self.namespace = namespace
+        self.event_id = event_id
+        self.deleted = deleted
+
+    def __eq__(self, other):
+        return (self.feed, self.sequence, self.namespace, self.event_id, self.deleted) == \
+               (other.feed, other.sequence, other.namespace, other.event_id, other.deleted)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "Change(%r, %r, %r, %r, %r)" % (self.feed, self.sequence, self.namespace, self.event_id, self.deleted)
+
+    def to_json_dict(self):
+        """
+        Convert from a Change object to JSON
+
+        :returns: a dict ready for json serialization
+        :rtype: dict
+        """
+        return dict(
+            feed=self.feed,
+            sequence=self.sequence,
+            namespace=self.namespace,
+            event_id=self.event_id.hex,
+            deleted=self.deleted
+        )
+
+    @staticmethod
+    def from_json_dict(json_dict):
+        """
+        Convert from JSON to a Change object.
+
+        :param json_dict: the decoded JSON data
+        :type  json_dict: dict
+        :returns: the change that this JSON represents
+        :rtype: memdam.common.change.Change
+        """
+        return Change(json_dict['feed'], json_dict['sequence'], json_dict['namespace'],
+                      uuid.UUID(json_dict['event_id']), json_dict['deleted'])
+
+class Cursor(object):
+    """
+    How far someone has read through the change feeds of an Eventstore: the sequence number of the
+    last change that they have seen in each feed. Feeds that are not in the cursor are read from the
+    beginning.
+
+    Cursors are never modified. Use advance to get the cursor for after some changes.
+
+    :attr positions: feed -> the sequence number of the last change that was seen
+    :type positions: dict(unicode, int)
+    """
+
+    def __init__(self, positions=None):
+        if positions is None:
+            positions = {}
+        self.positions = dict(positions)
+
+    def position(self, feed):
+        """
+        :returns: the sequence number of the last change that was seen in this feed (0 for none)
+        :rtype: int
+        """
+        return self.positions.get(feed, 0)
+
+    def advance(self, changes):
+        """
+        :param changes: changes that were returned by changes_since for this cursor
+        :type  changes: list(memdam.common.change.Change)
+        :returns: the cursor for after all of these changes
+        :rtype: memdam.common.change.Cursor
+        """
+        positions = dict(self.positions)
+        for change in changes:
+            positions[change.feed] = max(positions.get(change.feed, 0), change.sequence)
+        return Cursor(positions)
+
+    def __eq__(self, other):
+        return self.positions == other.positions
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "Cursor(%r)" % (self.positions,)
+
+    def to_json_dict(self):
+        """
+        Convert from a Cursor object to JSON
+
+        :returns: a dict ready for json serialization
+        :rtype: dict
+        """
+        return dict(positions=self.positions)
+
+    @staticmethod
+    def from_json_dict(json_dict):
+        """
+        Convert from JSON to a Cursor object.
+
+        :param json_dict: the decoded JSON data
+        :type  json_dict: dict
+        :returns: the cursor that this JSON represents
+        :rtype: memdam.common.change.Cursor
+        """
+        return Cursor(json_dict['positions'])
@@ -9,6 +9,11 @@ import requests
 
 import memdam.common.event
 
+#newline-delimited JSON. Used to stream large lists of events
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+#see memdam.common.bincodec. Used instead of JSON for events when bandwidth matters
+BINARY_CONTENT_TYPE = 'application/x-memdam-events'
+
 class ServerError(Exception):
     """Raised if any error happens while talking to the server."""
 
@@ -1,10 +1,9 @@
 
 import types
-import base64
 import datetime
 import uuid
+import threading
 
-import dateutil.parser
 from fn.monad import Option
 
 import memdam.common.timeutils
@@ -52,28 +51,101 @@ class Event(object):
     newtons, inches, etc).
     In the case of STRING types, `secondary_type` refers to the encoding standard used to generate
     the string (ex: iso_3679)
+
+    Events are stored compactly, since there can be millions of them in memory at once: each one is
+    just a FieldLayout (shared by every event from the same namespace with the same fields) and a
+    tuple of values in the order of the layout. Fields are still read as attributes. Field names are
+    only checked once per layout, but values are checked for every event, except by
+    from_trusted_dict.
+
+    Since events never change, the hash is only computed the first time that it is needed. Events
+    are equal when they have the same namespace, fields and values, which is checked without
+    converting anything.
     """
 
+    __slots__ = ('_layout', '_values', '_hash')
+
     def __init__(self, **kwargs):
-        self.id__id = None
-        self.time_time = None
-        self.keys = set()
-        base_names = set()
-        for key, value in kwargs.items():
-            key = unicode(key)
+        assert 'type__namespace' in kwargs, "Events must have a type__namespace"
+        namespace = kwargs.pop('type__namespace')
+        assert isinstance(namespace, unicode), \
+        "Namespaces should be unicode, %s was %s" % (namespace, type(namespace))
+        layout = FieldLayout.get(namespace, kwargs.keys())
+        values = []
+        for name, field_type in zip(layout.names, layout.types):
+            value = kwargs[name]
             assert value != None, "Can not set attributes to None. If you want to, simply leave it off."
-            assert memdam.common.validation.EVENT_FIELD_REGEX.match(key), "Field %s contains something besides a-z_ or is the wrong type. Should match: %s" % (key, memdam.common.validation.EVENT_FIELD_REGEX.pattern)
-            base_name = key.split('__')[0]
-            assert base_name not in base_names, "Duplicated key: " + base_name
-            base_names.add(base_name)
-            field_type = Event.field_type(key)
             Event.validate(value, field_type)
-            setattr(self, key, value)
-            self.keys.add(key)
-        self.id__id = getattr(self, 'id__id')
-        self.time__time = getattr(self, 'time__time')
-        self.type__namespace = getattr(self, 'type__namespace')
-        self._init_finished = True
+            values.append(value)
+        object.__setattr__(self, '_layout', layout)
+        object.__setattr__(self, '_values', tuple(values))
+        object.__setattr__(self, '_hash', None)
+
+    @staticmethod
+    def from_trusted_dict(data):
+        """
+        Like Event(**data), but without checking any of the values. Only for data that was already
+        checked before it was stored (eg, rows loaded from an Eventstore), never for input from
+        anywhere else.
+
+        :param data: field name -> value, including type__namespace. None values are left out.
+        :type  data: dict(unicode, any)
+        :rtype: memdam.common.event.Event
+        """
+        data = dict(data)
+        layout = FieldLayout.get(data.pop('type__namespace'), data.keys())
+        return Event._from_layout(layout, tuple(data[name] for name in layout.names))
+
+    @staticmethod
+    def _from_layout(layout, values):
+        """
+        :returns: an event with exactly these values, in the order of the layout
+        :rtype: memdam.common.event.Event
+        """
+        event = object.__new__(Event)
+        object.__setattr__(event, '_layout', layout)
+        object.__setattr__(event, '_values', values)
+        object.__setattr__(event, '_hash', None)
+        return event
+
+    def __getattr__(self, name):
+        #only called for names that aren't slots, methods or properties, ie, fields
+        if name.startswith('_'):
+            raise AttributeError(name)
+        index = self._layout.indices.get(name)
+        if index is None:
+            if name == 'type__namespace':
+                return self._layout.namespace
+            raise AttributeError(name)
+        return self._values[index]
+
+    def __reduce__(self):
+        data = dict(zip(self._layout.names, self._values))
+        data['type__namespace'] = self._layout.namespace
+        return (_unpickle, (data,))
+
+    @property
+    def keys(self):
+        """
+        :returns: the name of every field (including type__namespace)
+        :rtype: frozenset(unicode)
+        """
+        return self._layout.keys
+
+    @property
+    def id__id(self):
+        """The unique id of this Event"""
+        return self._values[self._layout.id_index]
+
+    @property
+    def time__time(self):
+        """The time at which this Event happened"""
+        return self._values[self._layout.time_index]
+
+    @property
+    def type__namespace(self):
+        """The namespace of this Event"""
+        return self._layout.namespace
 
     def get_field(self, key):
         """
@@ -88,37 +160,41 @@ class Event(object):
         """
         :returns: a list of (field_name, blob_ref) tuples, one per file field
         """
-        return [(key, self.get_field(key)) for key in self.keys if Event.field_type(key) == memdam.common.field.FieldType.FILE]
+        return [(field.name, value) for field, value in zip(self._layout.fields, self._values) \
+                if field.type == memdam.common.field.FieldType.FILE]
 
     def to_json_dict(self):
         """
         Turn this into a dictionary that is suitable for serialization to json
         """
-        new_dict = {}
-        for key in self.keys:
-            value = getattr(self, key)
-            if isinstance(value, datetime.datetime):
-                value = value.isoformat()
-            elif isinstance(value, uuid.UUID):
-                value = value.hex
-            elif isinstance(value, buffer):
-                value = base64.b64encode(value)
-            elif isinstance(value, memdam.common.blob.BlobReference):
-                value = value.to_json()
-            if isinstance(value, basestring):
-                value = unicode(value)
-            new_dict[key] = value
+        new_dict = dict((field.name, field.to_json(value)) for field, value in zip(self._layout.fields, self._values))
+        new_dict[u'type__namespace'] = self._layout.namespace
         return new_dict
 
     def __eq__(self, other):
-        return self.to_json_dict().__eq__(other.to_json_dict())
+        if self is other:
+            return True
+        if not isinstance(other, Event):
+            return False
+        #layouts are interned, so different layouts mean different namespaces or fields
+        if self._layout is not other._layout or self.id__id != other.id__id:
+            return False
+        if self._hash is not None and other._hash is not None and self._hash != other._hash:
+            return False
+        return self._values == other._values
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
 
     def __hash__(self):
-        return hash(tuple(_make_hash_key(self.to_json_dict())))
+        if self._hash is None:
+            #buffers from sqlite are writable, so can't be hashed themselves
+            values = tuple(str(value) if isinstance(value, types.BufferType) else value for value in self._values)
+            object.__setattr__(self, '_hash', hash((self._layout.namespace, self._layout.names, values)))
+        return self._hash
 
     def __setattr__(self, name, value):
-        assert not getattr(self, '_init_finished', False), "Events are immutable."
-        object.__setattr__(self, name, value)
+        assert False, "Events are immutable."
 
     def __delattr__(self, name):
         assert False, "Events are immutable."
@@ -150,7 +226,7 @@ class Event(object):
         :rtype: string
         :throws: Exception if the name does not conform to the above specification
         """
-        return name.split('__')[0]
+        return memdam.common.field.describe(name).raw_name
 
     @staticmethod
     def field_type(name):
@@ -161,9 +237,7 @@ class Event(object):
         :rtype: memdam.common.field.FieldType
         :throws: Exception if the name does not conform to the above specification
         """
-        data = name.upper().split('__')
-        type_name = data[1]
-        return getattr(memdam.common.field.FieldType, type_name)
+        return memdam.common.field.describe(name).type
 
     @staticmethod
     def secondary_type_option(name):
@@ -174,27 +248,14 @@ class Event(object):
         no secondary type)
         :rtype: Option(secondaryType)
         """
-        data = name.upper().split('__')
-        if len(data) > 2:
-            return Option.from_value(data.pop())
-        return Option.from_value(None)
+        return Option.from_value(memdam.common.field.describe(name).secondary_type)
 
     @staticmethod
     def from_json_dict(data):
         """
         Convert from a dictionary loaded from JSON to an Event
         """
-        keys = list(data.keys())
-        for key in keys:
-            field_type = Event.field_type(key)
-            if field_type == memdam.common.field.FieldType.TIME:
-                data[key] = dateutil.parser.parse(data[key])
-            elif field_type == memdam.common.field.FieldType.ID:
-                data[key] = uuid.UUID(data[key])
-            elif field_type == memdam.common.field.FieldType.RAW:
-                data[key] = buffer(base64.b64decode(data[key]))
-            elif field_type == memdam.common.field.FieldType.FILE:
-                data[key] = memdam.common.blob.BlobReference.from_json(data[key])
+        data = dict((key, memdam.common.field.describe(key).from_json(value)) for key, value in data.items())
         # pylint: disable=W0142
         return Event(**data)
 
@@ -242,11 +303,77 @@ class Event(object):
             assert memdam.common.validation.NAMESPACE_REGEX.match(value), \
             "Namespace %s did not match %s" % (value, memdam.common.validation.NAMESPACE_PATTERN)
 
-def _make_hash_key(data):
-    """recursively make a bunch of tuples out of a dict for stable hashing"""
-    if isinstance(data, types.TupleType):
-        return data
-    elif hasattr(data, '__iter__'):
-        sorted_keys = sorted([x for x in data])
-        return ((key, _make_hash_key(data[key])) for key in sorted_keys)
-    return data
+class FieldLayout(object):
+    """
+    The fields of an Event, shared by every event from the same namespace with the same fields.
+    Layouts are interned (see get), and never change.
+
+    :attr namespace: the namespace of the events
+    :type namespace: unicode
+    :attr names: the name of every field except type__namespace, sorted. Values are in this order.
+    :type names: tuple(unicode)
+    :attr fields: the descriptor of each of those fields
+    :type fields: tuple(memdam.common.field.FieldDescriptor)
+    :attr types: the memdam.common.field.FieldType of each of those fields
+    :type types: tuple(memdam.common.field.FieldType)
+    :attr indices: field name -> where its value is
+    :type indices: dict(unicode, int)
+    :attr keys: the name of every field, including type__namespace
+    :type keys: frozenset(unicode)
+    :attr id_index: where the value of id__id is
+    :type id_index: int
+    :attr time_index: where the value of time__time is
+    :type time_index: int
+    """
+
+    __slots__ = ('namespace', 'names', 'fields', 'types', 'indices', 'keys', 'id_index', 'time_index')
+
+    #(namespace, frozenset(field names)) -> FieldLayout
+    _layouts = {}
+    _layouts_lock = threading.Lock()
+
+    def __init__(self, namespace, names):
+        """
+        Checks the namespace and the names of the fields. Use get instead, so that this only happens once.
+        """
+        assert memdam.common.validation.NAMESPACE_REGEX.match(namespace), \
+        "Namespace %s did not match %s" % (namespace, memdam.common.validation.NAMESPACE_PATTERN)
+        names = tuple(sorted(unicode(name) for name in names))
+        base_names = set([u'type'])
+        for name in names:
+            assert memdam.common.validation.EVENT_FIELD_REGEX.match(name), "Field %s contains something besides a-z_ or is the wrong type. Should match: %s" % (name, memdam.common.validation.EVENT_FIELD_REGEX.pattern)
+            base_name = memdam.common.field.describe(name).raw_name
+            assert base_name not in base_names, "Duplicated key: " + base_name
+            base_names.add(base_name)
+        assert u'id__id' in names, "Events must have an id__id"
+        assert u'time__time' in names, "Events must have a time__time"
+        self.namespace = namespace
+        self.names = names
+        self.fields = tuple(memdam.common.field.describe(name) for name in names)
+        self.types = tuple(field.type for field in self.fields)
+        self.indices = dict((name, i) for i, name in enumerate(names))
+        self.keys = frozenset(names + (u'type__namespace',))
+        self.id_index = self.indices[u'id__id']
+        self.time_index = self.indices[u'time__time']
+
+    @staticmethod
+    def get(namespace, names):
+        """
+        :param namespace: the namespace of the event
+        :type  namespace: unicode
+        :param names: the names of the fields, except type__namespace
+        :type  names: iterable(unicode)
+        :returns: the one layout for this namespace and these fields
+        :rtype: memdam.common.event.FieldLayout
+        """
+        key = (namespace, frozenset(names))
+        layout = FieldLayout._layouts.get(key)
+        if layout is None:
+            layout = FieldLayout(namespace, key[1])
+            with FieldLayout._layouts_lock:
+                layout = FieldLayout._layouts.setdefault(key, layout)
+        return layout
+
+def _unpickle(data):
+    """Pickle can only refer to top level functions, see Event.__reduce__"""
+    return Event.from_trusted_dict(data)
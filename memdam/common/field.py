@@ -1,4 +1,178 @@
+"""
+The types of event fields, and everything that can be worked out from the name of a field.
+
+Field names look like name__type or name__type__secondary_type (see memdam.common.event.Event).
+describe parses each distinct name once, into a FieldDescriptor that is shared by everyone who asks
+about that name afterwards, so that code that runs for every field of every event never has to
+parse names or compare types to decide how to convert a value.
+"""
+
+import uuid
+import base64
+import threading
 
 import memdam.common.enum
+import memdam.common.timeutils
 
 FieldType = memdam.common.enum.enum('NUMBER', 'STRING', 'TEXT', 'ENUM', 'RAW', 'BOOL', 'TIME', 'ID', 'LONG', 'FILE', 'NAMESPACE')
+
+#how each type of field is declared in sqlite
+SQL_TYPES = {
+    FieldType.NUMBER: 'FLOAT',
+    FieldType.STRING: 'TEXT',
+    #this might seems strange, but it's because we store an index to a document in another table
+    FieldType.TEXT: 'INTEGER',
+    FieldType.ENUM: 'TEXT',
+    FieldType.RAW: 'BLOB',
+    FieldType.BOOL: 'BOOL',
+    FieldType.TIME: 'INTEGER',
+    FieldType.ID: 'TEXT',
+    FieldType.LONG: 'INTEGER',
+    FieldType.FILE: 'TEXT',
+    FieldType.NAMESPACE: 'TEXT',
+}
+
+class FieldDescriptor(object):
+    """
+    Everything about a field that follows from its name. Never changes, and there is only ever one
+    per name (see describe).
+
+    The json functions convert values to and from what is in Event.to_json_dict, and the sql
+    functions convert them to and from what is stored in sqlite. TEXT fields are stored as a
+    reference to a separate document, which the sqlite Eventstore deals with itself, so the sql
+    functions leave their values alone.
+
+    :attr name: the whole name of the field
+    :type name: unicode
+    :attr raw_name: the name without the type and secondary type
+    :type raw_name: unicode
+    :attr type: the type of the field
+    :type type: FieldType
+    :attr secondary_type: the secondary type (upper case), or None if there isn't one
+    :type secondary_type: string
+    :attr sql_type: how the field is declared in sqlite
+    :type sql_type: string
+    :attr to_json: function(value) -> JSON value
+    :type to_json: function
+    :attr from_json: function(JSON value) -> value
+    :type from_json: function
+    :attr to_sql: function(value) -> the value as it is stored
+    :type to_sql: function
+    :attr from_sql: function(the value as it is stored) -> value
+    :type from_sql: function
+    """
+
+    __slots__ = ('name', 'raw_name', 'type', 'secondary_type', 'sql_type', 'to_json', 'from_json', 'to_sql', 'from_sql')
+
+    def __init__(self, name):
+        """
+        Use describe instead, so that names are only parsed once.
+        """
+        parts = name.split('__')
+        self.name = name
+        self.raw_name = parts[0]
+        self.type = getattr(FieldType, parts[1].upper())
+        self.secondary_type = None
+        if len(parts) > 2:
+            self.secondary_type = parts[-1].upper()
+        self.sql_type = SQL_TYPES[self.type]
+        self.to_json, self.from_json = _JSON_CODECS.get(self.type, (_identity, _identity))
+        self.to_sql, self.from_sql = _SQL_CODECS.get(self.type, (_identity, _identity))
+
+    def __repr__(self):
+        return "FieldDescriptor(%r)" % (self.name,)
+
+#name -> FieldDescriptor
+_descriptors = {}
+_descriptors_lock = threading.Lock()
+
+def describe(name):
+    """
+    :param name: the name of a field, eg, cpu__number__percent
+    :type  name: unicode
+    :returns: the one descriptor for that name
+    :rtype: FieldDescriptor
+    :throws: Exception if the name does not have a valid type
+    """
+    descriptor = _descriptors.get(name)
+    if descriptor is None:
+        descriptor = FieldDescriptor(unicode(name))
+        with _descriptors_lock:
+            descriptor = _descriptors.setdefault(name, descriptor)
+    return descriptor
+
+def _identity(value):
+    """:returns: the value, unchanged"""
+    return value
+
+def _to_unicode(value):
+    """:returns: the value as unicode"""
+    return unicode(value)
+
+def _encode_time(value):
+    """:returns: the ISO 8601 representation of the datetime"""
+    return unicode(value.isoformat())
+
+def _encode_id(value):
+    """:returns: the hex representation of the UUID"""
+    return unicode(value.hex)
+
+def _encode_raw(value):
+    """:returns: the buffer, base64 encoded"""
+    return unicode(base64.b64encode(value))
+
+def _decode_raw(value):
+    """:returns: the buffer from its base64 encoding"""
+    return buffer(base64.b64decode(value))
+
+def _decode_file(value):
+    """:returns: the BlobReference from its JSON representation"""
+    #blob needs this module (through validation), so it can't be imported until now
+    import memdam.common.blob
+    return memdam.common.blob.BlobReference.from_json(value)
+
+def _encode_file(value):
+    """:returns: the JSON representation of the BlobReference"""
+    return value.to_json()
+
+def _store_id(value):
+    """:returns: the UUID as stored (as bytes)"""
+    return buffer(value.bytes)
+
+def _load_id(value):
+    """:returns: the UUID from the way it is stored"""
+    return uuid.UUID(bytes=str(value))
+
+def _load_bool(value):
+    """:returns: the bool from the way it is stored"""
+    return value == 1
+
+def _store_file(value):
+    """:returns: the BlobReference as stored (as its file name)"""
+    return value.name
+
+def _load_file(value):
+    """:returns: the BlobReference from its file name"""
+    import memdam.common.blob
+    blob_id, extension = value.split('.', 1)
+    return memdam.common.blob.BlobReference(uuid.UUID(blob_id), extension)
+
+#FieldType -> (to_json, from_json). Any that are left out are unchanged.
+_JSON_CODECS = {
+    FieldType.STRING: (_to_unicode, _identity),
+    FieldType.TEXT: (_to_unicode, _identity),
+    FieldType.ENUM: (_to_unicode, _identity),
+    FieldType.NAMESPACE: (_to_unicode, _identity),
+    FieldType.TIME: (_encode_time, memdam.common.timeutils.parse_time),
+    FieldType.ID: (_encode_id, uuid.UUID),
+    FieldType.RAW: (_encode_raw, _decode_raw),
+    FieldType.FILE: (_encode_file, _decode_file),
+}
+
+#FieldType -> (to_sql, from_sql). Any that are left out are unchanged.
+_SQL_CODECS = {
+    FieldType.TIME: (memdam.common.timeutils.time_to_long, memdam.common.timeutils.long_to_time),
+    FieldType.ID: (_store_id, _load_id),
+    FieldType.BOOL: (_identity, _load_bool),
+    FieldType.FILE: (_store_file, _load_file),
+}
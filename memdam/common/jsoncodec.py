@@ -0,0 +1,110 @@
+"""
+Convert events to and from JSON as quickly as possible, since that is most of the work of saving and
+finding events over HTTP.
+
+The representation is exactly the same as Event.to_json_dict and Event.from_json_dict, but the work
+that only depends on the fields of an event (which conversion to use for each value, and the
+FieldLayout for the decoded events) is done once per namespace and set of fields instead of once
+per event, and lists of events are converted in one call.
+"""
+
+import json
+import threading
+
+import memdam.common.event
+
+#memdam.common.event.FieldLayout -> ((field name, to_json function), ...)
+_encoders = {}
+#(namespace, frozenset(every key of the JSON dict)) -> memdam.common.event.FieldLayout
+_decoders = {}
+_lock = threading.Lock()
+
+def encode_event(event):
+    """
+    :param event: the event to convert
+    :type  event: memdam.common.event.Event
+    :returns: the same dict as event.to_json_dict()
+    :rtype: dict
+    """
+    # pylint: disable=W0212
+    layout = event._layout
+    encoders = _encoders.get(layout)
+    if encoders is None:
+        encoders = tuple((field.name, field.to_json) for field in layout.fields)
+        with _lock:
+            encoders = _encoders.setdefault(layout, encoders)
+    json_dict = dict((name, to_json(value)) for (name, to_json), value in zip(encoders, event._values))
+    json_dict[u'type__namespace'] = layout.namespace
+    return json_dict
+
+def decode_event(json_dict):
+    """
+    Like Event.from_json_dict, so the values are still checked, since they are usually from
+    somewhere else.
+
+    :param json_dict: the decoded JSON data
+    :type  json_dict: dict
+    :returns: the event that this JSON represents
+    :rtype: memdam.common.event.Event
+    :throws: AssertionError if the JSON is not a valid event
+    """
+    assert u'type__namespace' in json_dict, "Events must have a type__namespace"
+    namespace = json_dict[u'type__namespace']
+    key = (namespace, frozenset(json_dict))
+    layout = _decoders.get(key)
+    if layout is None:
+        assert isinstance(namespace, unicode), \
+        "Namespaces should be unicode, %s was %s" % (namespace, type(namespace))
+        names = [name for name in json_dict if name != u'type__namespace']
+        layout = memdam.common.event.FieldLayout.get(namespace, names)
+        with _lock:
+            layout = _decoders.setdefault(key, layout)
+    values = []
+    for field in layout.fields:
+        value = json_dict[field.name]
+        assert value is not None, "Can not set attributes to None. If you want to, simply leave it off."
+        value = field.from_json(value)
+        memdam.common.event.Event.validate(value, field.type)
+        values.append(value)
+    # pylint: disable=W0212
+    return memdam.common.event.Event._from_layout(layout, tuple(values))
+
+def encode_events(events):
+    """
+    :param events: the events to convert
+    :type  events: iterable(memdam.common.event.Event)
+    :returns: a JSON list of the events
+    :rtype: string
+    """
+    return json.dumps([encode_event(event) for event in events])
+
+def decode_events(data):
+    """
+    :param data: a JSON list of events, or that list already decoded
+    :type  data: string OR list(dict)
+    :returns: the events
+    :rtype: list(memdam.common.event.Event)
+    """
+    if isinstance(data, basestring):
+        data = json.loads(data)
+    return [decode_event(json_dict) for json_dict in data]
+
+def encode_line(event, sort_keys=False):
+    """
+    :param event: the event to convert
+    :type  event: memdam.common.event.Event
+    :param sort_keys: whether the fields should be in a stable order
+    :type  sort_keys: bool
+    :returns: the event as a single line of JSON (for newline-delimited JSON), including the newline
+    :rtype: string
+    """
+    return json.dumps(encode_event(event), sort_keys=sort_keys) + '\n'
+
+def decode_line(line):
+    """
+    :param line: a single line of newline-delimited JSON
+    :type  line: string
+    :returns: the event on that line
+    :rtype: memdam.common.event.Event
+    """
+    return decode_event(json.loads(line))
@@ -1,7 +1,13 @@
 
 # pylint: disable=W0401,W0622,W0614
+import datetime
+
+import dateutil.parser
 from funcy import *
 
+import memdam.common.field
+import memdam.common.event
+
 class Query(object):
     """
     Represents a query to the event archive
@@ -27,7 +33,7 @@ class Query(object):
         :returns: a dict ready for json serialization
         :rtype: dict
         """
-        encoded_filters = (f.to_json_dict() for f in self.filters)
+        encoded_filters = [f.to_json_dict() for f in self.filters]
         if len(encoded_filters) <= 0:
             encoded_filters = None
         return select(lambda (k, v): v != None, dict(
@@ -48,18 +54,19 @@ class Query(object):
         """
         order = json_dict.get('order', None)
         limit = json_dict.get('limit', None)
-        filters = json_dict.get('filters', None)
+        filters = json_dict.get('filters', None) or ()
         decoded_filters = (QueryFilter.from_json_dict(f) for f in filters)
         return Query(filters=decoded_filters, order=order, limit=limit)
 
-#TODO (security): be more strict about acceptable operators and strings
+#note: operators and operands are validated when the filter is compiled (see memdam.eventstore.compiler)
 class QueryFilter(object):
     """
     Limit the events returned by a Query to a matching subset
 
     :attr lhs: left hand side of a comparison
     :type lhs: QueryFilter|unicode
-    :attr operator: the actual comparison to perform.
+    :attr operator: the actual comparison to perform (=, !=, <, <=, >, >=, like), AND or OR to combine
+    two other QueryFilters, or match for a full text search of a TEXT field (lhs) for the words in rhs
     :type operator: string
     :attr rhs: right hand side of a comparison
     :type rhs: QueryFilter|unicode
@@ -116,3 +123,177 @@ def _possibly_decode(arg):
     if isinstance(arg, dict):
         return QueryFilter.from_json_dict(arg)
     return arg
+
+class AggregateQuery(object):
+    """
+    Summarizes the events that match some filters instead of returning them (see
+    memdam.eventstore.api.Eventstore.aggregate)
+
+    :attr filters: the set of constraints for this query (just like for Query)
+    :type filters: iterable(QueryFilter)
+    :attr aggregates: what to calculate for each bucket, as (function, field name) pairs. The
+    functions are count, min, max, sum and avg. The field name may be None for count, to count events.
+    :type aggregates: tuple(tuple(unicode, unicode), ...)
+    :attr bucket: if not None, events are grouped into buckets of this many seconds by time__time
+    :type bucket: int
+    :attr group_by: if not None, events are also grouped by the value of this ENUM or STRING field
+    (or by namespace, if this is namespace__namespace)
+    :type group_by: unicode
+    """
+    def __init__(self, filters=None, aggregates=None, bucket=None, group_by=None):
+        if filters == None:
+            filters = ()
+        if aggregates == None:
+            aggregates = ((u'count', None),)
+        self.filters = tuple(filters)
+        self.aggregates = tuple(tuple(x) for x in aggregates)
+        self.bucket = bucket
+        self.group_by = group_by
+
+    def to_json_dict(self):
+        """
+        Convert from an AggregateQuery object to JSON
+
+        :returns: a dict ready for json serialization
+        :rtype: dict
+        """
+        encoded_filters = [f.to_json_dict() for f in self.filters]
+        if len(encoded_filters) <= 0:
+            encoded_filters = None
+        return select(lambda (k, v): v != None, dict(
+            filters=encoded_filters,
+            aggregates=[list(x) for x in self.aggregates],
+            bucket=self.bucket,
+            group_by=self.group_by
+        ))
+
+    @staticmethod
+    def from_json_dict(json_dict):
+        """
+        Convert from JSON to an AggregateQuery object.
+
+        :param json_dict: the decoded JSON data
+        :type  json_dict: dict
+        :returns: the query that this JSON represents
+        :rtype: memdam.common.query.AggregateQuery
+        """
+        filters = json_dict.get('filters', None) or ()
+        decoded_filters = (QueryFilter.from_json_dict(f) for f in filters)
+        return AggregateQuery(filters=decoded_filters,
+                              aggregates=json_dict.get('aggregates', None),
+                              bucket=json_dict.get('bucket', None),
+                              group_by=json_dict.get('group_by', None))
+
+class AggregateRow(object):
+    """
+    One group of events from the result of an AggregateQuery
+
+    :attr bucket: the start of the time bucket, or None if the query had no buckets
+    :type bucket: datetime.datetime
+    :attr group: the value of the group_by field, or None if the query had no group_by (or the events
+    did not have that field)
+    :type group: unicode
+    :attr values: the result of each of the query's aggregates, in the same order
+    :type values: list
+    """
+
+    def __init__(self, bucket, group, values):
+        self.bucket = bucket
+        self.group = group
+        self.values = list(values)
+
+    def __eq__(self, other):
+        return (self.bucket, self.group, self.values) == (other.bucket, other.group, other.values)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "AggregateRow(%r, %r, %r)" % (self.bucket, self.group, self.values)
+
+    def to_json_dict(self):
+        """
+        Convert from an AggregateRow object to JSON
+
+        :returns: a dict ready for json serialization
+        :rtype: dict
+        """
+        return dict(
+            bucket=_encode_time(self.bucket),
+            group=self.group,
+            values=[_encode_time(x) for x in self.values]
+        )
+
+    @staticmethod
+    def from_json_dict(json_dict, query):
+        """
+        Convert from JSON to an AggregateRow object.
+
+        :param json_dict: the decoded JSON data
+        :type  json_dict: dict
+        :param query: the query that this is a result for (which decides which values are times)
+        :type  query: memdam.common.query.AggregateQuery
+        :returns: the row that this JSON represents
+        :rtype: memdam.common.query.AggregateRow
+        """
+        values = []
+        for (function, field), value in zip(query.aggregates, json_dict['values']):
+            if function in (u'min', u'max') and memdam.common.event.Event.field_type(field) == memdam.common.field.FieldType.TIME:
+                value = _decode_time(value)
+            values.append(value)
+        return AggregateRow(_decode_time(json_dict['bucket']), json_dict['group'], values)
+
+def _encode_time(value):
+    """Convert to JSON if this is a datetime, otherwise return"""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+def _decode_time(value):
+    """Convert from JSON if this is not None, otherwise return"""
+    if value is None:
+        return None
+    return dateutil.parser.parse(value)
+
+class SearchResult(object):
+    """
+    One of the events found by a full text search (see memdam.eventstore.api.Eventstore.search)
+
+    :attr event: the event that matched
+    :type event: memdam.common.event.Event
+    :attr rank: how well the event matched. Higher is better.
+    :type rank: float
+    :attr snippets: the parts of the searched TEXT fields that matched, by field name
+    :type snippets: dict(unicode, unicode)
+    """
+
+    def __init__(self, event, rank, snippets):
+        self.event = event
+        self.rank = rank
+        self.snippets = snippets
+
+    def to_json_dict(self):
+        """
+        Convert from a SearchResult object to JSON
+
+        :returns: a dict ready for json serialization
+        :rtype: dict
+        """
+        return dict(
+            event=self.event.to_json_dict(),
+            rank=self.rank,
+            snippets=self.snippets
+        )
+
+    @staticmethod
+    def from_json_dict(json_dict):
+        """
+        Convert from JSON to a SearchResult object.
+
+        :param json_dict: the decoded JSON data
+        :type  json_dict: dict
+        :returns: the search result that this JSON represents
+        :rtype: memdam.common.query.SearchResult
+        """
+        event = memdam.common.event.Event.from_json_dict(json_dict['event'])
+        return SearchResult(event, json_dict['rank'], json_dict['snippets'])
@@ -3,9 +3,17 @@
 Contains some helper functions related to time
 """
 
+import re
 import time
 import datetime
 import pytz
+import dateutil.parser
+
+#times are stored as microseconds since this
+EPOCH_BEGIN = datetime.datetime(1970, 1, 1, tzinfo=pytz.UTC)
+
+#exactly what datetime.isoformat produces for UTC times (which is how every stored time is written)
+UTC_ISO_8601_REGEX = re.compile(r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?(?:Z|\+00:00)$')
 
 def now():
     """
@@ -25,3 +33,40 @@ def local_time_to_utc(unaware_time):
     offset = time.timezone if (time.localtime().tm_isdst == 0) else time.altzone
     adjusted_time = unaware_time + datetime.timedelta(seconds=offset)
     return datetime.datetime(adjusted_time.year, adjusted_time.month, adjusted_time.day, adjusted_time.hour, adjusted_time.minute, adjusted_time.second, adjusted_time.microsecond, pytz.UTC)
+
+def time_to_long(value):
+    """
+    :param value: a timezone aware time
+    :type  value: datetime.datetime
+    :returns: the number of microseconds since EPOCH_BEGIN (which is how times are stored)
+    :rtype: long
+    """
+    return long(round(1000000.0 * (value - EPOCH_BEGIN).total_seconds()))
+
+def long_to_time(value):
+    """
+    :param value: a number of microseconds since EPOCH_BEGIN
+    :type  value: long
+    :returns: the time, in UTC
+    :rtype: datetime.datetime
+    """
+    return EPOCH_BEGIN + datetime.timedelta(microseconds=value)
+
+def parse_time(value):
+    """
+    Times in UTC in exactly the format that datetime.isoformat produces are parsed directly, since
+    that is how times are almost always written. Anything else is left to dateutil.
+
+    :param value: an ISO 8601 representation of a time
+    :type  value: unicode
+    :returns: the time
+    :rtype: datetime.datetime
+    """
+    match = UTC_ISO_8601_REGEX.match(value)
+    if match is None:
+        return dateutil.parser.parse(value)
+    year, month, day, hour, minute, second, fraction = match.groups()
+    microsecond = 0
+    if fraction is not None:
+        microsecond = int(fraction.ljust(6, '0'))
+    return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond, pytz.UTC)
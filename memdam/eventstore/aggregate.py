@@ -0,0 +1,154 @@
+"""
+Evaluate memdam.common.query.AggregateQuery. Every table calculates partial results in sql (one row
+per bucket and group), and those are combined here, so only a few rows per table ever leave sqlite.
+"""
+
+import memdam
+import memdam.common.field
+import memdam.common.event
+import memdam.common.validation
+import memdam.eventstore.compiler
+
+FUNCTIONS = frozenset(('count', 'min', 'max', 'sum', 'avg'))
+#the types of fields that each function makes sense for (None means any field, or no field at all)
+FIELD_TYPES = {
+    'count': None,
+    'min': (memdam.common.field.FieldType.NUMBER, memdam.common.field.FieldType.LONG, memdam.common.field.FieldType.TIME),
+    'max': (memdam.common.field.FieldType.NUMBER, memdam.common.field.FieldType.LONG, memdam.common.field.FieldType.TIME),
+    'sum': (memdam.common.field.FieldType.NUMBER, memdam.common.field.FieldType.LONG, memdam.common.field.FieldType.BOOL),
+    'avg': (memdam.common.field.FieldType.NUMBER, memdam.common.field.FieldType.LONG, memdam.common.field.FieldType.BOOL),
+}
+GROUP_BY_TYPES = (memdam.common.field.FieldType.ENUM, memdam.common.field.FieldType.STRING)
+
+@memdam.vtrace()
+def validate(query):
+    """
+    Make sure that the query only refers to things that can be aggregated, since the field names end
+    up in the sql.
+
+    :param query: the query to check
+    :type  query: memdam.common.query.AggregateQuery
+    :raises: AssertionError if the query is invalid
+    """
+    assert len(query.aggregates) > 0, "Must calculate at least one aggregate"
+    for function, field in query.aggregates:
+        assert function in FUNCTIONS, "Unsupported aggregate function: %s" % (function)
+        if field is None:
+            assert function == 'count', "Only count can be used without a field"
+            continue
+        assert memdam.common.validation.EVENT_FIELD_REGEX.match(field), "Invalid field: %s" % (field)
+        field_types = FIELD_TYPES[function]
+        if field_types is not None:
+            assert memdam.common.event.Event.field_type(field) in field_types, "Can't calculate %s of %s" % (function, field)
+    if query.bucket is not None:
+        assert isinstance(query.bucket, (int, long, float)) and not isinstance(query.bucket, bool), "Buckets must be a number of seconds"
+        assert query.bucket >= 1, "Buckets must be at least one second"
+        assert query.bucket % 1 == 0, "Buckets must be a whole number of seconds"
+    if query.group_by is not None and query.group_by not in memdam.eventstore.compiler.NAMESPACE_FIELDS:
+        assert memdam.common.validation.EVENT_FIELD_REGEX.match(query.group_by), "Invalid field: %s" % (query.group_by)
+        assert memdam.common.event.Event.field_type(query.group_by) in GROUP_BY_TYPES, "Can only group by ENUM or STRING fields, not %s" % (query.group_by)
+
+def partial_sql(function, column_sql):
+    """
+    :param column_sql: the sql for the field (eg, the column name, or NULL if the table doesn't have
+    it), or None to count rows
+    :type  column_sql: string
+    :returns: the sql expressions for the partial results of this function (in the order that
+    Accumulator.add expects them)
+    :rtype: list(string)
+    """
+    if function == 'count':
+        if column_sql is None:
+            return ["COUNT(*)"]
+        return ["COUNT(%s)" % (column_sql)]
+    if function == 'avg':
+        return ["SUM(%s)" % (column_sql), "COUNT(%s)" % (column_sql)]
+    return ["%s(%s)" % (function.upper(), column_sql)]
+
+class Accumulator(object):
+    """
+    Combines the partial results for each bucket and group, as they come in from each table.
+    """
+
+    def __init__(self, aggregates):
+        """
+        :param aggregates: see memdam.common.query.AggregateQuery.aggregates
+        :type  aggregates: tuple(tuple(unicode, unicode), ...)
+        """
+        self._functions = [function for function, _ in aggregates]
+        #(bucket, group) -> the partial results for each function
+        self._partials = {}
+
+    def add(self, bucket, group, partials):
+        """
+        :param bucket: the number of the time bucket (or None)
+        :type  bucket: long
+        :param group: the value of the group_by field (or None)
+        :type  group: unicode
+        :param partials: the results of every expression from partial_sql, for every function in order
+        :type  partials: sequence
+        """
+        key = (bucket, group)
+        existing = self._partials.get(key, None)
+        split = self._split(partials)
+        if existing is None:
+            self._partials[key] = split
+        else:
+            self._partials[key] = [_combine(function, a, b) for function, a, b in zip(self._functions, existing, split)]
+
+    def results(self):
+        """
+        :returns: the final result of every function for every (bucket, group), sorted by bucket
+        then group
+        :rtype: list(tuple(long, unicode, list))
+        """
+        results = []
+        for key in sorted(self._partials.keys()):
+            values = [_finish(function, partial) for function, partial in zip(self._functions, self._partials[key])]
+            results.append((key[0], key[1], values))
+        return results
+
+    def _split(self, partials):
+        """
+        :returns: the partial results grouped by function (avg has two)
+        :rtype: list
+        """
+        split = []
+        i = 0
+        for function in self._functions:
+            if function == 'avg':
+                split.append((partials[i], partials[i+1]))
+                i += 2
+            else:
+                split.append(partials[i])
+                i += 1
+        return split
+
+def _combine(function, a, b):
+    """
+    :returns: the partial result for the union of the events that a and b were calculated from
+    """
+    if function == 'avg':
+        return (_combine('sum', a[0], b[0]), _combine('count', a[1], b[1]))
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if function in ('count', 'sum'):
+        return a + b
+    if function == 'min':
+        return min(a, b)
+    return max(a, b)
+
+def _finish(function, partial):
+    """
+    :returns: the final result, given the partial result for all of the events
+    """
+    if function == 'avg':
+        total, count = partial
+        if not count:
+            return None
+        return float(total) / count
+    if function == 'count' and partial is None:
+        return 0
+    return partial
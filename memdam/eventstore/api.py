@@ -24,14 +24,72 @@ class Eventstore(memdam.Base):
         :raises: Exception if there is no event with that id.
         """
 
+    def get_many(self, event_ids):
+        """
+        :param event_ids: the UUIDs of the events to retrieve
+        :type  event_ids: list(UUID)
+        :returns: the events with those ids, in the same order
+        :rtype:  list(memdam.common.event.Event)
+        :raises: Exception if there is no event with any one of those ids.
+        """
+
     def find(self, query):
         """
+        Equivalent to list(self.find_iter(query))
+
         :param query: defines the filters which restrict which events should be found
         :type  query: memdam.common.query.Query
         :returns: all events that match the given query.
         :rtype: list(memdam.common.event.Event)
         """
 
+    def find_iter(self, query):
+        """
+        Like find, but yields the events a page at a time instead of loading all of them into
+        memory at once. Use this when the query might match a huge number of events.
+
+        :param query: defines the filters which restrict which events should be found
+        :type  query: memdam.common.query.Query
+        :returns: all events that match the given query.
+        :rtype: generator(memdam.common.event.Event)
+        """
+
+    def search(self, query):
+        """
+        Full text search. The first (top level) match filter in the query decides the rank of each
+        event, and the other filters just restrict which events are found.
+
+        :param query: must contain at least one QueryFilter with the match operator
+        :type  query: memdam.common.query.Query
+        :returns: the events that match the query, best matches first (up to the limit)
+        :rtype: list(memdam.common.query.SearchResult)
+        """
+
+    def aggregate(self, query):
+        """
+        Summarize the events that match the query without loading them. Each aggregate is calculated
+        for every time bucket and group that has at least one matching event.
+
+        :param query: defines which events to summarize, and how
+        :type  query: memdam.common.query.AggregateQuery
+        :returns: one row per bucket and group, sorted by bucket and then group
+        :rtype: list(memdam.common.query.AggregateRow)
+        """
+
+    def changes_since(self, cursor=None, limit=None):
+        """
+        Read the change feeds: every save and delete after the cursor, so that new events can be
+        found without polling with find. Each event only appears once, with its latest change.
+
+        :param cursor: how far the caller has already read (from the start of every feed if None)
+        :type  cursor: memdam.common.change.Cursor
+        :param limit: the most changes to return, or None for all of them
+        :type  limit: int
+        :returns: the changes, in order within each feed. cursor.advance(changes) is where to
+        continue from.
+        :rtype: list(memdam.common.change.Change)
+        """
+
     def delete(self, event_id):
         """
         Ensures that the given event id is deleted.
@@ -40,3 +98,9 @@ class Eventstore(memdam.Base):
         :param event_id: the event id to be deleted.
         :type  event_id: uuid.UUID
         """
+
+    def close(self):
+        """
+        Release any resources (connections, file handles, etc) held by this Eventstore.
+        It should not be used after this is called.
+        """
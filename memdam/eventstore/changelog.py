@@ -0,0 +1,100 @@
+"""
+The change feed of the sqlite Eventstore: every table gets a <table>__changes table in the same file,
+with one row per save or delete, in the same transaction as the change itself.
+
+Sequence numbers come from an AUTOINCREMENT key, so they only ever increase, even after rows are
+removed. Each event only keeps its latest change: saving or deleting it again replaces the old row
+with a new one at the end of the feed. So reading a feed from the beginning gives every event that is
+in the table (plus a tombstone for every event that was deleted), and anyone who fell behind skips
+straight to the latest version of each event. Tombstones are only removed by trim.
+"""
+
+import memdam
+
+CHANGES_SUFFIX = u'__changes'
+
+def changes_table_name(table_name):
+    """
+    :returns: the name of the table with the changes to this table
+    :rtype: unicode
+    """
+    return table_name + CHANGES_SUFFIX
+
+def is_changes_table(table_name):
+    """
+    :returns: True iff this is a table of changes rather than a table of events
+    :rtype: bool
+    """
+    return table_name.endswith(CHANGES_SUFFIX)
+
+@memdam.vtrace()
+def exists(cur, table_name):
+    """
+    :returns: True iff the changes table for this table has been created
+    :rtype: bool
+    """
+    sql = "SELECT name FROM sqlite_master WHERE type='table' AND name = ?;"
+    cur.execute(sql, (changes_table_name(table_name),))
+    return len(cur.fetchall()) > 0
+
+@memdam.vtrace()
+def create(cur, table_name, sealed_ids=()):
+    """
+    Create the changes table, with a save for every event that is already in the table (oldest
+    first), so that the feed starts out complete. Must be called inside of a write transaction.
+
+    :param sealed_ids: the ids (as stored) of the events that are in the segments of this table
+    :type  sealed_ids: iterable(buffer)
+    """
+    changes_table = changes_table_name(table_name)
+    cur.execute("CREATE TABLE %s(sequence INTEGER PRIMARY KEY AUTOINCREMENT, id__id BLOB NOT NULL, deleted INTEGER NOT NULL);" % \
+                (changes_table))
+    cur.execute("CREATE UNIQUE INDEX %s__id__id ON %s (id__id);" % (changes_table, changes_table))
+    sql = "INSERT OR REPLACE INTO %s (id__id, deleted) VALUES (?, 0);" % (changes_table)
+    cur.executemany(sql, ((event_id,) for event_id in sealed_ids))
+    cur.execute("INSERT OR REPLACE INTO %s (id__id, deleted) SELECT id__id, 0 FROM %s ORDER BY time__time, _id;" % \
+                (changes_table, table_name))
+
+@memdam.vtrace()
+def record(cur, table_name, event_ids, deleted):
+    """
+    Add a change for each of these events to the end of the feed, replacing any older changes to
+    the same events. Must be called in the same transaction as the changes themselves.
+
+    :param event_ids: the events that were saved or deleted
+    :type  event_ids: list(uuid.UUID)
+    :param deleted: True if the events were deleted, False if they were saved
+    :type  deleted: bool
+    """
+    sql = "INSERT OR REPLACE INTO %s (id__id, deleted) VALUES (?, ?);" % (changes_table_name(table_name))
+    cur.executemany(sql, ((buffer(event_id.bytes), int(deleted)) for event_id in event_ids))
+
+@memdam.vtrace()
+def read(cur, table_name, after, limit=None):
+    """
+    :param after: only changes with a larger sequence number than this are returned
+    :type  after: int
+    :param limit: the most changes to return, or None for all of them
+    :type  limit: int
+    :returns: (sequence, id (as stored), deleted) for each change, in order
+    :rtype: list(tuple(int, buffer, bool))
+    """
+    sql = "SELECT sequence, id__id, deleted FROM %s WHERE sequence > ? ORDER BY sequence" % (changes_table_name(table_name))
+    args = [after]
+    if limit is not None:
+        sql += " LIMIT ?"
+        args.append(limit)
+    cur.execute(sql + ";", args)
+    return [(row[0], row[1], row[2] != 0) for row in cur.fetchall()]
+
+@memdam.vtrace()
+def trim(cur, table_name, through):
+    """
+    Remove the tombstones up to (and including) a sequence number. Saves are always kept, since
+    they are the only record of the events that are in the table.
+
+    :returns: the number of tombstones that were removed
+    :rtype: int
+    """
+    cur.execute("DELETE FROM %s WHERE deleted = 1 AND sequence <= ?;" % (changes_table_name(table_name)), (through,))
+    return cur.rowcount
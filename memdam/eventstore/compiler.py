@@ -0,0 +1,330 @@
+"""
+Turn the filters from a memdam.common.query.Query into a sqlite WHERE clause with bound parameters.
+
+Filters are compiled in two steps. First the filter tree is reduced to its "shape" (the operators
+and columns, but not the values), so that, for example, every time-range query from the web UI has
+the same shape no matter what the bounds are. Then the shape is rendered to sql for the columns that
+a particular table actually has. The rendered sql is cached by shape and columns, so it is shared by
+every table with the same columns, and since the values are always bound (never formatted into the
+sql), sqlite can reuse its own prepared statements as well.
+
+Operands are interpreted as follows:
+- a QueryFilter is a nested condition (only for AND and OR)
+- anything that looks like an event field name (eg, time__time) refers to that column. Columns that
+  don't exist in a table are NULL, just like they are for the events in that table.
+- namespace__namespace (or type__namespace) is the namespace of the table
+- anything else is a value. Values compared to a column are converted the same way that values of
+  that type are stored (eg, datetimes become longs and UUIDs become bytes)
+
+TEXT fields can't be compared, but can be searched with the match operator, eg
+QueryFilter(u'body__text', u'match', u'hello world'), which uses the fts table for that field (see
+http://www.sqlite.org/fts3.html for the syntax of the search string).
+"""
+
+import threading
+import datetime
+import uuid
+import collections
+
+import memdam
+import memdam.common.field
+import memdam.common.blob
+import memdam.common.event
+import memdam.common.query
+import memdam.common.validation
+import memdam.eventstore.sqlite
+
+#replaced by the name of the table whenever the sql depends on it (eg, for fts tables)
+TABLE_NAME_PLACEHOLDER = '{table_name}'
+
+COMPARISON_OPERATORS = frozenset(('=', '==', '!=', '<>', '<', '<=', '>', '>=', 'like'))
+BOOLEAN_OPERATORS = frozenset(('and', 'or'))
+MATCH_OPERATOR = 'match'
+NAMESPACE_FIELDS = frozenset(('namespace__namespace', 'type__namespace'))
+
+class QueryCompiler(object):
+    """
+    Compiles query filters to sql, and remembers the result for each shape of query.
+    Safe to use from multiple threads.
+    """
+
+    DEFAULT_MAX_CACHED = 256
+
+    def __init__(self, max_cached=DEFAULT_MAX_CACHED):
+        """
+        :param max_cached: the most compiled forms to remember (least recently used are forgotten)
+        :type  max_cached: int
+        """
+        self._max_cached = max_cached
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def compile(self, filters, columns, namespace, table_name=None):
+        """
+        :param filters: the conditions, all of which must be true
+        :type  filters: iterable(memdam.common.query.QueryFilter)
+        :param columns: the names of the columns that exist in the table
+        :type  columns: iterable(string)
+        :param namespace: the namespace of the events in the table
+        :type  namespace: unicode
+        :param table_name: the name of the table. Only needed if there are match filters.
+        :type  table_name: unicode
+        :returns: the WHERE clause (without WHERE, or the empty string if there are no filters) and
+        the parameters to bind to it
+        :rtype: tuple(string, tuple)
+        """
+        values = []
+        shape = tuple(_filter_shape(f, values) for f in filters)
+        if len(shape) <= 0:
+            return "", ()
+        referenced_columns = set()
+        for elem in shape:
+            _collect_columns(elem, referenced_columns)
+        cache_key = (shape, frozenset(referenced_columns.intersection(columns)))
+        with self._lock:
+            compiled = self._cache.pop(cache_key, None)
+        if compiled is None:
+            compiled = CompiledFilter(shape, cache_key[1])
+        with self._lock:
+            self._cache[cache_key] = compiled
+            while len(self._cache) > self._max_cached:
+                self._cache.popitem(last=False)
+        sql = compiled.sql
+        if compiled.uses_table_name:
+            assert table_name is not None, "The table name is required for match filters"
+            sql = sql.replace(TABLE_NAME_PLACEHOLDER, table_name)
+        return sql, compiled.bind(values, namespace)
+
+class CompiledFilter(object):
+    """
+    The sql for one shape of query, in a table with a particular set of columns.
+
+    :attr sql: the WHERE clause, with a ? for every parameter
+    :type sql: string
+    :attr uses_table_name: iff True, TABLE_NAME_PLACEHOLDER in sql must be replaced by the table name
+    :type uses_table_name: bool
+    """
+
+    def __init__(self, shape, columns):
+        """
+        :param shape: see _filter_shape. Every element is one condition that must be true
+        :type  shape: tuple
+        :param columns: the columns (out of those referenced by the shape) that exist
+        :type  columns: frozenset(string)
+        """
+        #for each parameter: the index of the value to bind (None for the namespace), and the field
+        #type that it is being compared to (None if it should be bound as is)
+        self._parameters = []
+        self.uses_table_name = False
+        self.sql = " AND ".join(self._render(elem, columns) for elem in shape)
+
+    def bind(self, values, namespace):
+        """
+        :param values: the values from the query, in the same order that _filter_shape found them
+        :type  values: list
+        :returns: the parameters for self.sql
+        :rtype: tuple
+        """
+        args = []
+        for value_index, field_type in self._parameters:
+            if value_index is None:
+                args.append(namespace)
+            else:
+                args.append(_convert_value(values[value_index], field_type))
+        return tuple(args)
+
+    def _render(self, shape, columns):
+        """
+        :returns: the sql for this part of the shape, adding to self._parameters along the way
+        :rtype: string
+        """
+        kind = shape[0]
+        if kind == 'op':
+            _, operator, lhs, rhs = shape
+            if operator in BOOLEAN_OPERATORS:
+                return "(%s %s %s)" % (self._render(lhs, columns), operator.upper(), self._render(rhs, columns))
+            return "%s %s %s" % (self._render_operand(lhs, rhs, columns), operator.upper(), self._render_operand(rhs, lhs, columns))
+        if kind == 'match':
+            _, column, value = shape
+            if column not in columns:
+                return "NULL"
+            self.uses_table_name = True
+            self._parameters.append((value[1], None))
+            return "_id IN (SELECT docid FROM %s__%s__docs WHERE data MATCH ?)" % (TABLE_NAME_PLACEHOLDER, column)
+        raise Exception("Unexpected filter shape: %s" % (shape,))
+
+    def _render_operand(self, operand, other, columns):
+        """
+        :param other: the other side of the comparison, which decides how values are converted
+        :type  other: tuple
+        """
+        kind = operand[0]
+        if kind == 'column':
+            if operand[1] in columns:
+                return operand[1]
+            return "NULL"
+        if kind == 'namespace':
+            self._parameters.append((None, None))
+            return "?"
+        field_type = None
+        if other[0] == 'column':
+            field_type = memdam.common.event.Event.field_type(other[1])
+        self._parameters.append((operand[1], field_type))
+        return "?"
+
+@memdam.vtrace()
+def _filter_shape(query_filter, values):
+    """
+    :param query_filter: the filter to examine. Also validated here, since this is the only place
+    that user-supplied filters are turned into sql.
+    :type  query_filter: memdam.common.query.QueryFilter
+    :param values: every value found in the filter is appended to this list
+    :type  values: list
+    :returns: a hashable description of everything about the filter except for its values:
+    ('op', operator, lhs, rhs), where lhs and rhs are either other ops, ('column', name),
+    ('namespace',), or ('value', index in values), or ('match', TEXT column name, value)
+    :rtype: tuple
+    """
+    assert isinstance(query_filter, memdam.common.query.QueryFilter), "Not a QueryFilter: %r" % (query_filter,)
+    operator = query_filter.operator.lower()
+    if operator == MATCH_OPERATOR:
+        return ('match', match_column(query_filter), _value_shape(query_filter.rhs, values))
+    if operator in BOOLEAN_OPERATORS:
+        return ('op', operator, _filter_shape(query_filter.lhs, values), _filter_shape(query_filter.rhs, values))
+    assert operator in COMPARISON_OPERATORS, "Unsupported operator: %s" % (query_filter.operator)
+    return ('op', operator, _operand_shape(query_filter.lhs, values), _operand_shape(query_filter.rhs, values))
+
+#how a comparison changes when its sides are swapped, so that time__time is always on the left
+FLIPPED_OPERATORS = {'<': '>', '<=': '>=', '>': '<', '>=': '<=', '=': '=', '==': '=='}
+
+@memdam.vtrace()
+def time_bounds(filters):
+    """
+    Figure out the range of times that the filters allow, so that whole tables (eg, time partitions)
+    can be skipped. Only looks at comparisons between time__time and a value that are required to be
+    true (ie, not inside an OR), so the real range may be narrower.
+
+    :param filters: the conditions, all of which must be true
+    :type  filters: iterable(memdam.common.query.QueryFilter)
+    :returns: the smallest possible time (inclusive) and the largest possible time (exclusive), as
+    stored (longs). Either may be None if there is no bound.
+    :rtype: tuple(long, long)
+    """
+    lower, upper = None, None
+    for query_filter in required_filters(filters):
+        operator = query_filter.operator.lower()
+        if operator not in FLIPPED_OPERATORS:
+            continue
+        if query_filter.lhs == u'time__time':
+            value = query_filter.rhs
+        elif query_filter.rhs == u'time__time':
+            value = query_filter.lhs
+            operator = FLIPPED_OPERATORS[operator]
+        else:
+            continue
+        value = _convert_value(value, memdam.common.field.FieldType.TIME)
+        if not isinstance(value, (int, long)):
+            continue
+        if operator in ('>', '>=', '=', '=='):
+            if operator == '>':
+                value += 1
+            if lower is None or value > lower:
+                lower = value
+        if operator in ('<', '<=', '=', '=='):
+            if operator != '<':
+                value += 1
+            if upper is None or value < upper:
+                upper = value
+    return lower, upper
+
+def required_filters(filters):
+    """
+    :returns: every comparison that must be true for all of the filters to be true (ie, everything
+    that is not inside of an OR)
+    :rtype: generator(memdam.common.query.QueryFilter)
+    """
+    for query_filter in filters:
+        if query_filter.operator.lower() == 'and':
+            for required_filter in required_filters((query_filter.lhs, query_filter.rhs)):
+                yield required_filter
+        elif query_filter.operator.lower() != 'or':
+            yield query_filter
+
+def referenced_columns(filters):
+    """
+    :param filters: the conditions, all of which must be true
+    :type  filters: iterable(memdam.common.query.QueryFilter)
+    :returns: the name of every field that the filters compare or match
+    :rtype: set(string)
+    """
+    columns = set()
+    values = []
+    for query_filter in filters:
+        _collect_columns(_filter_shape(query_filter, values), columns)
+    return columns
+
+def _operand_shape(operand, values):
+    """
+    :returns: the shape of one side of a comparison (see _filter_shape)
+    :rtype: tuple
+    """
+    assert not isinstance(operand, memdam.common.query.QueryFilter), "Comparisons must be between columns and values, not conditions"
+    if isinstance(operand, basestring):
+        if operand in NAMESPACE_FIELDS:
+            return ('namespace',)
+        if memdam.common.validation.EVENT_FIELD_REGEX.match(operand):
+            assert memdam.common.event.Event.field_type(operand) != memdam.common.field.FieldType.TEXT, "text fields cannot be compared, only matched"
+            return ('column', operand)
+    return _value_shape(operand, values)
+
+def _value_shape(value, values):
+    """
+    :returns: the shape of a value (see _filter_shape)
+    :rtype: tuple
+    """
+    assert not isinstance(value, memdam.common.query.QueryFilter), "Expected a value, not a condition"
+    values.append(value)
+    return ('value', len(values) - 1)
+
+def match_column(query_filter):
+    """
+    :param query_filter: a filter with the match operator
+    :type  query_filter: memdam.common.query.QueryFilter
+    :returns: the name of the TEXT field that is being searched
+    :rtype: string
+    """
+    column = query_filter.lhs
+    assert isinstance(column, basestring) and memdam.common.validation.EVENT_FIELD_REGEX.match(column), "Can only match fields, not %r" % (column,)
+    assert memdam.common.event.Event.field_type(column) == memdam.common.field.FieldType.TEXT, "Can only match TEXT fields, not %s" % (column)
+    return column
+
+def _collect_columns(shape, columns):
+    """
+    Add the name of every column referenced anywhere in the shape to columns
+    """
+    if shape[0] in ('column', 'match'):
+        columns.add(shape[1])
+    elif shape[0] != 'value':
+        for elem in shape[1:]:
+            if isinstance(elem, tuple):
+                _collect_columns(elem, columns)
+
+def _convert_value(value, field_type):
+    """
+    :returns: the value, converted to the way that values of this field type are stored
+    """
+    if field_type == memdam.common.field.FieldType.TIME:
+        if isinstance(value, datetime.datetime):
+            return memdam.eventstore.sqlite.convert_time_to_long(value)
+    elif field_type == memdam.common.field.FieldType.ID:
+        if isinstance(value, basestring):
+            value = uuid.UUID(value)
+        if isinstance(value, uuid.UUID):
+            return buffer(value.bytes)
+    elif field_type == memdam.common.field.FieldType.BOOL:
+        if isinstance(value, bool):
+            return int(value)
+    elif field_type == memdam.common.field.FieldType.FILE:
+        if isinstance(value, memdam.common.blob.BlobReference):
+            return value.name
+    return value
@@ -0,0 +1,142 @@
+"""
+Combine the saves from lots of threads (eg, one per collector) into a few big transactions.
+"""
+
+import threading
+
+import memdam
+import memdam.eventstore.api
+
+class Eventstore(memdam.eventstore.api.Eventstore):
+    """
+    Wraps another Eventstore so that events saved by different threads at about the same time are
+    written together, with one transaction (and one fsync) per namespace instead of one per call.
+
+    The first thread to call save starts a batch and becomes its leader. It waits for up to window
+    seconds (or until the batch is full) for other threads to add their events, and then saves all of
+    them at once. Every other thread just waits for that save to finish. save never returns before
+    the events have actually been committed, so callers get exactly the same guarantees as before.
+    Only one batch is saved at a time, and the next batch keeps filling up until it can be saved.
+
+    If saving a batch fails, every caller that contributed to it gets the exception. Some of the
+    namespaces in the batch may have been committed anyway, just like when a single save of events
+    from several namespaces fails part way through.
+
+    Everything except save is passed straight through.
+    """
+
+    DEFAULT_WINDOW = 0.01
+    DEFAULT_MAX_BATCH_SIZE = 1000
+
+    def __init__(self, eventstore, window=DEFAULT_WINDOW, max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+        """
+        :param eventstore: where the events are actually saved
+        :type  eventstore: memdam.eventstore.api.Eventstore
+        :param window: the most seconds that a save will wait for other saves to join it
+        :type  window: float
+        :param max_batch_size: batches with at least this many events are saved without waiting
+        :type  max_batch_size: int
+        """
+        assert window >= 0
+        assert max_batch_size > 0
+        self._eventstore = eventstore
+        self._window = window
+        self._max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        self._pending = None
+
+    def save(self, events):
+        events = list(events)
+        if len(events) <= 0:
+            return
+        with self._lock:
+            batch = self._pending
+            is_leader = batch is None
+            if is_leader:
+                batch = _Batch()
+                self._pending = batch
+            batch.events.extend(events)
+            if len(batch.events) >= self._max_batch_size:
+                self._close(batch)
+        if is_leader:
+            self._commit(batch)
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+
+    def get(self, event_id):
+        return self._eventstore.get(event_id)
+
+    def get_many(self, event_ids):
+        return self._eventstore.get_many(event_ids)
+
+    def find(self, query):
+        return self._eventstore.find(query)
+
+    def find_iter(self, query):
+        return self._eventstore.find_iter(query)
+
+    def search(self, query):
+        return self._eventstore.search(query)
+
+    def aggregate(self, query):
+        return self._eventstore.aggregate(query)
+
+    def changes_since(self, cursor=None, limit=None):
+        return self._eventstore.changes_since(cursor, limit)
+
+    def delete(self, event_id):
+        self._eventstore.delete(event_id)
+
+    def close(self):
+        """
+        Every save has already been committed by the time it returns, so there is nothing to flush
+        """
+        self._eventstore.close()
+
+    def _commit(self, batch):
+        """
+        Wait for the batch to fill up, then save it and wake up everyone who is waiting on it
+        """
+        batch.full.wait(self._window)
+        try:
+            with self._commit_lock:
+                with self._lock:
+                    self._close(batch)
+                memdam.log().debug("Committing %s events at once" % (len(batch.events)))
+                self._eventstore.save(batch.events)
+        except Exception, e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+    def _close(self, batch):
+        """
+        Must hold the lock.
+        Stop adding events to this batch. Later saves will start a new one.
+        """
+        if self._pending is batch:
+            self._pending = None
+        batch.full.set()
+
+class _Batch(object):
+    """
+    The events from every save that is waiting to be committed together
+
+    :attr events: all of the events to save
+    :type events: list(memdam.common.event.Event)
+    :attr full: set once no more events can be added
+    :type full: threading.Event
+    :attr done: set once the events have been saved (or failed to save)
+    :type done: threading.Event
+    :attr error: the exception from saving the events, if any
+    :type error: Exception
+    """
+
+    def __init__(self):
+        self.events = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.error = None
@@ -1,6 +1,11 @@
 
 import json
 
+import memdam.common.jsoncodec
+import memdam.common.bincodec
+import memdam.common.query
+import memdam.common.change
+import memdam.common.client
 import memdam.eventstore.api
 
 class Eventstore(memdam.eventstore.api.Eventstore):
@@ -9,26 +14,84 @@ class Eventstore(memdam.eventstore.api.Eventstore):
 
     :attr _client: the method for actually making calls to the remote server
     :type _client: memdam.common.client.MemdamClient
+    :attr _binary: whether to send and receive events as binary (see memdam.common.bincodec) instead
+    of JSON. Binary events are a fraction of the size, and all of the events in a save are sent at once.
+    :type _binary: bool
     """
 
-    def __init__(self, client):
+    #how many bytes of binary events to read at a time
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, client, binary=False):
         self._client = client
+        self._binary = binary
 
     def save(self, events):
+        if self._binary:
+            events = list(events)
+            if len(events) > 0:
+                data = memdam.common.bincodec.encode_event_list(events)
+                self._client.request('POST', "/events", data=data,
+                                     headers={'Content-Type': memdam.common.client.BINARY_CONTENT_TYPE})
+            return
         for event in events:
-            event_json = json.dumps(event.to_json_dict())
+            event_json = json.dumps(memdam.common.jsoncodec.encode_event(event))
             self._client.request('PUT', "/events/" + event.id__id.hex, data=event_json)
 
     def get(self, event_id):
+        if self._binary:
+            response = self._client.request('GET', "/events/" + event_id.hex,
+                                            headers={'Accept': memdam.common.client.BINARY_CONTENT_TYPE})
+            return memdam.common.bincodec.decode_event_list(response.content)[0]
         response = self._client.request('GET', "/events/" + event_id.hex)
-        return memdam.common.event.Event.from_json_dict(response.json())
+        return memdam.common.jsoncodec.decode_event(response.json())
+
+    def get_many(self, event_ids):
+        return [self.get(event_id) for event_id in event_ids]
 
     def find(self, query):
+        if self._binary:
+            return list(self.find_iter(query))
         query_json = json.dumps(query.to_json_dict())
         response = self._client.request('POST', "/queries", data=query_json)
-        event_json_list = response.json()
-        event_list = [memdam.common.event.Event.from_json_dict(x) for x in event_json_list]
-        return event_list
+        return memdam.common.jsoncodec.decode_events(response.content)
+
+    def search(self, query):
+        query_json = json.dumps(query.to_json_dict())
+        response = self._client.request('POST', "/queries/search", data=query_json)
+        return [memdam.common.query.SearchResult.from_json_dict(x) for x in response.json()]
+
+    def aggregate(self, query):
+        query_json = json.dumps(query.to_json_dict())
+        response = self._client.request('POST', "/queries/aggregate", data=query_json)
+        return [memdam.common.query.AggregateRow.from_json_dict(x, query) for x in response.json()]
+
+    def find_iter(self, query):
+        """
+        Asks the server to stream the results back as newline-delimited JSON (or binary events), so
+        that neither side has to hold all of the events in memory at once.
+        """
+        query_json = json.dumps(query.to_json_dict())
+        if self._binary:
+            response = self._client.request('POST', "/queries", data=query_json, stream=True,
+                                            headers={'Accept': memdam.common.client.BINARY_CONTENT_TYPE})
+            for event in memdam.common.bincodec.decode_events(response.iter_content(self.CHUNK_SIZE)):
+                yield event
+            return
+        response = self._client.request('POST', "/queries", data=query_json, stream=True,
+                                        headers={'Accept': memdam.common.client.NDJSON_CONTENT_TYPE})
+        for line in response.iter_lines():
+            if line:
+                yield memdam.common.jsoncodec.decode_line(line)
+
+    def changes_since(self, cursor=None, limit=None):
+        params = {}
+        if cursor is not None:
+            params['cursor'] = json.dumps(cursor.to_json_dict())
+        if limit is not None:
+            params['limit'] = limit
+        response = self._client.request('GET', "/changes", params=params)
+        return [memdam.common.change.Change.from_json_dict(x) for x in response.json()]
 
     def delete(self, event_id):
         self._client.request('DELETE', "/events/" + event_id.hex)
@@ -0,0 +1,270 @@
+"""
+Decide which indices the tables of the sqlite Eventstore get.
+
+Every table always has an index on time__time and a unique index on id__id. Nothing else is indexed
+unless it is asked for, since every index makes every insert slower, and most fields are never
+queried at all. There are two ways to ask for more:
+
+- composite indices declared up front in the IndexPolicy, per namespace
+- the IndexAdvisor, which looks at the query plan of every distinct statement that is run, and when
+  the same kind of query keeps scanning a whole table, suggests (or builds) the index that would
+  have avoided it
+
+The advisor also counts how often each index is actually used, so that indices which are never used
+can be found and dropped.
+"""
+
+import re
+import threading
+import collections
+
+import memdam
+import memdam.common.field
+import memdam.common.event
+import memdam.common.validation
+import memdam.eventstore.compiler
+
+ADVISOR_MODES = ('suggest', 'build')
+#composite indices for this namespace apply to every namespace
+ALL_NAMESPACES = u'*'
+
+EQUALITY_OPERATORS = frozenset(('=', '=='))
+RANGE_OPERATORS = frozenset(('<', '<=', '>', '>=', 'like'))
+
+class IndexPolicy(memdam.Base):
+    """
+    Which indices to create, beyond the ones that every table has.
+
+    :attr advisor: None to only count index usage, 'suggest' to also log the indices that would
+    avoid repeated table scans, or 'build' to create them
+    :type advisor: string
+    :attr advisor_threshold: how many times the same kind of query has to scan a whole table before
+    the advisor does anything about it
+    :type advisor_threshold: int
+    """
+
+    DEFAULT_ADVISOR_THRESHOLD = 10
+
+    def __init__(self, composite=None, advisor=None, advisor_threshold=DEFAULT_ADVISOR_THRESHOLD):
+        """
+        :param composite: namespace (or ALL_NAMESPACES) -> the indices for that namespace, each of
+        which is a list of field names (eg, {u'com.memdam.cpu': [[u'host__string', u'time__time']]})
+        :type  composite: dict(unicode, list(list(unicode)))
+        """
+        assert advisor is None or advisor in ADVISOR_MODES, "Invalid index advisor mode: %s" % (advisor)
+        assert advisor_threshold > 0
+        self.advisor = advisor
+        self.advisor_threshold = advisor_threshold
+        self._composite = {}
+        for namespace, indices in (composite or {}).items():
+            self._composite[namespace] = [tuple(_validate_index_columns(columns)) for columns in indices]
+
+    def composite_indices(self, namespace):
+        """
+        :returns: the columns of every composite index that tables for this namespace should have
+        :rtype: list(tuple(string))
+        """
+        return self._composite.get(ALL_NAMESPACES, []) + self._composite.get(namespace, [])
+
+def index_name(table_name, columns):
+    """
+    :returns: the name of the index on these columns (in order) of the table, following the same
+    scheme as every other index ("table__name__type__asc")
+    :rtype: unicode
+    """
+    return table_name + u'__' + u'__'.join(columns) + u'__asc'
+
+@memdam.vtrace()
+def candidate_columns(filters, columns):
+    """
+    :param filters: the field filters of a query, all of which must be true
+    :type  filters: iterable(memdam.common.query.QueryFilter)
+    :param columns: the names of the columns that exist in the table
+    :type  columns: iterable(string)
+    :returns: the columns of the index that would help most with these filters: every column that
+    must equal a value, followed by one column that must be in a range of values. Empty if nothing
+    would help.
+    :rtype: tuple(string)
+    """
+    columns = set(columns)
+    equality_columns = set()
+    range_columns = set()
+    for query_filter in memdam.eventstore.compiler.required_filters(filters):
+        operator = query_filter.operator.lower()
+        column = _compared_column(query_filter, columns)
+        if column is None:
+            continue
+        if operator in EQUALITY_OPERATORS:
+            equality_columns.add(column)
+        elif operator in RANGE_OPERATORS:
+            range_columns.add(column)
+    range_columns -= equality_columns
+    candidate = sorted(equality_columns)
+    if len(range_columns) > 0:
+        candidate.append(sorted(range_columns)[0])
+    return tuple(candidate)
+
+class IndexAdvisor(memdam.Base):
+    """
+    Watches the statements that the Eventstore runs. The plan for each distinct statement is only
+    looked at once (statements always bind their values, so there are not many of them), and
+    remembered until the indices of its table change.
+
+    Usage counts only cover the statements run since the Eventstore was opened.
+    Safe to use from multiple threads.
+    """
+
+    DEFAULT_MAX_CACHED = 1024
+
+    def __init__(self, policy, max_cached=DEFAULT_MAX_CACHED):
+        """
+        :param policy: decides what to do about table scans
+        :type  policy: IndexPolicy
+        :param max_cached: the most query plans to remember (least recently used are forgotten)
+        :type  max_cached: int
+        """
+        self._policy = policy
+        self._max_cached = max_cached
+        self._lock = threading.Lock()
+        #(table name, sql) -> (names of the indices used, True iff the table is scanned)
+        self._plans = collections.OrderedDict()
+        #table name -> index name -> number of statements that used it
+        self._uses = collections.defaultdict(lambda: collections.defaultdict(int))
+        #(table name, candidate columns) -> number of statements that scanned the table
+        self._scans = collections.defaultdict(int)
+        #the (table name, candidate columns) that should be built the next time that is possible
+        self._pending = set()
+        #table name -> how many times its indices have changed
+        self._generations = collections.defaultdict(int)
+
+    def observe(self, cur, table_name, sql, args, filters, columns):
+        """
+        Call right after running a query against a table. Not before: explaining a statement doesn't
+        notice that the schema has changed (eg, an index was just created) but running one does.
+
+        :param cur: a cursor for the table (not the one with the query) to explain the query
+        :type  cur: sqlite3.Cursor
+        :param sql: the statement that was run
+        :type  sql: string
+        :param args: the parameters that were bound to it
+        :type  args: tuple
+        :param filters: the field filters that the statement was compiled from
+        :type  filters: list(memdam.common.query.QueryFilter)
+        :param columns: the names of the columns that exist in the table
+        :type  columns: iterable(string)
+        """
+        key = (table_name, sql)
+        with self._lock:
+            plan = self._plans.pop(key, None)
+            generation = self._generations[table_name]
+        if plan is None:
+            plan = _explain(cur, table_name, sql, args, generation)
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self._max_cached:
+                self._plans.popitem(last=False)
+            used_indices, scanned = plan
+            for name in used_indices:
+                self._uses[table_name][name] += 1
+        if not scanned:
+            return
+        candidate = candidate_columns(filters, columns)
+        if len(candidate) <= 0:
+            return
+        with self._lock:
+            scan_key = (table_name, candidate)
+            self._scans[scan_key] += 1
+            if self._scans[scan_key] != self._policy.advisor_threshold:
+                return
+            if self._policy.advisor == 'build':
+                self._pending.add(scan_key)
+        if self._policy.advisor is not None:
+            memdam.log().info("Queries keep scanning all of %s, an index on (%s) would help" % (table_name, ", ".join(candidate)))
+
+    def suggestions(self):
+        """
+        :returns: every index that would have avoided at least advisor_threshold table scans, with
+        the number of scans
+        :rtype: list(tuple(unicode, tuple(string), int))
+        """
+        with self._lock:
+            return sorted((table_name, columns, count) for (table_name, columns), count in self._scans.items() \
+                          if count >= self._policy.advisor_threshold)
+
+    def take_pending(self):
+        """
+        :returns: the (table name, columns) of every index that should be built now, and forgets them
+        :rtype: list(tuple(unicode, tuple(string)))
+        """
+        with self._lock:
+            pending = sorted(self._pending)
+            self._pending.clear()
+        return pending
+
+    def uses(self, table_name):
+        """
+        :returns: index name -> the number of statements that used it
+        :rtype: dict(string, int)
+        """
+        with self._lock:
+            return dict(self._uses.get(table_name, {}))
+
+    def forget(self, table_name):
+        """
+        Call whenever the indices of a table change (or it is removed), since plans may change too
+        """
+        with self._lock:
+            self._generations[table_name] += 1
+            for key in [key for key in self._plans if key[0] == table_name]:
+                del self._plans[key]
+            for key in [key for key in self._scans if key[0] == table_name]:
+                del self._scans[key]
+
+def _validate_index_columns(columns):
+    """
+    :returns: the columns, if they are all fields that can be indexed
+    :raises: AssertionError otherwise, since they end up in the sql
+    """
+    assert len(columns) > 0, "Indices must have at least one column"
+    for column in columns:
+        assert memdam.common.validation.EVENT_FIELD_REGEX.match(column), "Invalid field: %s" % (column)
+        assert memdam.common.event.Event.field_type(column) != memdam.common.field.FieldType.TEXT, "TEXT fields are searched, not indexed: %s" % (column)
+    return columns
+
+def _compared_column(query_filter, columns):
+    """
+    :returns: the column that is compared to a value by this filter, or None
+    :rtype: string
+    """
+    lhs_is_column = isinstance(query_filter.lhs, basestring) and query_filter.lhs in columns
+    rhs_is_column = isinstance(query_filter.rhs, basestring) and query_filter.rhs in columns
+    if lhs_is_column and not rhs_is_column:
+        return query_filter.lhs
+    if rhs_is_column and not lhs_is_column:
+        return query_filter.rhs
+    return None
+
+USING_INDEX_REGEX = re.compile(r"USING (?:COVERING )?INDEX (\w+)")
+
+@memdam.vtrace()
+def _explain(cur, table_name, sql, args, generation):
+    """
+    :param generation: changes whenever the indices of the table change. sqlite3 caches prepared
+    statements by their sql, and a cached EXPLAIN never notices that the schema has changed, so this
+    is part of the sql to make sure that the plan is always prepared again.
+    :type  generation: int
+    :returns: the names of the indices that the statement uses, and True iff it scans the whole table
+    :rtype: tuple(frozenset(string), bool)
+    """
+    cur.execute("EXPLAIN QUERY PLAN /* %d */ %s" % (generation, sql), args)
+    scan_regex = re.compile(r"^SCAN (TABLE )?%s(\s|$)" % (re.escape(table_name)))
+    used_indices = set()
+    scanned = False
+    for row in cur.fetchall():
+        detail = row[-1]
+        match = USING_INDEX_REGEX.search(detail)
+        if match is not None:
+            used_indices.add(match.group(1))
+        elif scan_regex.match(detail):
+            scanned = True
+    return frozenset(used_indices), scanned
@@ -0,0 +1,251 @@
+"""
+Import and export events as newline-delimited JSON (one Event.to_json_dict per line), for
+migrations, backups, and seeding benchmarks. Files ending in .gz are compressed, and - means stdin or
+stdout.
+
+Only the events are copied: FILE fields are exported as references, and the blobs that they refer
+to have to be copied separately.
+
+Run as a script, eg:
+
+    python -m memdam.eventstore.jsonl export --db ~/events --namespace com.memdam.cpu backup.jsonl.gz
+    python -m memdam.eventstore.jsonl import --db /tmp/copy --bulk restore backup.jsonl.gz
+"""
+
+import sys
+import gzip
+import time
+import argparse
+
+import dateutil.parser
+
+import memdam
+import memdam.common.jsoncodec
+import memdam.common.query
+import memdam.common.client
+import memdam.eventstore.sqlite
+import memdam.eventstore.https
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_PROGRESS_INTERVAL = 10000
+GZIP_EXTENSION = '.gz'
+STANDARD_STREAM = '-'
+
+@memdam.vtrace()
+def make_query(namespaces=None, start=None, end=None):
+    """
+    :param namespaces: only select events from these namespaces (all of them if None or empty)
+    :type  namespaces: list(unicode)
+    :param start: only select events at or after this time
+    :type  start: datetime.datetime
+    :param end: only select events before this time
+    :type  end: datetime.datetime
+    :returns: a query for the selected events, in order of time
+    :rtype: memdam.common.query.Query
+    """
+    filters = []
+    for namespace in namespaces or ():
+        filters.append(memdam.common.query.QueryFilter(u'namespace__namespace', u'=', namespace))
+    #times as stored, so that the query can be sent to a server as JSON
+    if start is not None:
+        filters.append(memdam.common.query.QueryFilter(u'time__time', u'>=', memdam.eventstore.sqlite.convert_time_to_long(start)))
+    if end is not None:
+        filters.append(memdam.common.query.QueryFilter(u'time__time', u'<', memdam.eventstore.sqlite.convert_time_to_long(end)))
+    return memdam.common.query.Query(filters=filters, order=[(u'time__time', True)])
+
+def export_events(eventstore, output, query, progress=None, progress_interval=DEFAULT_PROGRESS_INTERVAL):
+    """
+    Write every event that matches the query to output, one per line. Events are streamed, so this
+    never holds more than a page of them in memory.
+
+    :param eventstore: where to read the events from
+    :type  eventstore: memdam.eventstore.api.Eventstore
+    :param output: where to write them
+    :type  output: file
+    :param query: which events to export (see make_query)
+    :type  query: memdam.common.query.Query
+    :param progress: if not None, called with the number of events so far, every progress_interval
+    events and at the end
+    :type  progress: function(int)
+    :returns: the number of events that were exported
+    :rtype: int
+    """
+    count = 0
+    for event in eventstore.find_iter(query):
+        output.write(memdam.common.jsoncodec.encode_line(event, sort_keys=True))
+        count += 1
+        if progress is not None and count % progress_interval == 0:
+            progress(count)
+    if progress is not None:
+        progress(count)
+    return count
+
+def import_events(eventstore, lines, namespaces=None, start=None, end=None, batch_size=DEFAULT_BATCH_SIZE,
+                  progress=None, progress_interval=DEFAULT_PROGRESS_INTERVAL, bulk_load=None):
+    """
+    Save the events from every line (that is selected by namespaces, start and end, see make_query),
+    batch_size events at a time. Saving is idempotent, so importing the same lines again is harmless.
+
+    :param eventstore: where to save the events
+    :type  eventstore: memdam.eventstore.api.Eventstore
+    :param lines: the events as JSON, one per line. Blank lines are skipped.
+    :type  lines: iterable(string)
+    :param progress: see export_events (counts every line read, whether or not it was selected)
+    :type  progress: function(int)
+    :param bulk_load: if not None, the name of the bulk load (see memdam.eventstore.sqlite.BulkLoad)
+    to save the events with. The line number is the checkpoint, so running the same import again
+    resumes where it left off, and the bulk load is finished at the end.
+    :type  bulk_load: unicode
+    :returns: the number of events that were saved
+    :rtype: int
+    """
+    namespaces = set(namespaces or ())
+    session = None
+    skip = 0
+    if bulk_load is not None:
+        session = eventstore.bulk_load(bulk_load, batch_size=batch_size)
+        if session.checkpoint is not None:
+            skip = session.checkpoint
+    line_number = 0
+    count = 0
+    batch = []
+    for line in lines:
+        line_number += 1
+        if line_number <= skip or not line.strip():
+            continue
+        event = memdam.common.jsoncodec.decode_line(line)
+        if _is_selected(event, namespaces, start, end):
+            batch.append(event)
+        if len(batch) >= batch_size:
+            _save(eventstore, session, batch, line_number)
+            count += len(batch)
+            batch = []
+        if progress is not None and line_number % progress_interval == 0:
+            progress(line_number)
+    _save(eventstore, session, batch, line_number)
+    count += len(batch)
+    if session is not None:
+        session.finish()
+    if progress is not None:
+        progress(line_number)
+    return count
+
+def open_file(path, mode):
+    """
+    :param path: the file to open, or - for stdin or stdout
+    :type  path: string
+    :param mode: 'r' or 'w'
+    :type  mode: string
+    :returns: the file, decompressing or compressing it if it ends in .gz
+    :rtype: file
+    """
+    assert mode in ('r', 'w')
+    if path == STANDARD_STREAM:
+        if mode == 'r':
+            return sys.stdin
+        return sys.stdout
+    if path.endswith(GZIP_EXTENSION):
+        return gzip.open(path, mode + 'b')
+    return open(path, mode + 'b')
+
+def _is_selected(event, namespaces, start, end):
+    """:returns: True iff the event is in one of the namespaces (if any), and between start and end"""
+    if len(namespaces) > 0 and event.namespace not in namespaces:
+        return False
+    if start is not None and event.time__time < start:
+        return False
+    if end is not None and event.time__time >= end:
+        return False
+    return True
+
+def _save(eventstore, session, events, line_number):
+    """Save one batch of events, either directly or as part of a bulk load"""
+    if session is None:
+        if len(events) > 0:
+            eventstore.save(events)
+    else:
+        session.save(events, checkpoint=line_number)
+
+def _open_eventstore(args):
+    """
+    :returns: the Eventstore that the commandline arguments refer to
+    :rtype: memdam.eventstore.api.Eventstore
+    """
+    if args.db is not None:
+        return memdam.eventstore.sqlite.Eventstore(args.db, partition=args.partition)
+    assert args.server is not None, "Either --db or --server is required"
+    client = memdam.common.client.MemdamClient(args.server, args.username, args.password)
+    return memdam.eventstore.https.Eventstore(client)
+
+def _make_progress(verb):
+    """:returns: a progress function that logs how many events have been processed, and how quickly"""
+    started = time.time()
+    def progress(count):
+        elapsed = max(time.time() - started, 0.001)
+        sys.stderr.write("%s %s events (%.0f/s)\n" % (verb, count, count / elapsed))
+    return progress
+
+def _parse_time(value):
+    """:returns: the time from the commandline (which must include a timezone)"""
+    parsed = dateutil.parser.parse(value)
+    assert parsed.tzinfo is not None, "Times must include a timezone: %s" % (value)
+    return parsed
+
+def read_commandline_args(argv):
+    '''
+    :returns: the parsed commandline arguments
+    :rtype: argparse.Namespace
+    '''
+    parser = argparse.ArgumentParser(description='Import or export events as newline-delimited JSON.')
+    parser.add_argument('command', choices=('import', 'export'),
+                        help='whether to read events from the file into the eventstore, or the reverse')
+    parser.add_argument('file', type=str,
+                        help='the file to read or write (- for stdin or stdout). Compressed if it ends in .gz')
+    parser.add_argument('--db', dest='db', type=str,
+                        help='the folder of a local sqlite eventstore')
+    parser.add_argument('--partition', dest='partition', type=str, choices=('year', 'month', 'day'),
+                        help='how the local eventstore is partitioned, if it is')
+    parser.add_argument('--server', dest='server', type=str,
+                        help='the url of a memdam server, instead of a local eventstore')
+    parser.add_argument('--username', dest='username', type=str)
+    parser.add_argument('--password', dest='password', type=str)
+    parser.add_argument('--namespace', dest='namespaces', type=unicode, action='append',
+                        help='only include events from this namespace (may be repeated)')
+    parser.add_argument('--start', dest='start', type=_parse_time,
+                        help='only include events at or after this time (ISO 8601, with a timezone)')
+    parser.add_argument('--end', dest='end', type=_parse_time,
+                        help='only include events before this time (ISO 8601, with a timezone)')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='how many events to save at once')
+    parser.add_argument('--bulk', dest='bulk', type=unicode,
+                        help='import with a resumable bulk load of this name (local eventstores only)')
+    return parser.parse_args(argv)
+
+def run_as_script(argv=None):
+    '''Import or export, based on the commandline arguments'''
+    if argv is None:
+        argv = sys.argv[1:]
+    args = read_commandline_args(argv)
+    eventstore = _open_eventstore(args)
+    try:
+        if args.command == 'export':
+            output = open_file(args.file, 'w')
+            try:
+                query = make_query(args.namespaces, args.start, args.end)
+                export_events(eventstore, output, query, progress=_make_progress("Exported"))
+            finally:
+                if output is not sys.stdout:
+                    output.close()
+        else:
+            lines = open_file(args.file, 'r')
+            try:
+                import_events(eventstore, lines, args.namespaces, args.start, args.end, batch_size=args.batch_size,
+                              progress=_make_progress("Read"), bulk_load=args.bulk)
+            finally:
+                if lines is not sys.stdin:
+                    lines.close()
+    finally:
+        eventstore.close()
+
+if __name__ == '__main__':
+    run_as_script()
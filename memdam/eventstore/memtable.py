@@ -0,0 +1,335 @@
+"""
+Buffer recently saved events in memory, and write them to another Eventstore in large batches.
+"""
+
+import os
+import re
+import json
+import uuid
+import threading
+
+import memdam
+import memdam.common.jsoncodec
+import memdam.common.query
+import memdam.eventstore.api
+import memdam.eventstore.sqlite
+import memdam.eventstore.merge
+
+LOG_FILE_PATTERN = re.compile(r'^memtable\.(\d+)\.log$')
+
+class Eventstore(memdam.eventstore.api.Eventstore):
+    """
+    Wraps another Eventstore (eg, the recorder's local sqlite Eventstore) so that recently saved events
+    are kept in a memtable, and only written to it in large batches.
+
+    A memtable is an in-memory sqlite Eventstore (so that its events are sorted by time, and queries
+    mean exactly the same thing as they do for the wrapped Eventstore), plus an append-only log file.
+    Every save is appended to the log (and fsync'd) before it returns, which is much cheaper than
+    committing a sqlite transaction. A background thread flushes the memtable every flush_interval
+    seconds, or as soon as it holds max_events events: the memtable is swapped for an empty one (with
+    a new log), all of its events are saved to the wrapped Eventstore at once, and then its log is
+    removed. If the process dies before that, the logs are replayed and flushed the next time this
+    is opened.
+
+    get, get_many, find, find_iter and delete see the events in the memtables as well as the ones in
+    the wrapped Eventstore, and events in a memtable hide older versions of themselves. Events that
+    are deleted before they are flushed (eg, because they were synchronized quickly) are never written
+    to the wrapped Eventstore at all. Deleting still asks the wrapped Eventstore to delete the event, in
+    case an older version of it was flushed, but for sqlite that is just a lookup in the id index.
+
+    search, aggregate and changes_since flush the memtable first and then just ask the wrapped
+    Eventstore, since their results can't be merged exactly.
+    """
+
+    DEFAULT_FLUSH_INTERVAL = 30.0
+    DEFAULT_MAX_EVENTS = 10000
+
+    def __init__(self, eventstore, log_folder, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 max_events=DEFAULT_MAX_EVENTS, fsync=True):
+        """
+        :param eventstore: where the events are eventually saved
+        :type  eventstore: memdam.eventstore.api.Eventstore
+        :param log_folder: where to keep the logs of the events in the memtables. Any logs that are
+        already there are replayed and flushed before this returns.
+        :type  log_folder: string
+        :param flush_interval: the most seconds that events are kept in memory
+        :type  flush_interval: float
+        :param max_events: memtables with at least this many events are flushed without waiting
+        :type  max_events: int
+        :param fsync: whether to fsync the log after every save. If False, events may be lost if the
+        machine (rather than just the process) crashes.
+        :type  fsync: bool
+        """
+        assert flush_interval > 0
+        assert max_events > 0
+        self._eventstore = eventstore
+        self._log_folder = log_folder
+        self._flush_interval = flush_interval
+        self._max_events = max_events
+        self._fsync = fsync
+        if not os.path.exists(log_folder):
+            os.makedirs(log_folder)
+        #guards the memtables themselves
+        self._lock = threading.RLock()
+        #held while flushing, so that deletes can't miss events that are on their way to the wrapped Eventstore
+        self._flush_lock = threading.Lock()
+        self._next_log_number = self._replay_logs()
+        self._flushing = None
+        self._active = self._new_memtable()
+        self._full = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(name="memtable-flusher", target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, events):
+        events = list(events)
+        if len(events) <= 0:
+            return
+        with self._lock:
+            self._active.save(events)
+            is_full = len(self._active.ids) >= self._max_events
+        if is_full:
+            self._full.set()
+
+    def get(self, event_id):
+        return self.get_many([event_id])[0]
+
+    def get_many(self, event_ids):
+        event_ids = list(event_ids)
+        found = {}
+        for memtable in self._memtables():
+            ids = [event_id for event_id in event_ids if event_id in memtable.ids and event_id not in found]
+            if len(ids) > 0:
+                for event in memtable.store.get_many(ids):
+                    found[event.id__id] = event
+        missing = [event_id for event_id in event_ids if event_id not in found]
+        if len(missing) > 0:
+            for event in self._eventstore.get_many(missing):
+                found[event.id__id] = event
+        return [found[event_id] for event_id in event_ids]
+
+    def find(self, query):
+        return list(self.find_iter(query))
+
+    def find_iter(self, query):
+        """
+        Newer sources hide any older versions of their events, so each source is asked for enough
+        extra events to make up for the ones that might be hidden.
+        """
+        sources = []
+        hidden = frozenset()
+        with self._lock:
+            memtables = [(memtable, frozenset(memtable.ids)) for memtable in self._memtables()]
+        for memtable, ids in memtables:
+            sources.append(_without(memtable.store.find(_extend_limit(query, len(hidden))), hidden))
+            hidden = hidden | ids
+        sources.append(_without(self._eventstore.find_iter(_extend_limit(query, len(hidden))), hidden))
+        sort_key = None
+        if query.order:
+            sort_key = memdam.eventstore.sqlite.make_sort_key(query.order)
+        for event in memdam.eventstore.merge.merge_sorted(sources, key=sort_key, limit=query.limit):
+            yield event
+
+    def search(self, query):
+        self.flush()
+        return self._eventstore.search(query)
+
+    def aggregate(self, query):
+        self.flush()
+        return self._eventstore.aggregate(query)
+
+    def changes_since(self, cursor=None, limit=None):
+        self.flush()
+        return self._eventstore.changes_since(cursor, limit)
+
+    def delete(self, event_id):
+        with self._flush_lock:
+            with self._lock:
+                for memtable in self._memtables():
+                    memtable.delete(event_id)
+            self._eventstore.delete(event_id)
+
+    def flush(self):
+        """
+        Save every event in the memtable to the wrapped Eventstore now, instead of waiting for the
+        background thread. If a previous flush failed, its events are saved first.
+        """
+        with self._flush_lock:
+            with self._lock:
+                if self._flushing is None:
+                    if len(self._active.ids) <= 0:
+                        return
+                    self._flushing = self._active
+                    self._active = self._new_memtable()
+                memtable = self._flushing
+            events = memtable.store.find(memdam.common.query.Query())
+            memdam.log().debug("Flushing %s events from the memtable" % (len(events)))
+            if len(events) > 0:
+                self._eventstore.save(events)
+            with self._lock:
+                self._flushing = None
+            memtable.remove()
+
+    def close(self):
+        """
+        Stop the background thread, flush the memtable, and close the wrapped Eventstore
+        """
+        self._stopped.set()
+        self._full.set()
+        self._thread.join()
+        self.flush()
+        self._active.remove()
+        self._eventstore.close()
+
+    def _memtables(self):
+        """
+        :returns: the memtables that might contain events that are not in the wrapped Eventstore,
+        newest first
+        :rtype: list(_Memtable)
+        """
+        with self._lock:
+            return [memtable for memtable in (self._active, self._flushing) if memtable is not None]
+
+    def _new_memtable(self):
+        """
+        :returns: an empty memtable with a new log
+        :rtype: _Memtable
+        """
+        path = os.path.join(self._log_folder, "memtable.%s.log" % (self._next_log_number))
+        self._next_log_number += 1
+        return _Memtable(path, self._fsync)
+
+    def _run(self):
+        """
+        Flush every flush_interval seconds (or whenever the memtable is full) until stopped
+        """
+        while not self._stopped.is_set():
+            self._full.wait(self._flush_interval)
+            self._full.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.flush()
+            except Exception, e:
+                memdam.log().warn("Failed to flush the memtable, will retry: %s" % (e))
+
+    def _replay_logs(self):
+        """
+        Save the events from any logs that were left behind (because the process died before they
+        were flushed) to the wrapped Eventstore, then remove the logs.
+
+        :returns: the number for the next log
+        :rtype: int
+        """
+        numbers = []
+        for name in os.listdir(self._log_folder):
+            match = LOG_FILE_PATTERN.match(name)
+            if match:
+                numbers.append(int(match.group(1)))
+        for number in sorted(numbers):
+            path = os.path.join(self._log_folder, "memtable.%s.log" % (number))
+            store = memdam.eventstore.sqlite.Eventstore(":memory:")
+            for record in _read_log(path):
+                if u'save' in record:
+                    store.save([memdam.common.jsoncodec.decode_event(record[u'save'])])
+                else:
+                    store.delete(uuid.UUID(record[u'delete']))
+            events = store.find(memdam.common.query.Query())
+            memdam.log().info("Replaying %s events from %s" % (len(events), path))
+            if len(events) > 0:
+                self._eventstore.save(events)
+            store.close()
+            os.remove(path)
+        if len(numbers) <= 0:
+            return 0
+        return max(numbers) + 1
+
+class _Memtable(object):
+    """
+    Recently saved events, and the log that they can be recovered from.
+
+    The store is never closed, so anyone still reading from a memtable after it was flushed just sees
+    the events that it had.
+
+    :attr store: the events
+    :type store: memdam.eventstore.sqlite.Eventstore
+    :attr ids: the id of every event in the store
+    :type ids: set(uuid.UUID)
+    :attr log_path: the file that every change is appended to
+    :type log_path: string
+    """
+
+    def __init__(self, log_path, fsync):
+        self.store = memdam.eventstore.sqlite.Eventstore(":memory:")
+        self.ids = set()
+        self.log_path = log_path
+        self._fsync = fsync
+        self._log = open(log_path, 'ab')
+
+    def save(self, events):
+        """
+        Must hold the lock, so that the log is in the same order as the changes.
+        """
+        self._append([{u'save': memdam.common.jsoncodec.encode_event(event)} for event in events])
+        self.store.save(events)
+        self.ids.update(event.id__id for event in events)
+
+    def delete(self, event_id):
+        """
+        Must hold the lock.
+        Does nothing if the event is not in this memtable.
+        """
+        if event_id not in self.ids:
+            return
+        self._append([{u'delete': event_id.hex}])
+        self.store.delete(event_id)
+        self.ids.discard(event_id)
+
+    def remove(self):
+        """
+        Close and remove the log. Only call this once the events are safe somewhere else.
+        """
+        self._log.close()
+        os.remove(self.log_path)
+
+    def _append(self, records):
+        """
+        Write the records to the log, and make sure that they are durable
+        """
+        for record in records:
+            self._log.write(json.dumps(record))
+            self._log.write('\n')
+        self._log.flush()
+        if self._fsync:
+            os.fsync(self._log.fileno())
+
+def _read_log(path):
+    """
+    :returns: every record in the log. The last line is ignored if it is incomplete (because the
+    process died while writing it, so that save never returned).
+    :rtype: generator(dict)
+    """
+    with open(path, 'rb') as infile:
+        for line in infile:
+            if not line.endswith('\n'):
+                break
+            yield json.loads(line)
+
+def _without(events, hidden):
+    """
+    :returns: the events, except for the ones whose ids are in hidden
+    :rtype: generator(memdam.common.event.Event)
+    """
+    for event in events:
+        if event.id__id not in hidden:
+            yield event
+
+def _extend_limit(query, extra):
+    """
+    :returns: the same query, but with room for extra more events (if it has a limit)
+    :rtype: memdam.common.query.Query
+    """
+    if not query.limit or extra <= 0:
+        return query
+    return memdam.common.query.Query(filters=query.filters, order=query.order, limit=query.limit + extra)
@@ -0,0 +1,82 @@
+"""
+Combine the results from several sources (eg, one per table) into a single stream of events.
+"""
+
+import heapq
+import itertools
+
+def merge_sorted(iterables, key=None, limit=None):
+    """
+    Lazily merge a bunch of iterables that are each already sorted into one sorted stream.
+    Only pulls as many items from each iterable as are needed to produce the output.
+
+    :param iterables: each one must already be sorted by key
+    :type  iterables: list(iterable)
+    :param key: function(item) -> comparable. If None, the iterables are simply concatenated
+    :type  key: function
+    :param limit: the most items to produce in total (across all iterables). None for no limit.
+    :type  limit: int
+    :returns: all items from all iterables, in order
+    :rtype: generator
+    """
+    if key is None:
+        merged = itertools.chain.from_iterable(iterables)
+    else:
+        merged = _merge_with_key(iterables, key)
+    if limit:
+        merged = itertools.islice(merged, limit)
+    for item in merged:
+        yield item
+
+def _merge_with_key(iterables, key):
+    """
+    heapq.merge doesn't take a key until python 3.5, so this is the same thing with a key.
+    The index breaks ties, so that items themselves are never compared, and so that the merge is
+    stable.
+    """
+    heap = []
+    for index, iterable in enumerate(iterables):
+        iterator = iter(iterable)
+        for item in iterator:
+            heap.append((key(item), index, item, iterator))
+            break
+    heapq.heapify(heap)
+    while heap:
+        _, index, item, iterator = heap[0]
+        yield item
+        for next_item in iterator:
+            heapq.heapreplace(heap, (key(next_item), index, next_item, iterator))
+            break
+        else:
+            heapq.heappop(heap)
+
+class Descending(object):
+    """
+    Wraps a value so that it sorts in the reverse order. Use in sort keys for descending columns.
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __gt__(self, other):
+        return other.value > self.value
+
+    def __le__(self, other):
+        return other.value <= self.value
+
+    def __ge__(self, other):
+        return other.value >= self.value
+
+    def __repr__(self):
+        return "Descending(%r)" % (self.value,)
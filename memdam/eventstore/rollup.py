@@ -0,0 +1,309 @@
+"""
+Summary tables for the sqlite Eventstore, so that aggregates over long periods of time don't have to
+read every event.
+
+Every table gets one rollup table per grain (<table>__rollup__minute, __hour and __day) in the same
+file, with one row per (bucket, field): the number of events (field *), and the count, min, max and
+sum of every NUMBER and LONG field. They are updated in the same transaction as the events
+themselves: new events are simply added in, and any bucket that loses (or replaces) an event is
+recalculated from the events that are left, since min and max can't be undone.
+
+Bucket numbers are time__time (as stored) divided by the grain, rounded towards zero just like
+sqlite integer division.
+
+Events that have been sealed (see memdam.eventstore.segment) are no longer in the table, so whenever
+rollups are calculated from the table, the sealed events are passed in as well: sealed is a
+function(start, end) -> lists of the sealed events between those times (as stored, None for no
+bound), or None if the table has no segments.
+"""
+
+import collections
+
+import memdam
+import memdam.common.field
+import memdam.common.event
+import memdam.eventstore.compiler
+import memdam.eventstore.sqlite
+
+#in seconds, coarsest first
+GRAINS = collections.OrderedDict((
+    ('day', 24 * 60 * 60),
+    ('hour', 60 * 60),
+    ('minute', 60),
+))
+ROLLUP_SEPARATOR = u'__rollup__'
+#the field name of the rows that count events
+EVENT_COUNT_FIELD = u'*'
+FIELD_TYPES = (memdam.common.field.FieldType.NUMBER, memdam.common.field.FieldType.LONG)
+TIME_OPERATORS = frozenset(('<', '<=', '>', '>=', '=', '=='))
+
+def rollup_table_name(table_name, grain):
+    """
+    :returns: the name of the rollup table for this table and grain
+    :rtype: unicode
+    """
+    return table_name + ROLLUP_SEPARATOR + grain
+
+def is_rollup_table(table_name):
+    """
+    :returns: True iff this is a rollup table rather than a table of events
+    :rtype: bool
+    """
+    return ROLLUP_SEPARATOR in table_name
+
+def rollup_field_names(columns):
+    """
+    :param columns: the names of the columns in the table
+    :type  columns: iterable(string)
+    :returns: the names of the fields that are summarized
+    :rtype: list(string)
+    """
+    return [name for name in columns if memdam.common.event.Event.field_type(name) in FIELD_TYPES]
+
+@memdam.vtrace()
+def exists(cur, table_name):
+    """
+    :returns: True iff the rollup tables for this table have been created (they are always created
+    together)
+    :rtype: bool
+    """
+    sql = "SELECT name FROM sqlite_master WHERE type='table' AND name = ?;"
+    cur.execute(sql, (rollup_table_name(table_name, GRAINS.keys()[0]),))
+    return len(cur.fetchall()) > 0
+
+@memdam.vtrace()
+def create(cur, table_name, columns, sealed=None):
+    """
+    Create the rollup tables, and fill them in from the events that are already in the table.
+    Must be called inside of a write transaction.
+
+    :param columns: the names of the columns in the table
+    :type  columns: iterable(string)
+    """
+    for grain in GRAINS:
+        cur.execute("CREATE TABLE %s(bucket INTEGER NOT NULL, field TEXT NOT NULL, count INTEGER NOT NULL, min, max, sum, "
+                    "PRIMARY KEY (bucket, field));" % (rollup_table_name(table_name, grain)))
+    _fill(cur, table_name, columns, sealed)
+
+@memdam.vtrace()
+def rebuild(cur, table_name, columns, sealed=None):
+    """
+    Throw away the rollups and calculate them again from all of the events (eg, after a bulk load,
+    which doesn't keep them up to date). Must be called inside of a write transaction.
+
+    :param columns: the names of the columns in the table
+    :type  columns: iterable(string)
+    """
+    for grain in GRAINS:
+        cur.execute("DELETE FROM %s;" % (rollup_table_name(table_name, grain)))
+    _fill(cur, table_name, columns, sealed)
+
+def _fill(cur, table_name, columns, sealed):
+    """
+    Calculate every bucket of the (empty) rollups from the events
+    """
+    fields = rollup_field_names(columns)
+    for grain, seconds in GRAINS.items():
+        rollup_table = rollup_table_name(table_name, grain)
+        grain_long = _seconds_to_long(seconds)
+        cur.execute("INSERT INTO %s SELECT time__time / ?, ?, COUNT(*), NULL, NULL, 0 FROM %s GROUP BY 1;" % \
+                    (rollup_table, table_name), (grain_long, EVENT_COUNT_FIELD))
+        for field in fields:
+            cur.execute("INSERT INTO %s SELECT time__time / ?, ?, COUNT(%s), MIN(%s), MAX(%s), SUM(%s) FROM %s WHERE %s IS NOT NULL GROUP BY 1;" % \
+                        (rollup_table, field, field, field, field, table_name, field), (grain_long, field))
+    if sealed is not None:
+        for events in sealed(None, None):
+            add(cur, table_name, events)
+
+@memdam.vtrace()
+def add(cur, table_name, events):
+    """
+    Add new events to the rollups. Must be called in the same transaction that inserts them.
+
+    :param events: events that were not in the table before
+    :type  events: list(memdam.common.event.Event)
+    """
+    for grain, seconds in GRAINS.items():
+        grain_long = _seconds_to_long(seconds)
+        #(bucket, field) -> [count, min, max, sum]
+        deltas = {}
+        for event in events:
+            bucket = _bucket(memdam.eventstore.sqlite.convert_time_to_long(event.time__time), grain_long)
+            _add_value(deltas, bucket, EVENT_COUNT_FIELD, None)
+            for field in event.keys:
+                if memdam.common.event.Event.field_type(field) in FIELD_TYPES:
+                    value = getattr(event, field)
+                    if value is not None:
+                        _add_value(deltas, bucket, field, value)
+        rollup_table = rollup_table_name(table_name, grain)
+        keys = [(bucket, field) for bucket, field in deltas]
+        cur.executemany("INSERT OR IGNORE INTO %s (bucket, field, count, min, max, sum) VALUES (?, ?, 0, NULL, NULL, 0);" % (rollup_table), keys)
+        sql = "UPDATE %s SET count = count + ?, min = COALESCE(MIN(min, ?), ?), max = COALESCE(MAX(max, ?), ?), " \
+              "sum = sum + ? WHERE bucket = ? AND field = ?;" % (rollup_table)
+        values = []
+        for (bucket, field), (count, low, high, total) in deltas.items():
+            values.append((count, low, low, high, high, total, bucket, field))
+        cur.executemany(sql, values)
+
+@memdam.vtrace()
+def recompute(cur, table_name, columns, times, sealed=None):
+    """
+    Recalculate every bucket that contains any of these times from the events in the table. Must be
+    called in the same transaction that removes or replaces the events.
+
+    :param columns: the names of the columns in the table
+    :type  columns: iterable(string)
+    :param times: the times (as stored) of every event that was removed or replaced
+    :type  times: iterable(long)
+    """
+    fields = rollup_field_names(columns)
+    expressions = ["COUNT(*)"]
+    for field in fields:
+        expressions.append("COUNT(%s), MIN(%s), MAX(%s), SUM(%s)" % (field, field, field, field))
+    select_sql = "SELECT %s FROM %s WHERE time__time >= ? AND time__time < ?;" % (", ".join(expressions), table_name)
+    for grain, seconds in GRAINS.items():
+        grain_long = _seconds_to_long(seconds)
+        rollup_table = rollup_table_name(table_name, grain)
+        for bucket in set(_bucket(time, grain_long) for time in times):
+            cur.execute("DELETE FROM %s WHERE bucket = ?;" % (rollup_table), (bucket,))
+            start, end = _bucket_range(bucket, grain_long)
+            cur.execute(select_sql, (start, end))
+            row = cur.fetchone()
+            #(bucket, field) -> [count, min, max, sum], just like in add
+            stats = {}
+            if row[0] > 0:
+                stats[(bucket, EVENT_COUNT_FIELD)] = [row[0], None, None, 0]
+            for i in range(0, len(fields)):
+                count, low, high, total = row[1 + 4*i:5 + 4*i]
+                if count > 0:
+                    stats[(bucket, fields[i])] = [count, low, high, total]
+            if sealed is not None:
+                for events in sealed(start, end):
+                    for event in events:
+                        _add_value(stats, bucket, EVENT_COUNT_FIELD, None)
+                        for field in fields:
+                            value = getattr(event, field, None)
+                            if value is not None:
+                                _add_value(stats, bucket, field, value)
+            rows = [(bucket, field, count, low, high, total) for (bucket, field), (count, low, high, total) in stats.items()]
+            cur.executemany("INSERT INTO %s (bucket, field, count, min, max, sum) VALUES (?, ?, ?, ?, ?, ?);" % (rollup_table), rows)
+
+@memdam.vtrace()
+def choose_grain(query, field_filters):
+    """
+    :param query: the query that is about to be evaluated
+    :type  query: memdam.common.query.AggregateQuery
+    :param field_filters: the filters from the query, without any namespace filters
+    :type  field_filters: list(memdam.common.query.QueryFilter)
+    :returns: the coarsest grain whose rollups give exactly the same answer as the events, or None if
+    the events have to be read. The only filters allowed are time bounds that line up with the grain.
+    :rtype: string
+    """
+    if query.group_by is not None and query.group_by not in memdam.eventstore.compiler.NAMESPACE_FIELDS:
+        return None
+    for _, field in query.aggregates:
+        if field is not None and memdam.common.event.Event.field_type(field) not in FIELD_TYPES:
+            return None
+    for query_filter in field_filters:
+        if query_filter.operator.lower() not in TIME_OPERATORS:
+            return None
+        if memdam.eventstore.compiler.time_bounds((query_filter,)) == (None, None):
+            return None
+    lower, upper = memdam.eventstore.compiler.time_bounds(field_filters)
+    for grain, seconds in GRAINS.items():
+        grain_long = _seconds_to_long(seconds)
+        if query.bucket is not None and query.bucket % seconds != 0:
+            continue
+        if (lower is None or lower % grain_long == 0) and (upper is None or upper % grain_long == 0):
+            return grain
+    return None
+
+@memdam.vtrace()
+def aggregate(cur, table_name, namespace, query, field_filters, grain, accumulator):
+    """
+    Calculate the partial results for the query from the rollups, and add them to the accumulator.
+    Only valid if choose_grain returned this grain.
+    """
+    seconds = GRAINS[grain]
+    grain_long = _seconds_to_long(seconds)
+    fields = set(field for _, field in query.aggregates if field is not None)
+    fields.add(EVENT_COUNT_FIELD)
+    fields = list(fields)
+    args = ()
+    if query.bucket is None:
+        bucket_sql = "NULL"
+    else:
+        bucket_sql = "bucket / ?"
+        args = args + (long(query.bucket / seconds),)
+    sql = "SELECT %s, field, SUM(count), MIN(min), MAX(max), SUM(sum) FROM %s WHERE field IN (%s)" % \
+          (bucket_sql, rollup_table_name(table_name, grain), ", ".join(['?'] * len(fields)))
+    args = args + tuple(fields)
+    lower, upper = memdam.eventstore.compiler.time_bounds(field_filters)
+    if lower is not None:
+        sql += " AND bucket >= ?"
+        args = args + (lower / grain_long,)
+    if upper is not None:
+        sql += " AND bucket < ?"
+        args = args + (upper / grain_long,)
+    sql += " GROUP BY 1, 2;"
+    cur.execute(sql, args)
+    #bucket -> field -> (count, min, max, sum)
+    stats = collections.defaultdict(dict)
+    for row in cur.fetchall():
+        stats[row[0]][row[1]] = row[2:]
+    group = None
+    if query.group_by is not None:
+        group = namespace
+    for bucket, field_stats in stats.items():
+        partials = []
+        for function, field in query.aggregates:
+            if field is None:
+                field = EVENT_COUNT_FIELD
+            count, low, high, total = field_stats.get(field, (0, None, None, None))
+            if function == 'count':
+                partials.append(count)
+            elif function == 'min':
+                partials.append(low)
+            elif function == 'max':
+                partials.append(high)
+            elif function == 'sum':
+                partials.append(total)
+            else:
+                partials.extend((total, count))
+        accumulator.add(bucket, group, partials)
+
+def _add_value(deltas, bucket, field, value):
+    """
+    Include one value in the changes for its bucket and field
+    """
+    key = (bucket, field)
+    delta = deltas.get(key, None)
+    if delta is None:
+        if value is None:
+            deltas[key] = [1, None, None, 0]
+        else:
+            deltas[key] = [1, value, value, value]
+    else:
+        delta[0] += 1
+        if value is not None:
+            delta[1] = min(delta[1], value)
+            delta[2] = max(delta[2], value)
+            delta[3] += value
+
+def _bucket(time, grain_long):
+    """:returns: the bucket for a time (as stored), rounded towards zero like sqlite"""
+    if time >= 0:
+        return time // grain_long
+    return -((-time) // grain_long)
+
+def _bucket_range(bucket, grain_long):
+    """:returns: the (inclusive) first and (exclusive) last times (as stored) in a bucket"""
+    if bucket > 0:
+        return bucket * grain_long, (bucket + 1) * grain_long
+    if bucket < 0:
+        return (bucket - 1) * grain_long + 1, bucket * grain_long + 1
+    return -grain_long + 1, grain_long
+
+def _seconds_to_long(seconds):
+    """:returns: the length of time, in the same units as stored times"""
+    return long(seconds) * 1000000L
@@ -0,0 +1,349 @@
+"""
+Sealed, columnar storage for old events in the sqlite Eventstore.
+
+Sampling collectors (eg, cpu usage every 10 seconds) produce huge numbers of tiny, regular events,
+and as rows each one costs a whole row plus an entry in every index. Once they are old enough that
+they stop changing, Eventstore.seal moves them out of their table and into segments in the same file:
+
+- <table>__segments has one row per segment (up to DEFAULT_SEGMENT_SIZE events, in order of time)
+  with the first and last time in it. It is indexed by the last time, so it is the time index for
+  the segments: queries only read the segments that overlap the time range that they ask for.
+- <table>__segment_columns has one row per column of each segment: every value in the column,
+  packed into an array and compressed with zlib. TIME columns are stored as the differences between
+  consecutive times, which are nearly all the same for sampled events. Columns where every value is
+  NULL are left out, and NULLs are marked in a separate (compressed) array.
+
+Only tables where every field is a TIME, ID, NUMBER, LONG or BOOL can be sealed. Event ids are
+random, so they can't be compressed, and end up being most of what is left.
+
+Segments are read by loading their rows into an in-memory table with the same columns, and running
+exactly the same sql against that as against the table, so the results are always the same as if
+the events had never been sealed. Only the columns that a query needs are decompressed.
+"""
+
+import zlib
+import struct
+import sqlite3
+
+import memdam
+import memdam.common.field
+import memdam.common.event
+
+SEGMENTS_SUFFIX = u'__segments'
+COLUMNS_SUFFIX = u'__segment_columns'
+FORMAT_VERSION = 1
+DEFAULT_SEGMENT_SIZE = 4096
+#the most rows to load into memory at once when reading segments
+LOAD_SIZE = 65536
+
+SEALABLE_TYPES = frozenset((
+    memdam.common.field.FieldType.TIME,
+    memdam.common.field.FieldType.ID,
+    memdam.common.field.FieldType.NUMBER,
+    memdam.common.field.FieldType.LONG,
+    memdam.common.field.FieldType.BOOL,
+))
+#how the values of each type (except ID) are packed, always little endian
+VALUE_FORMATS = {
+    memdam.common.field.FieldType.TIME: 'q',
+    memdam.common.field.FieldType.NUMBER: 'd',
+    memdam.common.field.FieldType.LONG: 'q',
+    memdam.common.field.FieldType.BOOL: 'B',
+}
+ID_SIZE = 16
+NULL_MARK = '\x01'
+PRESENT_MARK = '\x00'
+
+def segments_table_name(table_name):
+    """
+    :returns: the name of the table with one row per segment
+    :rtype: unicode
+    """
+    return table_name + SEGMENTS_SUFFIX
+
+def columns_table_name(table_name):
+    """
+    :returns: the name of the table with the compressed columns of every segment
+    :rtype: unicode
+    """
+    return table_name + COLUMNS_SUFFIX
+
+def is_segment_table(table_name):
+    """
+    :returns: True iff this holds segments rather than events
+    :rtype: bool
+    """
+    return table_name.endswith(SEGMENTS_SUFFIX) or table_name.endswith(COLUMNS_SUFFIX)
+
+def is_sealable(columns):
+    """
+    :param columns: the names of the columns in the table
+    :type  columns: iterable(string)
+    :returns: True iff every column can be stored in segments
+    :rtype: bool
+    """
+    return all(memdam.common.event.Event.field_type(name) in SEALABLE_TYPES for name in columns)
+
+@memdam.vtrace()
+def exists(cur, table_name):
+    """
+    :returns: True iff the segment tables for this table have been created
+    :rtype: bool
+    """
+    sql = "SELECT name FROM sqlite_master WHERE type='table' AND name = ?;"
+    cur.execute(sql, (segments_table_name(table_name),))
+    return len(cur.fetchall()) > 0
+
+@memdam.vtrace()
+def create(cur, table_name):
+    """
+    Create the segment tables, if they don't exist yet
+    """
+    segments_table = segments_table_name(table_name)
+    cur.execute("CREATE TABLE IF NOT EXISTS %s(_id INTEGER PRIMARY KEY, version INTEGER NOT NULL, "
+                "first_time INTEGER NOT NULL, last_time INTEGER NOT NULL, count INTEGER NOT NULL);" % (segments_table))
+    cur.execute("CREATE INDEX IF NOT EXISTS %s__last_time ON %s (last_time);" % (segments_table, segments_table))
+    cur.execute("CREATE TABLE IF NOT EXISTS %s(segment INTEGER NOT NULL, name TEXT NOT NULL, nulls BLOB, data BLOB NOT NULL, "
+                "PRIMARY KEY (segment, name));" % (columns_table_name(table_name)))
+
+@memdam.vtrace()
+def seal(cur, table_name, before, segment_size=DEFAULT_SEGMENT_SIZE):
+    """
+    Move every event from before a certain time out of the table and into new segments. Must be
+    called inside of a write transaction, only for tables that are_sealable, and after create.
+
+    :param before: the time (as stored) before which events are sealed
+    :type  before: long
+    :param segment_size: the most events in one segment
+    :type  segment_size: int
+    :returns: the number of events that were sealed
+    :rtype: int
+    """
+    assert segment_size > 0
+    read_cur = cur.connection.cursor()
+    read_cur.execute("SELECT * FROM %s WHERE time__time < ? ORDER BY time__time, _id;" % (table_name), (before,))
+    names = [x[0] for x in read_cur.description]
+    row_id_index = names.index('_id')
+    del names[row_id_index]
+    count = 0
+    while True:
+        rows = read_cur.fetchmany(segment_size)
+        if len(rows) <= 0:
+            break
+        _write(cur, table_name, names, [row[:row_id_index] + row[row_id_index+1:] for row in rows])
+        count += len(rows)
+    cur.execute("DELETE FROM %s WHERE time__time < ?;" % (table_name), (before,))
+    return count
+
+@memdam.vtrace()
+def find(cur, table_name, lower=None, upper=None):
+    """
+    :param lower: the smallest time (as stored) to look for, or None
+    :type  lower: long
+    :param upper: the largest time (as stored, exclusive) to look for, or None
+    :type  upper: long
+    :returns: the (id, first time, last time, number of events) of every segment that overlaps the
+    range, in order of first time
+    :rtype: list(tuple(int, long, long, int))
+    """
+    sql = "SELECT _id, first_time, last_time, count FROM %s WHERE 1" % (segments_table_name(table_name))
+    args = ()
+    if lower is not None:
+        sql += " AND last_time >= ?"
+        args = args + (lower,)
+    if upper is not None:
+        sql += " AND first_time < ?"
+        args = args + (upper,)
+    cur.execute(sql + " ORDER BY first_time;", args)
+    return cur.fetchall()
+
+def batches(segments, ordered_by_time, max_rows=LOAD_SIZE):
+    """
+    Split the segments into groups that can be loaded and queried one at a time.
+
+    :param segments: see find
+    :type  segments: list(tuple(int, long, long, int))
+    :param ordered_by_time: iff True, groups are only split where every later segment starts after
+    every earlier segment ends, so that results ordered by time can just be concatenated
+    :type  ordered_by_time: bool
+    :returns: the ids of the segments in each group, in order of time
+    :rtype: list(list(int))
+    """
+    groups = []
+    current = []
+    rows = 0
+    last_time = None
+    for segment_id, first_time, segment_last_time, count in sorted(segments, key=lambda segment: segment[1]):
+        can_split = not ordered_by_time or first_time > last_time
+        if len(current) > 0 and rows + count > max_rows and can_split:
+            groups.append(current)
+            current = []
+            rows = 0
+        current.append(segment_id)
+        rows += count
+        last_time = max(last_time, segment_last_time)
+    if len(current) > 0:
+        groups.append(current)
+    return groups
+
+@memdam.vtrace()
+def load_rows(cur, table_name, segment_ids, names):
+    """
+    :param segment_ids: the segments to read
+    :type  segment_ids: list(int)
+    :param names: the columns to read. Any that a segment doesn't have are NULL.
+    :type  names: list(string)
+    :returns: every row in the segments, as they would be stored in the table
+    :rtype: list(tuple)
+    """
+    rows = []
+    for segment_id in segment_ids:
+        columns = _load_columns(cur, table_name, segment_id, names)
+        rows.extend(zip(*[columns[name] for name in names]))
+    return rows
+
+@memdam.vtrace()
+def memory_table(table_name, columns, names, rows):
+    """
+    :param columns: the columns of the table
+    :type  columns: dict(string, memdam.eventstore.sqlite.SqliteColumn)
+    :param names: the columns that the rows have
+    :type  names: list(string)
+    :param rows: see load_rows
+    :type  rows: list(tuple)
+    :returns: a connection to a new in-memory database with a table of the same name, with just
+    those columns and rows. The caller must close it.
+    :rtype: sqlite3.Connection
+    """
+    conn = sqlite3.connect(":memory:")
+    definitions = ["_id INTEGER PRIMARY KEY"] + ["%s %s" % (name, columns[name].sql_type) for name in names]
+    conn.execute("CREATE TABLE %s(%s);" % (table_name, ", ".join(definitions)))
+    conn.executemany("INSERT INTO %s (%s) VALUES (%s);" % (table_name, ", ".join(names), ", ".join(['?'] * len(names))), rows)
+    return conn
+
+@memdam.vtrace()
+def remove(cur, table_name, event_ids):
+    """
+    Take these events out of whichever segments they are in, by writing new segments without them.
+    Has to look at the ids in every segment, so this is much slower than removing rows from the
+    table. Must be called inside of a write transaction.
+
+    :param event_ids: the events to remove
+    :type  event_ids: iterable(uuid.UUID)
+    :returns: the time (as stored) of every event that was removed
+    :rtype: dict(uuid.UUID, long)
+    """
+    id_bytes = dict((event_id.bytes, event_id) for event_id in event_ids)
+    removed = {}
+    if len(id_bytes) <= 0:
+        return removed
+    for segment_id, _, _, _ in find(cur, table_name):
+        ids = _load_columns(cur, table_name, segment_id, [u'id__id'])[u'id__id']
+        if not any(event_id is not None and str(event_id) in id_bytes for event_id in ids):
+            continue
+        cur.execute("SELECT name FROM %s WHERE segment = ?;" % (columns_table_name(table_name)), (segment_id,))
+        names = [row[0] for row in cur.fetchall()]
+        id_index = names.index(u'id__id')
+        time_index = names.index(u'time__time')
+        kept = []
+        for row in load_rows(cur, table_name, [segment_id], names):
+            event_id = id_bytes.get(str(row[id_index]), None)
+            if event_id is None:
+                kept.append(row)
+            else:
+                removed[event_id] = row[time_index]
+        cur.execute("DELETE FROM %s WHERE segment = ?;" % (columns_table_name(table_name)), (segment_id,))
+        cur.execute("DELETE FROM %s WHERE _id = ?;" % (segments_table_name(table_name)), (segment_id,))
+        if len(kept) > 0:
+            _write(cur, table_name, names, kept)
+    return removed
+
+def encode_column(name, values):
+    """
+    :param name: the field that the values are for
+    :type  name: string
+    :param values: every value in the column, as stored in the table (None for NULL)
+    :type  values: list
+    :returns: the compressed NULL marks (None if there are no NULLs), and the compressed values
+    :rtype: tuple(buffer, buffer)
+    """
+    field_type = memdam.common.event.Event.field_type(name)
+    nulls = None
+    if any(value is None for value in values):
+        nulls = buffer(zlib.compress(''.join(NULL_MARK if value is None else PRESENT_MARK for value in values)))
+    if field_type == memdam.common.field.FieldType.ID:
+        packed = ''.join('\x00' * ID_SIZE if value is None else str(value) for value in values)
+    else:
+        filled = [0 if value is None else value for value in values]
+        if field_type == memdam.common.field.FieldType.TIME:
+            filled = _deltas(filled)
+        packed = struct.pack('<%d%s' % (len(filled), VALUE_FORMATS[field_type]), *filled)
+    return nulls, buffer(zlib.compress(packed))
+
+def decode_column(name, count, nulls, data):
+    """
+    The opposite of encode_column
+
+    :param count: the number of values in the column
+    :type  count: int
+    :returns: the values, as stored in the table
+    :rtype: list
+    """
+    field_type = memdam.common.event.Event.field_type(name)
+    packed = zlib.decompress(str(data))
+    if field_type == memdam.common.field.FieldType.ID:
+        values = [buffer(packed[i*ID_SIZE:(i+1)*ID_SIZE]) for i in range(0, count)]
+    else:
+        values = list(struct.unpack('<%d%s' % (count, VALUE_FORMATS[field_type]), packed))
+        if field_type == memdam.common.field.FieldType.TIME:
+            values = _running_sums(values)
+    if nulls is not None:
+        marks = zlib.decompress(str(nulls))
+        values = [None if marks[i] == NULL_MARK else values[i] for i in range(0, count)]
+    return values
+
+def _write(cur, table_name, names, rows):
+    """
+    Add a new segment with these rows (which must be in order of time)
+    """
+    time_index = names.index(u'time__time')
+    cur.execute("INSERT INTO %s (version, first_time, last_time, count) VALUES (?, ?, ?, ?);" % (segments_table_name(table_name)),
+                (FORMAT_VERSION, rows[0][time_index], rows[-1][time_index], len(rows)))
+    segment_id = cur.lastrowid
+    values = []
+    for i in range(0, len(names)):
+        column = [row[i] for row in rows]
+        if all(value is None for value in column):
+            continue
+        nulls, data = encode_column(names[i], column)
+        values.append((segment_id, names[i], nulls, data))
+    cur.executemany("INSERT INTO %s (segment, name, nulls, data) VALUES (?, ?, ?, ?);" % (columns_table_name(table_name)), values)
+
+def _load_columns(cur, table_name, segment_id, names):
+    """
+    :returns: name -> every value in that column of the segment
+    :rtype: dict(string, list)
+    """
+    cur.execute("SELECT version, count FROM %s WHERE _id = ?;" % (segments_table_name(table_name)), (segment_id,))
+    version, count = cur.fetchone()
+    assert version == FORMAT_VERSION, "Unsupported segment format: %s" % (version)
+    columns = dict((name, [None] * count) for name in names)
+    sql = "SELECT name, nulls, data FROM %s WHERE segment = ? AND name IN (%s);" % \
+          (columns_table_name(table_name), ", ".join(['?'] * len(names)))
+    cur.execute(sql, [segment_id] + list(names))
+    for name, nulls, data in cur.fetchall():
+        columns[name] = decode_column(name, count, nulls, data)
+    return columns
+
+def _deltas(values):
+    """:returns: the first value, followed by the difference between each value and the one before it"""
+    return values[:1] + [values[i] - values[i-1] for i in range(1, len(values))]
+
+def _running_sums(deltas):
+    """:returns: the values that _deltas was called with"""
+    values = []
+    total = 0
+    for delta in deltas:
+        total += delta
+        values.append(total)
+    return values
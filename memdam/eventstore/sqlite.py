@@ -6,14 +6,29 @@ import os
 import sqlite3
 import time
 import itertools
+import threading
+import contextlib
+import collections
+import array
+import math
 
 import pytz
 import lockfile
 
 import memdam
 import memdam.common.field
+import memdam.common.timeutils
 import memdam.common.event
+import memdam.common.query
+import memdam.common.change
 import memdam.eventstore.api
+import memdam.eventstore.merge
+import memdam.eventstore.compiler
+import memdam.eventstore.aggregate
+import memdam.eventstore.rollup
+import memdam.eventstore.indexing
+import memdam.eventstore.segment
+import memdam.eventstore.changelog
 
 @memdam.vtrace()
 def execute_sql(cur, sql, args=()):
@@ -38,97 +53,1061 @@ class Eventstore(memdam.eventstore.api.Eventstore):
     Note: pass in a folder called :memory: to keep everything in memory for testing
 
     When inserting new events, automatically creates new columns if necessary.
-    All columns are given appropriate indices (usually ASC, except in the case of TEXT, which is
-    given an FTS virtual table, and the column in the main table because an INTEGER that refers
-    to the document id in the FTS table)
+    Only time__time and id__id are indexed by default. Any other indices come from the IndexPolicy
+    (see memdam.eventstore.indexing): composite indices declared per namespace are created as soon
+    as their columns exist, and the advisor can suggest or build indices for queries that keep
+    scanning whole tables. index_stats shows how often each index has been used, and drop_index
+    gets rid of the ones that aren't.
 
     Columns are created with exactly the same name as the variables.
-    Variable names uniquely define the type of the column, as well as the type of any index.
+    Variable names uniquely define the type of the column.
 
     TEXT attributes will createa column that contains docid integer references in the main table,
     AS WELL AS a second (virtual, fts4) table (name__text__docs)
 
     Indices are named "name__type__secondary__indextype"
+
+    id__id has a unique index, and saving an event that is already in the table replaces it (reusing
+    its row and documents), so save is idempotent and can safely be retried with the same events.
+    Tables from before the index was unique are deduplicated the first time they are written to.
+
+    By default each table file uses a rollback journal, so readers are blocked while anything is
+    being written. Pass wal=True to switch every table file to write-ahead logging instead, so that
+    readers can keep reading while collectors and sync are writing. In that mode, checkpoints are
+    never run inline with a write--a background thread checkpoints every table that was written to
+    once every checkpoint_interval seconds.
+
+    Every event id is also recorded in a small index (_event_ids.idx, or the _event_ids table in
+    memory) that maps it to the table holding the event, so that get and delete only ever have to
+    look at one table. Ids are added to the index BEFORE the events are inserted and removed AFTER
+    they are deleted, so the index never misses an event that exists (though after a crash it may
+    point at an event that doesn't). The index is built from the existing tables the first time a
+    folder is opened without one.
+
+    Pass partition='year', 'month' or 'day' to split each namespace into one table per period of
+    time (named like com_memdam_cpu__201401), so that tables and their indices stop growing forever.
+    find skips any partition that can't contain events matching the time__time filters, and old
+    partitions can be removed with drop_partitions or archive_partitions without touching anything
+    else. Unpartitioned tables (eg, from before partitioning was turned on) are still read as usual.
+
+    Pass rollups=True to keep per-minute, per-hour and per-day summaries of every table (see
+    memdam.eventstore.rollup), which are updated in the same transaction as the events. aggregate
+    reads the summaries instead of the events whenever that gives exactly the same answer: when the
+    buckets are whole minutes, hours or days, the only filters are time bounds on those same
+    boundaries (and namespaces), and nothing is grouped by a field. Summaries are created (from the
+    events already there) the first time each table is written to after turning this on.
+
+    Large imports should use bulk_load instead of save (see BulkLoad).
+
+    Old events from sampling namespaces can be sealed (see seal and memdam.eventstore.segment) into
+    compressed, columnar segments in the same file. find, get and aggregate read segments as well as
+    the table, so sealing never changes their results. Saving an event that is sealed takes it back
+    out of its segment, as does deleting it, but both have to look at every segment of the table.
+
+    Pass changes=True to keep a change feed for every table (see memdam.eventstore.changelog), so
+    that new, updated and deleted events can be read with changes_since instead of polling with find.
+    Each table's feed is created (with a save for every event already there) the first time it is
+    written to after turning this on.
     """
 
     EXTENSION = '.sql'
     LOCK_EXTENSION = '.lock'
     CREATE_TABLE_EXTENSION = '.creating_sql'
 
-    def __init__(self, folder):
+    ID_INDEX_TABLE = '_event_ids'
+    ID_INDEX_EXTENSION = '.idx'
+    CREATE_ID_INDEX_EXTENSION = '.creating_idx'
+
+    #the state of every bulk load lives next to the id index, and in each table that it has touched
+    BULK_LOADS_TABLE = '_bulk_loads'
+    BULK_LOAD_TABLES_TABLE = '_bulk_load_tables'
+    BULK_LOAD_STATE_TABLE = '_bulk_load'
+
+    #rows are read (and their TEXT documents are loaded) this many at a time
+    PAGE_SIZE = 500
+
+    DEFAULT_BUSY_TIMEOUT = 5.0
+    #how many prepared statements sqlite keeps around per connection. Queries are always compiled
+    #with bound parameters, so the same few statements get used over and over again
+    CACHED_STATEMENTS = 256
+
+    #how search results show the words that matched
+    SNIPPET_START = u'<b>'
+    SNIPPET_END = u'</b>'
+    SNIPPET_ELLIPSIS = u'...'
+    SNIPPET_TOKENS = 15
+    DEFAULT_CHECKPOINT_INTERVAL = 30.0
+
+    def __init__(self, folder, max_connections=None, wal=False, synchronous=None,
+                 checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL, busy_timeout=DEFAULT_BUSY_TIMEOUT,
+                 partition=None, rollups=False, index_policy=None, changes=False):
+        """
+        :param folder: the folder where all of the table files live (or :memory:)
+        :type  folder: string
+        :param max_connections: the most connections that will be kept open at once. Defaults to
+        ConnectionPool.DEFAULT_MAX_CONNECTIONS
+        :type  max_connections: int
+        :param wal: iff True, use write-ahead logging for every table file. Ignored for :memory:
+        :type  wal: bool
+        :param synchronous: the sqlite synchronous level (OFF, NORMAL, FULL). Defaults to NORMAL
+        for write-ahead logging (which is still safe in that mode) and to the sqlite default otherwise
+        :type  synchronous: string
+        :param checkpoint_interval: seconds between background checkpoints (only used with wal)
+        :type  checkpoint_interval: float
+        :param busy_timeout: seconds to wait for a lock held by someone else before giving up
+        :type  busy_timeout: float
+        :param partition: one of PARTITION_FORMATS to store new events in time partitions, or None
+        :type  partition: string
+        :param rollups: iff True, create summary tables and use them for aggregates. Summary tables that
+        already exist are always kept up to date, even if this is False.
+        :type  rollups: bool
+        :param index_policy: which indices to create beyond time__time and id__id
+        :type  index_policy: memdam.eventstore.indexing.IndexPolicy
+        :param changes: iff True, create a change feed for every table (see changes_since). Change feeds
+        that already exist always record every save and delete, even if this is False.
+        :type  changes: bool
+        """
         self.folder = folder
         self.memory_connection = None
+        self._memory_lock = threading.RLock()
+        if max_connections is None:
+            max_connections = ConnectionPool.DEFAULT_MAX_CONNECTIONS
+        self._pool = ConnectionPool(self._open_connection, max_connections)
+        self._catalog = SchemaCatalog()
+        self._compiler = memdam.eventstore.compiler.QueryCompiler()
+        self._wal = wal and folder != ":memory:"
+        if synchronous is None and self._wal:
+            synchronous = 'NORMAL'
+        assert synchronous in (None, 'OFF', 'NORMAL', 'FULL'), "Invalid synchronous level: %s" % (synchronous)
+        self._synchronous = synchronous
+        self._busy_timeout = busy_timeout
+        self._checkpointer = None
+        if self._wal:
+            self._checkpointer = Checkpointer(self._checkpoint, checkpoint_interval)
+        self._id_index_lock = threading.Lock()
+        self._id_index_ready = False
+        assert partition is None or partition in PARTITION_FORMATS, "Invalid partition: %s" % (partition)
+        self._partition = partition
+        self._rollups = rollups
+        #the tables that are known to have rollups
+        self._rollup_tables = set()
+        if index_policy is None:
+            index_policy = memdam.eventstore.indexing.IndexPolicy()
+        self._index_policy = index_policy
+        self._advisor = memdam.eventstore.indexing.IndexAdvisor(index_policy)
+        #table name -> (name of the bulk load that it is part of, TEXT columns whose documents are staged)
+        self._bulk_tables = {}
+        self._bulk_lock = threading.Lock()
+        #the tables that are known to have segments
+        self._segment_tables = set()
+        self._changes = changes
+        #the tables that are known to have change feeds
+        self._change_tables = set()
 
     def save(self, events):
         memdam.log().debug("Saving events")
-        sorted_events = sorted(events, key=lambda x: x.namespace)
-        for namespace, grouped_events in itertools.groupby(sorted_events, lambda x: x.namespace):
-            table_name = namespace_to_table_name(namespace)
+        sorted_events = sorted(events, key=self._table_name_for_event)
+        for table_name, grouped_events in itertools.groupby(sorted_events, self._table_name_for_event):
             self._save_events(list(grouped_events), table_name)
 
     def get(self, event_id):
+        return self.get_many([event_id])[0]
+
+    def get_many(self, event_ids):
+        event_ids = list(event_ids)
+        table_names = self._lookup_tables(event_ids)
+        ids_by_table = collections.defaultdict(set)
+        for event_id in event_ids:
+            if event_id not in table_names:
+                raise Exception("event with id %s not found" % (event_id))
+            ids_by_table[table_names[event_id]].add(event_id)
+        events = {}
+        for table_name, table_event_ids in ids_by_table.items():
+            for event in self._get_events_from_table(table_name, list(table_event_ids)):
+                events[event.id__id] = event
+        for event_id in event_ids:
+            if event_id not in events:
+                raise Exception("event with id %s not found" % (event_id))
+        return [events[event_id] for event_id in event_ids]
+
+    def find(self, query):
+        return list(self.find_iter(query))
+
+    def find_iter(self, query):
+        """
+        If the query has an order, the (already sorted) results from each table are merged, so the
+        order and the limit apply to all of the events, not just to those within each table.
+
+        Note: the connection to each table is held while its events are being yielded. Unless wal is
+        enabled, that means that writes to that table will block until iteration moves on, so use
+        find if you need to modify the events as you go.
+        """
+        self._build_advised_indices()
+        time_bounds = memdam.eventstore.compiler.time_bounds(query.filters)
+        table_results = []
+        for table_name in self._all_table_names():
+            if _matches_namespace_filters(table_name, query) and _matches_time_bounds(table_name, time_bounds):
+                table_results.append(self._find_matching_events_in_table(table_name, query))
+                table_results.append(self._find_sealed_events_in_table(table_name, query, time_bounds))
+        sort_key = None
+        if query.order:
+            sort_key = make_sort_key(query.order)
+        for event in memdam.eventstore.merge.merge_sorted(table_results, key=sort_key, limit=query.limit):
+            yield event
+
+    def search(self, query):
+        rank_filter = _find_rank_filter(query.filters)
+        column = memdam.eventstore.compiler.match_column(rank_filter)
+        time_bounds = memdam.eventstore.compiler.time_bounds(query.filters)
+        table_results = [self._search_table(table_name, query, rank_filter, column) \
+                         for table_name in self._all_table_names() \
+                         if _matches_namespace_filters(table_name, query) and _matches_time_bounds(table_name, time_bounds)]
+        sort_key = lambda result: memdam.eventstore.merge.Descending(result.rank)
+        return list(memdam.eventstore.merge.merge_sorted(table_results, key=sort_key, limit=query.limit))
+
+    def aggregate(self, query):
+        memdam.eventstore.aggregate.validate(query)
+        self._build_advised_indices()
+        accumulator = memdam.eventstore.aggregate.Accumulator(query.aggregates)
+        time_bounds = memdam.eventstore.compiler.time_bounds(query.filters)
         for table_name in self._all_table_names():
-            conn = self._connect(table_name, read_only=True)
+            if _matches_namespace_filters(table_name, query) and _matches_time_bounds(table_name, time_bounds):
+                if not self._aggregate_rollups(table_name, query, accumulator):
+                    self._aggregate_table(table_name, query, accumulator)
+                    self._aggregate_sealed(table_name, query, accumulator, time_bounds)
+        rows = []
+        for bucket, group, values in accumulator.results():
+            if bucket is not None:
+                bucket = convert_long_to_time(bucket * _seconds_to_long(query.bucket))
+            values = [_convert_aggregate_value(function, field, value) for (function, field), value in zip(query.aggregates, values)]
+            rows.append(memdam.common.query.AggregateRow(bucket, group, values))
+        return rows
+
+    def delete(self, event_id):
+        table_names = self._lookup_tables([event_id])
+        if event_id not in table_names:
+            return
+        table_name = table_names[event_id]
+        if self._table_exists(table_name):
+            if self._changes:
+                self._ensure_changes(table_name)
+            self._delete_from_table(table_name, event_id)
+        self._unindex_events([event_id])
+
+    def close(self):
+        """
+        Close every connection that we are holding open. The Eventstore should not be used after
+        this is called.
+        """
+        if self._checkpointer != None:
+            self._checkpointer.stop()
+        self._pool.close()
+        with self._memory_lock:
+            if self.memory_connection != None:
+                self.memory_connection.close()
+                self.memory_connection = None
+
+    def drop_partitions(self, namespace, before):
+        """
+        Delete every partition of the namespace that only holds events from before a certain time.
+
+        :param namespace: the namespace whose partitions should be dropped
+        :type  namespace: unicode
+        :param before: partitions that end at or before this time are dropped
+        :type  before: datetime.datetime
+        :returns: the names of the tables that were dropped
+        :rtype: list(unicode)
+        """
+        def remove(path):
+            os.remove(path)
+        return self._remove_partitions(namespace, before, remove)
+
+    def archive_partitions(self, namespace, before, destination):
+        """
+        Move every partition of the namespace that only holds events from before a certain time into
+        another folder, which can itself be opened as an Eventstore.
+
+        :param destination: the folder to move the partitions to
+        :type  destination: string
+        :returns: the names of the tables that were archived
+        :rtype: list(unicode)
+        """
+        assert os.path.isdir(destination), "Archive folder does not exist: %s" % (destination)
+        def move(path):
+            os.rename(path, os.path.join(destination, os.path.basename(path)))
+        return self._remove_partitions(namespace, before, move)
+
+    def seal(self, namespace, before, segment_size=None):
+        """
+        Move the events of a namespace from before a certain time into segments (see
+        memdam.eventstore.segment). Only meant for namespaces of samples: tables with any fields that
+        aren't TIME, ID, NUMBER, LONG or BOOL are left alone. Events should not be sealed until they
+        have stopped changing, since saving or deleting them later is slow.
+
+        :param namespace: the namespace whose events should be sealed
+        :type  namespace: unicode
+        :param before: events from before this time are sealed
+        :type  before: datetime.datetime
+        :param segment_size: the most events in one segment. Defaults to
+        memdam.eventstore.segment.DEFAULT_SEGMENT_SIZE
+        :type  segment_size: int
+        :returns: the number of events that were sealed
+        :rtype: int
+        """
+        if segment_size is None:
+            segment_size = memdam.eventstore.segment.DEFAULT_SEGMENT_SIZE
+        base_table_name = namespace_to_table_name(namespace)
+        before = convert_time_to_long(before)
+        count = 0
+        for table_name in self._all_table_names():
+            table, suffix = split_partition(table_name)
+            if table != base_table_name:
+                continue
+            if suffix is not None and partition_time_range(suffix)[0] >= before:
+                continue
+            assert table_name not in self._bulk_tables, "Can't seal %s during a bulk load" % (table_name)
+            with self._schema_transaction(table_name) as cur:
+                columns = self._table_columns(cur, table_name)
+                if not memdam.eventstore.segment.is_sealable(columns):
+                    memdam.log().info("Not sealing %s, since not every field can be sealed" % (table_name))
+                    continue
+                memdam.eventstore.segment.create(cur, table_name)
+                sealed = memdam.eventstore.segment.seal(cur, table_name, before, segment_size)
+            self._segment_tables.add(table_name)
+            memdam.log().info("Sealed %s events from %s" % (sealed, table_name))
+            count += sealed
+        return count
+
+    def changes_since(self, cursor=None, limit=None):
+        """
+        Only available when the Eventstore was opened with changes=True. There is one feed per table,
+        and the feeds are read in order of table name. Feeds disappear along with their partitions
+        (see drop_partitions), without any tombstones for the events that they held.
+        """
+        assert self._changes, "The change feed is not enabled"
+        if cursor is None:
+            cursor = memdam.common.change.Cursor()
+        changes = []
+        for table_name in sorted(self._all_table_names()):
+            remaining = None
+            if limit is not None:
+                remaining = limit - len(changes)
+                if remaining <= 0:
+                    break
+            with self._connection(table_name, read_only=True) as conn:
+                cur = conn.cursor()
+                if not self._has_changes(cur, table_name):
+                    continue
+                rows = memdam.eventstore.changelog.read(cur, table_name, cursor.position(table_name), remaining)
             namespace = table_name_to_namespace(table_name)
+            changes.extend(memdam.common.change.Change(table_name, sequence, namespace, uuid.UUID(bytes=str(event_id)), deleted) \
+                           for sequence, event_id, deleted in rows)
+        return changes
+
+    def trim_changes(self, cursor):
+        """
+        Forget the tombstones for events that were deleted before the cursor, once every consumer of
+        the feed has read past them. Saves are never removed.
+
+        :param cursor: how far every consumer has read
+        :type  cursor: memdam.common.change.Cursor
+        :returns: the number of tombstones that were removed
+        :rtype: int
+        """
+        count = 0
+        for table_name in self._all_table_names():
+            if cursor.position(table_name) <= 0:
+                continue
+            with self._connection(table_name, read_only=False) as conn:
+                cur = conn.cursor()
+                if not self._has_changes(cur, table_name):
+                    continue
+                self._begin_write(cur, table_name)
+                count += memdam.eventstore.changelog.trim(cur, table_name, cursor.position(table_name))
+                conn.commit()
+        return count
+
+    def bulk_load(self, name, batch_size=None):
+        """
+        Start (or resume) a bulk load. See BulkLoad.
+
+        :param name: identifies the bulk load, so that it can be resumed after a crash
+        :type  name: unicode
+        :param batch_size: the most events to save in one transaction. Defaults to
+        BulkLoad.DEFAULT_BATCH_SIZE
+        :type  batch_size: int
+        :rtype: BulkLoad
+        """
+        if batch_size is None:
+            batch_size = BulkLoad.DEFAULT_BATCH_SIZE
+        self._ensure_id_index()
+        with self._connection(Eventstore.ID_INDEX_TABLE, read_only=False) as conn:
             cur = conn.cursor()
-            sql = "SELECT * FROM %s WHERE id__id = ?;" % (table_name)
-            execute_sql(cur, sql, (buffer(event_id.bytes),))
-            names = [x[0] for x in cur.description]
-            for row in cur.fetchall():
-                return _create_event_from_row(row, names, namespace, conn)
-        raise Exception("event with id %s not found" % (event_id))
+            _create_bulk_loads(cur)
+            self._begin_write(cur, Eventstore.ID_INDEX_TABLE)
+            execute_sql(cur, "INSERT OR IGNORE INTO %s (name) VALUES (?);" % (Eventstore.BULK_LOADS_TABLE), (name,))
+            execute_sql(cur, "SELECT checkpoint FROM %s WHERE name = ?;" % (Eventstore.BULK_LOADS_TABLE), (name,))
+            checkpoint = cur.fetchone()[0]
+            execute_sql(cur, "SELECT table_name FROM %s WHERE name = ?;" % (Eventstore.BULK_LOAD_TABLES_TABLE), (name,))
+            table_names = [row[0] for row in cur.fetchall()]
+            conn.commit()
+        for table_name in table_names:
+            staged_columns = frozenset()
+            if self._table_exists(table_name):
+                with self._connection(table_name, read_only=False) as conn:
+                    cur = conn.cursor()
+                    _create_bulk_load_state(cur)
+                    execute_sql(cur, "SELECT object FROM %s WHERE name = ? AND table_name = ? AND kind = 'docs';" % \
+                                (Eventstore.BULK_LOAD_STATE_TABLE), (name, table_name))
+                    staged_columns = frozenset(row[0] for row in cur.fetchall())
+            with self._bulk_lock:
+                assert self._bulk_tables.get(table_name, (name,))[0] == name, "%s is already part of another bulk load" % (table_name)
+                self._bulk_tables[table_name] = (name, staged_columns)
+        if len(table_names) > 0:
+            memdam.log().info("Resuming bulk load %s of %s tables from %r" % (name, len(table_names), checkpoint))
+        return BulkLoad(self, name, batch_size, checkpoint)
 
-    def find(self, query):
-        events = []
+    def index_stats(self):
+        """
+        :returns: table name -> index name -> how many queries have used the index since this
+        Eventstore was opened. Indices that were never used are included with 0.
+        :rtype: dict(unicode, dict(string, int))
+        """
+        stats = {}
         for table_name in self._all_table_names():
-            if _matches_namespace_filters(table_name, query):
-                events += self._find_matching_events_in_table(table_name, query)
-        return events
+            with self._connection(table_name, read_only=True) as conn:
+                index_names = self._query_existing_indices(conn.cursor(), table_name)
+            uses = self._advisor.uses(table_name)
+            stats[table_name] = dict((name, uses.get(name, 0)) for name in index_names if not name.startswith('sqlite_autoindex'))
+        return stats
 
-    def delete(self, event_id):
+    def index_suggestions(self):
+        """
+        :returns: the table and columns of every index that would have avoided repeatedly scanning
+        a whole table, and how many scans it would have avoided
+        :rtype: list(tuple(unicode, tuple(string), int))
+        """
+        return self._advisor.suggestions()
+
+    def drop_index(self, table_name, index_name):
+        """
+        Remove an index (eg, one that index_stats shows is never used). Indices from the IndexPolicy
+        will just be created again, so remove them from the policy as well.
+
+        :param table_name: the table that the index is on
+        :type  table_name: unicode
+        :param index_name: the name of the index (see index_stats)
+        :type  index_name: string
+        """
+        assert index_name.lower() != _unique_id_index_name(table_name).lower(), "The unique index on id__id is required"
+        assert index_name.lower() != _time_index_name(table_name).lower(), "The index on time__time is required"
+        with self._connection(table_name, read_only=False) as conn:
+            cur = conn.cursor()
+            columns = self._table_columns(cur, table_name)
+            assert index_name in self._query_existing_indices(cur, table_name), "No index %s on %s" % (index_name, table_name)
+            self._begin_write(cur, table_name)
+            memdam.log().info("Dropping index %s" % (index_name))
+            execute_sql(cur, "DROP INDEX %s;" % (index_name))
+            conn.commit()
+            self._catalog.update(table_name, columns.values(), self._query_existing_indices(cur, table_name))
+        self._advisor.forget(table_name)
+
+    def _remove_partitions(self, namespace, before, remove):
+        """
+        Take the old partitions of the namespace out of this Eventstore.
+
+        :param remove: function(path) that gets rid of each file for a table
+        :type  remove: function
+        """
+        assert self.folder != ":memory:", "Partitions can only be removed from files"
+        base_table_name = namespace_to_table_name(namespace)
+        before = convert_time_to_long(before)
+        removed = []
         for table_name in self._all_table_names():
-            conn = self._connect(table_name, read_only=False)
+            table, suffix = split_partition(table_name)
+            if table != base_table_name or suffix is None:
+                continue
+            if partition_time_range(suffix)[1] > before:
+                continue
+            if self._wal:
+                self._checkpointer.forget(table_name)
+                self._checkpoint(table_name, 'TRUNCATE')
+            self._pool.close_table(table_name)
+            self._catalog.invalidate(table_name)
+            self._rollup_tables.discard(table_name)
+            self._segment_tables.discard(table_name)
+            self._change_tables.discard(table_name)
+            self._advisor.forget(table_name)
+            db_file = self._table_file(table_name)
+            for path in (db_file, db_file + '-wal', db_file + '-shm', db_file + '-journal'):
+                if os.path.exists(path):
+                    remove(path)
+            #only after the events are gone, see the class docstring
+            self._unindex_table(table_name)
+            removed.append(table_name)
+        return removed
+
+    def _table_name_for_event(self, event):
+        """
+        :returns: the name of the table that this event should be saved in
+        :rtype: unicode
+        """
+        table_name = namespace_to_table_name(event.namespace)
+        if self._partition is None:
+            return table_name
+        return partition_table_name(table_name, event.time__time, self._partition)
+
+    def _delete_from_table(self, table_name, event_id):
+        """
+        Remove the event (and any of its TEXT documents) from this table
+        """
+        with self._connection(table_name, read_only=False) as conn:
             cur = conn.cursor()
-            cur.execute("BEGIN EXCLUSIVE")
-            sql = "SELECT _id FROM %s WHERE id__id = ?;" % (table_name)
+            text_columns = _text_column_names(self._table_columns(cur, table_name))
+            self._begin_write(cur, table_name)
+            staged_columns = self._staged_columns(cur, table_name)
+            sql = "SELECT _id, time__time FROM %s WHERE id__id = ?;" % (table_name)
             execute_sql(cur, sql, (buffer(event_id.bytes),))
-            for row in cur.fetchall():
+            rows = cur.fetchall()
+            for row in rows:
                 rowid = row[0]
-                names = [x[0] for x in cur.description]
-                for i in range(0, len(names)):
-                    name = names[i]
-                    if name == '_id':
-                        continue
-                    if memdam.common.event.Event.field_type(name) == memdam.common.field.FieldType.TEXT:
-                        execute_sql(cur, "DELETE FROM %s__%s__docs WHERE docid = ?;" % (table_name, name), (rowid))
-                execute_sql(cur, "DELETE FROM %s WHERE _id = %s" % (table_name, rowid), ())
+                for name in text_columns:
+                    execute_sql(cur, "DELETE FROM %s__%s__docs WHERE docid = ?;" % (table_name, name), (rowid,))
+                for name in staged_columns:
+                    execute_sql(cur, "DELETE FROM %s WHERE docid = ?;" % (_staged_docs_table_name(table_name, name)), (rowid,))
+                execute_sql(cur, "DELETE FROM %s WHERE _id = ?;" % (table_name), (rowid,))
+            times = [row[1] for row in rows]
+            if len(rows) <= 0 and self._has_segments(cur, table_name):
+                times = memdam.eventstore.segment.remove(cur, table_name, [event_id]).values()
+            if len(times) > 0 and self._has_rollups(cur, table_name):
+                memdam.eventstore.rollup.recompute(cur, table_name, self._table_columns(cur, table_name), times,
+                                                   self._sealed_events(cur, table_name))
+            if len(times) > 0 and self._has_changes(cur, table_name):
+                memdam.eventstore.changelog.record(cur, table_name, [event_id], True)
             conn.commit()
 
     def _find_matching_events_in_table(self, table_name, query):
-        conn = self._connect(table_name, read_only=True)
+        """
+        :returns: the events in this table that match the query, loaded PAGE_SIZE rows at a time
+        :rtype: generator(memdam.common.event.Event)
+        """
+        with self._connection(table_name, read_only=True) as conn:
+            namespace = table_name_to_namespace(table_name)
+            cur = conn.cursor()
+            columns = self._table_columns(cur, table_name)
+            sql, args, field_filters = self._find_sql(table_name, query, columns)
+            page_size = Eventstore.PAGE_SIZE
+            if query.limit:
+                page_size = min(page_size, long(query.limit))
+            execute_sql(cur, sql, args)
+            self._advisor.observe(conn.cursor(), table_name, sql, args, field_filters, columns)
+            names = list(map(lambda x: x[0], cur.description))
+            #a separate cursor, so that we don't reset the one we're reading rows from
+            text_cur = conn.cursor()
+            staged_columns = self._staged_columns(text_cur, table_name)
+            while True:
+                rows = cur.fetchmany(page_size)
+                if len(rows) <= 0:
+                    break
+                texts = _load_text_fields(text_cur, table_name, names, rows, staged_columns)
+                for row in rows:
+                    yield _create_event_from_row(row, names, namespace, texts)
+
+    def _find_sealed_events_in_table(self, table_name, query, time_bounds):
+        """
+        :returns: the events in the segments of this table that match the query. Segments are
+        loaded (and queried) a batch at a time. Unless the query is ordered by time, batches can
+        overlap in order, so the (sorted) results of every batch are merged.
+        :rtype: generator(memdam.common.event.Event)
+        """
+        with self._connection(table_name, read_only=True) as conn:
+            cur = conn.cursor()
+            if not self._has_segments(cur, table_name):
+                return
+            columns = _sealable_columns(self._table_columns(cur, table_name))
+            segments = memdam.eventstore.segment.find(cur, table_name, *time_bounds)
+        sql, args, _ = self._find_sql(table_name, query, columns)
+        ordered_by_time = not query.order or query.order[0][0].lower() == u'time__time'
+        batches = memdam.eventstore.segment.batches(segments, ordered_by_time)
+        if query.order and query.order[0][1] == False:
+            batches.reverse()
+        if ordered_by_time or len(batches) <= 1:
+            for segment_ids in batches:
+                for event in self._find_in_segments(table_name, segment_ids, columns, sql, args):
+                    yield event
+            return
+        #each batch is loaded and queried in turn, so only their results are ever in memory at once
+        batch_results = [list(self._find_in_segments(table_name, segment_ids, columns, sql, args)) \
+                         for segment_ids in batches]
+        sort_key = make_sort_key(query.order)
+        for event in memdam.eventstore.merge.merge_sorted(batch_results, key=sort_key, limit=query.limit):
+            yield event
+
+    def _find_in_segments(self, table_name, segment_ids, columns, sql, args):
+        """
+        :param columns: see _sealable_columns
+        :param sql: the query (see _find_sql), run against a table with just the events in these segments
+        :returns: the events in these segments that match the query
+        :rtype: generator(memdam.common.event.Event)
+        """
+        names = list(columns)
+        with self._connection(table_name, read_only=True) as conn:
+            rows = memdam.eventstore.segment.load_rows(conn.cursor(), table_name, segment_ids, names)
+        memory_conn = memdam.eventstore.segment.memory_table(table_name, columns, names, rows)
+        try:
+            cur = memory_conn.cursor()
+            execute_sql(cur, sql, args)
+            result_names = [x[0] for x in cur.description]
+            namespace = table_name_to_namespace(table_name)
+            for row in cur:
+                yield _create_event_from_row(row, result_names, namespace, {})
+        finally:
+            memory_conn.close()
+
+    def _find_sql(self, table_name, query, columns):
+        """
+        :param columns: the columns in the table
+        :type  columns: dict(string, SqliteColumn)
+        :returns: the statement that selects the rows that match the query, its parameters, and the
+        field filters that it was compiled from
+        :rtype: tuple(string, tuple, list(memdam.common.query.QueryFilter))
+        """
         namespace = table_name_to_namespace(table_name)
-        cur = conn.cursor()
-        args = ()
         sql = "SELECT * FROM %s" % (table_name)
+        #namespace filters were already handled by choosing which tables to look in
         field_filters, _ = _separate_filters(query.filters)
-        if field_filters:
-            filter_string, new_args = _get_field_filter_string(field_filters)
-            args = args + new_args
+        filter_string, args = self._compiler.compile(field_filters, columns, namespace, table_name)
+        if filter_string:
             sql += " WHERE " + filter_string
         if query.order:
-            order_string = self._get_order_string(query.order)
-            sql += " ORDER BY " + order_string
+            order_string = self._get_order_string(query.order, columns)
+            if order_string:
+                sql += " ORDER BY " + order_string
         if query.limit:
-            sql += " LIMIT " + str(long(query.limit))
-        sql += ';'
-        execute_sql(cur, sql, args)
-        events = []
-        names = list(map(lambda x: x[0], cur.description))
-        for row in cur.fetchall():
-            events.append(_create_event_from_row(row, names, namespace, conn))
-        return events
+            #no single table can ever need to contribute more than the limit
+            sql += " LIMIT ?"
+            args = args + (long(query.limit),)
+        return sql + ';', args, field_filters
+
+    def _search_table(self, table_name, query, rank_filter, column):
+        """
+        :param rank_filter: the match filter that decides the rank of each event
+        :type  rank_filter: memdam.common.query.QueryFilter
+        :param column: the TEXT field that rank_filter searches
+        :type  column: string
+        :returns: the events in this table that match the query, best matches first
+        :rtype: generator(memdam.common.query.SearchResult)
+        """
+        with self._connection(table_name, read_only=True) as conn:
+            namespace = table_name_to_namespace(table_name)
+            cur = conn.cursor()
+            columns = self._table_columns(cur, table_name)
+            if column not in columns:
+                return
+            #the fts table has to drive the query so that matchinfo and snippet work (and they only
+            #accept the real name of the table, not an alias)
+            docs_table = "%s__%s__docs" % (table_name, column)
+            sql = "SELECT %s.*, %s(matchinfo(%s, 'pcnx')) AS _rank, snippet(%s, ?, ?, ?, -1, ?) AS _snippet " \
+                  "FROM %s JOIN %s ON %s._id = %s.docid WHERE %s.data MATCH ?" % \
+                  (table_name, RANK_FUNCTION, docs_table, docs_table, docs_table, table_name, table_name, docs_table, docs_table)
+            args = (Eventstore.SNIPPET_START, Eventstore.SNIPPET_END, Eventstore.SNIPPET_ELLIPSIS,
+                    Eventstore.SNIPPET_TOKENS, rank_filter.rhs)
+            field_filters, _ = _separate_filters(query.filters)
+            other_filters = [f for f in field_filters if f is not rank_filter]
+            filter_string, filter_args = self._compiler.compile(other_filters, columns, namespace, table_name)
+            if filter_string:
+                sql += " AND " + filter_string
+                args = args + filter_args
+            sql += " ORDER BY _rank DESC"
+            page_size = Eventstore.PAGE_SIZE
+            if query.limit:
+                sql += " LIMIT ?"
+                args = args + (long(query.limit),)
+                page_size = min(page_size, long(query.limit))
+            execute_sql(cur, sql + ";", args)
+            #everything except for the rank and the snippet
+            names = [x[0] for x in cur.description][:-2]
+            text_cur = conn.cursor()
+            staged_columns = self._staged_columns(text_cur, table_name)
+            while True:
+                rows = cur.fetchmany(page_size)
+                if len(rows) <= 0:
+                    break
+                texts = _load_text_fields(text_cur, table_name, names, rows, staged_columns)
+                for row in rows:
+                    event = _create_event_from_row(row, names, namespace, texts)
+                    yield memdam.common.query.SearchResult(event, row[-2], {column: row[-1]})
+
+    def _aggregate_table(self, table_name, query, accumulator):
+        """
+        Calculate the partial results for the query in this table, and add them to the accumulator
+        """
+        with self._connection(table_name, read_only=True) as conn:
+            cur = conn.cursor()
+            columns = self._table_columns(cur, table_name)
+            sql, args, field_filters = self._aggregate_sql(table_name, query, columns)
+            execute_sql(cur, sql, args)
+            self._advisor.observe(conn.cursor(), table_name, sql, args, field_filters, columns)
+            for row in cur.fetchall():
+                accumulator.add(row[0], row[1], row[2:])
+
+    def _aggregate_sealed(self, table_name, query, accumulator, time_bounds):
+        """
+        Calculate the partial results for the query in the segments of this table, and add them to
+        the accumulator. Only the columns that the query needs are loaded.
+        """
+        with self._connection(table_name, read_only=True) as conn:
+            cur = conn.cursor()
+            if not self._has_segments(cur, table_name):
+                return
+            columns = self._table_columns(cur, table_name)
+            segments = memdam.eventstore.segment.find(cur, table_name, *time_bounds)
+        field_filters, _ = _separate_filters(query.filters)
+        needed = memdam.eventstore.compiler.referenced_columns(field_filters)
+        needed.add(u'time__time')
+        needed.add(query.group_by)
+        needed.update(field for _, field in query.aggregates)
+        columns = dict((name, column) for name, column in _sealable_columns(columns).items() if name in needed)
+        names = list(columns)
+        sql, args, _ = self._aggregate_sql(table_name, query, columns)
+        for segment_ids in memdam.eventstore.segment.batches(segments, False):
+            with self._connection(table_name, read_only=True) as conn:
+                rows = memdam.eventstore.segment.load_rows(conn.cursor(), table_name, segment_ids, names)
+            memory_conn = memdam.eventstore.segment.memory_table(table_name, columns, names, rows)
+            try:
+                cur = memory_conn.cursor()
+                execute_sql(cur, sql, args)
+                for row in cur.fetchall():
+                    accumulator.add(row[0], row[1], row[2:])
+            finally:
+                memory_conn.close()
+
+    def _aggregate_sql(self, table_name, query, columns):
+        """
+        :param columns: the columns in the table
+        :type  columns: dict(string, SqliteColumn)
+        :returns: the statement that calculates the partial results for the query, its parameters,
+        and the field filters that it was compiled from
+        :rtype: tuple(string, tuple, list(memdam.common.query.QueryFilter))
+        """
+        namespace = table_name_to_namespace(table_name)
+        def column_sql(name):
+            """:returns: the column, or NULL if this table doesn't have it"""
+            if name in columns:
+                return name
+            return "NULL"
+        expressions = []
+        args = ()
+        if query.bucket is None:
+            expressions.append("NULL")
+        else:
+            #note: integer division rounds towards 0, so this is only right for times after 1970
+            expressions.append("time__time / ?")
+            args = args + (_seconds_to_long(query.bucket),)
+        if query.group_by is None:
+            expressions.append("NULL")
+        elif query.group_by in memdam.eventstore.compiler.NAMESPACE_FIELDS:
+            expressions.append("?")
+            args = args + (namespace,)
+        else:
+            expressions.append(column_sql(query.group_by))
+        for function, field in query.aggregates:
+            if field is None:
+                expressions.extend(memdam.eventstore.aggregate.partial_sql(function, None))
+            else:
+                expressions.extend(memdam.eventstore.aggregate.partial_sql(function, column_sql(field)))
+        sql = "SELECT %s FROM %s" % (", ".join(expressions), table_name)
+        field_filters, _ = _separate_filters(query.filters)
+        filter_string, filter_args = self._compiler.compile(field_filters, columns, namespace, table_name)
+        if filter_string:
+            sql += " WHERE " + filter_string
+            args = args + filter_args
+        sql += " GROUP BY 1, 2;"
+        return sql, args, field_filters
+
+    def _aggregate_rollups(self, table_name, query, accumulator):
+        """
+        Calculate the partial results for the query from the rollups for this table, if possible.
+
+        :returns: False if the events have to be read instead
+        :rtype: bool
+        """
+        if not self._rollups:
+            return False
+        field_filters, _ = _separate_filters(query.filters)
+        grain = memdam.eventstore.rollup.choose_grain(query, field_filters)
+        if grain is None:
+            return False
+        with self._connection(table_name, read_only=True) as conn:
+            cur = conn.cursor()
+            if not self._has_rollups(cur, table_name):
+                return False
+            namespace = table_name_to_namespace(table_name)
+            memdam.eventstore.rollup.aggregate(cur, table_name, namespace, query, field_filters, grain, accumulator)
+        return True
+
+    def _has_rollups(self, cur, table_name):
+        """
+        Whether or not rollups are turned on for this Eventstore, once they have been created (by any
+        Eventstore on the same folder) they have to be kept up to date, or they would be wrong the
+        next time that they are used. Only tables that have rollups are remembered, since another
+        Eventstore might create them at any time.
 
-    def _get_order_string(self, order):
+        :returns: True iff rollups have been created for this table (and it is not being bulk loaded)
+        :rtype: bool
+        """
+        if table_name in self._bulk_tables:
+            return False
+        if table_name in self._rollup_tables:
+            return True
+        if memdam.eventstore.rollup.exists(cur, table_name):
+            self._rollup_tables.add(table_name)
+            return True
+        return False
+
+    def _ensure_rollups(self, table_name):
+        """
+        Create the rollups for this table if they don't exist yet. Creating them and filling them
+        in from the existing events happens in one transaction, so no events can be missed.
+        """
+        if table_name in self._rollup_tables:
+            return
+        with self._schema_transaction(table_name) as cur:
+            if not memdam.eventstore.rollup.exists(cur, table_name):
+                memdam.log().info("Creating rollups for %s" % (table_name))
+                memdam.eventstore.rollup.create(cur, table_name, self._table_columns(cur, table_name),
+                                                self._sealed_events(cur, table_name))
+        self._rollup_tables.add(table_name)
+
+    def _has_segments(self, cur, table_name):
+        """
+        :returns: True iff some events in this table have been sealed
+        :rtype: bool
+        """
+        if table_name in self._segment_tables:
+            return True
+        if memdam.eventstore.segment.exists(cur, table_name):
+            self._segment_tables.add(table_name)
+            return True
+        return False
+
+    def _sealed_events(self, cur, table_name):
+        """
+        :returns: the sealed argument for memdam.eventstore.rollup (None if there are no segments):
+        function(start, end) -> lists of the sealed events between those times, one per segment
+        :rtype: function
+        """
+        if not self._has_segments(cur, table_name):
+            return None
+        namespace = table_name_to_namespace(table_name)
+        names = list(self._table_columns(cur, table_name))
+        time_index = names.index(u'time__time')
+        def sealed(start, end):
+            for segment_id, _, _, _ in memdam.eventstore.segment.find(cur, table_name, start, end):
+                rows = memdam.eventstore.segment.load_rows(cur, table_name, [segment_id], names)
+                yield [_create_event_from_row(row, names, namespace, {}) for row in rows \
+                       if (start is None or row[time_index] >= start) and (end is None or row[time_index] < end)]
+        return sealed
+
+    def _has_changes(self, cur, table_name):
+        """
+        Whether or not the change feed is turned on for this Eventstore, once it has been created (by
+        any Eventstore on the same folder) every change has to be recorded, or its consumers would
+        never see them. Only tables that have a feed are remembered, since another Eventstore might
+        create one at any time.
+
+        :returns: True iff the change feed has been created for this table
+        :rtype: bool
+        """
+        if table_name in self._change_tables:
+            return True
+        if memdam.eventstore.changelog.exists(cur, table_name):
+            self._change_tables.add(table_name)
+            return True
+        return False
+
+    def _ensure_changes(self, table_name):
+        """
+        Create the change feed for this table if it doesn't exist yet, starting with every event that
+        is already there. Happens in one transaction, so no changes can be missed.
+        """
+        if table_name in self._change_tables:
+            return
+        with self._schema_transaction(table_name) as cur:
+            if not memdam.eventstore.changelog.exists(cur, table_name):
+                memdam.log().info("Creating the change feed for %s" % (table_name))
+                sealed_ids = []
+                if self._has_segments(cur, table_name):
+                    segment_ids = [segment[0] for segment in memdam.eventstore.segment.find(cur, table_name)]
+                    sealed_ids = [row[0] for row in memdam.eventstore.segment.load_rows(cur, table_name, segment_ids, [u'id__id'])]
+                memdam.eventstore.changelog.create(cur, table_name, sealed_ids)
+        self._change_tables.add(table_name)
+
+    @contextlib.contextmanager
+    def _schema_transaction(self, table_name):
+        """
+        Use as a context manager for a write transaction that also changes the schema. Yields a
+        cursor, and commits iff the block finishes. sqlite3 would otherwise commit before every
+        CREATE and DROP, so a failure could leave the changes half done.
+        """
+        with self._connection(table_name, read_only=False) as conn:
+            cur = conn.cursor()
+            isolation_level = conn.isolation_level
+            conn.isolation_level = None
+            try:
+                self._begin_write(cur, table_name)
+                try:
+                    yield cur
+                    cur.execute("COMMIT")
+                except:
+                    cur.execute("ROLLBACK")
+                    raise
+            finally:
+                conn.isolation_level = isolation_level
+
+    def _staged_columns(self, cur, table_name):
+        """
+        The bulk load may belong to another Eventstore (or process) using the same folder, so unless
+        it is one of ours, this is read from the bulk load state in the table file (which is changed
+        in the same transactions as the staging tables).
+
+        :param cur: a cursor for the table, inside of the transaction that will use the result
+        :type  cur: sqlite3.Cursor
+        :returns: the TEXT columns of the table whose documents are being staged by a bulk load
+        :rtype: frozenset(string)
+        """
+        bulk_table = self._bulk_tables.get(table_name)
+        if bulk_table is not None:
+            return bulk_table[1]
+        execute_sql(cur, "SELECT name FROM sqlite_master WHERE type='table' AND name = ?;", (Eventstore.BULK_LOAD_STATE_TABLE,))
+        if len(cur.fetchall()) <= 0:
+            return frozenset()
+        execute_sql(cur, "SELECT DISTINCT object FROM %s WHERE table_name = ? AND kind = 'docs';" % \
+                    (Eventstore.BULK_LOAD_STATE_TABLE), (table_name,))
+        return frozenset(row[0] for row in cur.fetchall())
+
+    def _bulk_save(self, name, events):
+        """
+        Save events as part of a bulk load, putting each table into bulk mode the first time
+        """
+        sorted_events = sorted(events, key=self._table_name_for_event)
+        for table_name, grouped_events in itertools.groupby(sorted_events, self._table_name_for_event):
+            self._save_events(list(grouped_events), table_name, bulk_load=name)
+
+    def _begin_bulk_table(self, name, table_name, text_columns):
+        """
+        Stop maintaining the secondary indices of a table, and stage the documents for these TEXT
+        columns instead of adding them to the fts tables. What was changed is recorded in the table
+        itself (in the same transaction), so that it can always be undone, even after a crash.
+        """
+        with self._bulk_lock:
+            assert self._bulk_tables.get(table_name, (name,))[0] == name, "%s is already part of another bulk load" % (table_name)
+        #recorded first, so that the bulk load never forgets about a table that it has changed
+        with self._connection(Eventstore.ID_INDEX_TABLE, read_only=False) as conn:
+            cur = conn.cursor()
+            self._begin_write(cur, Eventstore.ID_INDEX_TABLE)
+            execute_sql(cur, "INSERT OR IGNORE INTO %s (name, table_name) VALUES (?, ?);" % (Eventstore.BULK_LOAD_TABLES_TABLE), (name, table_name))
+            conn.commit()
+        with self._schema_transaction(table_name) as cur:
+            _create_bulk_load_state(cur)
+            execute_sql(cur, "SELECT name, sql FROM sqlite_master WHERE type='index' AND tbl_name = ? AND sql IS NOT NULL;", (table_name,))
+            for index_name, index_sql in cur.fetchall():
+                #needed to replace events that are already there
+                if index_name.lower() == _unique_id_index_name(table_name).lower():
+                    continue
+                execute_sql(cur, "INSERT INTO %s (name, table_name, kind, object, sql) VALUES (?, ?, 'index', ?, ?);" % \
+                            (Eventstore.BULK_LOAD_STATE_TABLE), (name, table_name, index_name, index_sql))
+                execute_sql(cur, "DROP INDEX %s;" % (index_name))
+            for column in text_columns:
+                execute_sql(cur, "CREATE TABLE IF NOT EXISTS %s(docid INTEGER PRIMARY KEY, data);" % (_staged_docs_table_name(table_name, column)))
+                execute_sql(cur, "DELETE FROM %s WHERE name = ? AND table_name = ? AND kind = 'docs' AND object = ?;" % \
+                            (Eventstore.BULK_LOAD_STATE_TABLE), (name, table_name, column))
+                execute_sql(cur, "INSERT INTO %s (name, table_name, kind, object) VALUES (?, ?, 'docs', ?);" % \
+                            (Eventstore.BULK_LOAD_STATE_TABLE), (name, table_name, column))
+            self._catalog.update(table_name, self._table_columns(cur, table_name).values(), self._query_existing_indices(cur, table_name))
+        self._advisor.forget(table_name)
+        with self._bulk_lock:
+            staged_columns = self._bulk_tables.get(table_name, (name, frozenset()))[1]
+            self._bulk_tables[table_name] = (name, staged_columns.union(text_columns))
+
+    def _finish_bulk_table(self, name, table_name):
+        """
+        Move the staged documents into the fts tables, recreate the indices, and rebuild the rollups
+        of a table, all in one transaction. Then optimize the fts tables.
+        """
+        text_columns = []
+        if self._table_exists(table_name):
+            with self._schema_transaction(table_name) as cur:
+                _create_bulk_load_state(cur)
+                execute_sql(cur, "SELECT kind, object, sql FROM %s WHERE name = ? AND table_name = ?;" % \
+                            (Eventstore.BULK_LOAD_STATE_TABLE), (name, table_name))
+                for kind, obj, obj_sql in cur.fetchall():
+                    if kind == 'docs':
+                        staged_table = _staged_docs_table_name(table_name, obj)
+                        #skip documents of events that were deleted or replaced by a save from outside of the bulk load
+                        docs_table = "%s__%s__docs" % (table_name, obj)
+                        execute_sql(cur, "INSERT INTO %s (docid, data) SELECT docid, data FROM %s WHERE docid IN (SELECT _id FROM %s) "
+                                         "AND docid NOT IN (SELECT docid FROM %s);" % (docs_table, staged_table, table_name, docs_table))
+                        execute_sql(cur, "DROP TABLE %s;" % (staged_table))
+                        text_columns.append(obj)
+                    else:
+                        memdam.log().info("Rebuilding index %s" % (obj))
+                        execute_sql(cur, obj_sql)
+                if memdam.eventstore.rollup.exists(cur, table_name):
+                    memdam.eventstore.rollup.rebuild(cur, table_name, self._table_columns(cur, table_name),
+                                                     self._sealed_events(cur, table_name))
+                execute_sql(cur, "DELETE FROM %s WHERE name = ? AND table_name = ?;" % (Eventstore.BULK_LOAD_STATE_TABLE), (name, table_name))
+                self._catalog.update(table_name, self._table_columns(cur, table_name).values(), self._query_existing_indices(cur, table_name))
+            with self._connection(table_name, read_only=False) as conn:
+                cur = conn.cursor()
+                for column in text_columns:
+                    execute_sql(cur, "INSERT INTO %s__%s__docs (%s__%s__docs) VALUES ('optimize');" % (table_name, column, table_name, column))
+                conn.commit()
+        self._advisor.forget(table_name)
+        with self._bulk_lock:
+            self._bulk_tables.pop(table_name, None)
+        with self._connection(Eventstore.ID_INDEX_TABLE, read_only=False) as conn:
+            cur = conn.cursor()
+            self._begin_write(cur, Eventstore.ID_INDEX_TABLE)
+            execute_sql(cur, "DELETE FROM %s WHERE name = ? AND table_name = ?;" % (Eventstore.BULK_LOAD_TABLES_TABLE), (name, table_name))
+            conn.commit()
+
+    def _finish_bulk_load(self, name):
+        """
+        Take every table out of bulk mode, then forget about the bulk load
+        """
+        with self._connection(Eventstore.ID_INDEX_TABLE, read_only=True) as conn:
+            cur = conn.cursor()
+            execute_sql(cur, "SELECT table_name FROM %s WHERE name = ?;" % (Eventstore.BULK_LOAD_TABLES_TABLE), (name,))
+            table_names = [row[0] for row in cur.fetchall()]
+        for table_name in table_names:
+            self._finish_bulk_table(name, table_name)
+        with self._connection(Eventstore.ID_INDEX_TABLE, read_only=False) as conn:
+            cur = conn.cursor()
+            self._begin_write(cur, Eventstore.ID_INDEX_TABLE)
+            execute_sql(cur, "DELETE FROM %s WHERE name = ?;" % (Eventstore.BULK_LOADS_TABLE), (name,))
+            conn.commit()
+
+    def _save_bulk_checkpoint(self, name, checkpoint):
+        """
+        Record how far the bulk load has gotten. Only call once everything before it is committed.
+        """
+        with self._connection(Eventstore.ID_INDEX_TABLE, read_only=False) as conn:
+            cur = conn.cursor()
+            self._begin_write(cur, Eventstore.ID_INDEX_TABLE)
+            execute_sql(cur, "UPDATE %s SET checkpoint = ? WHERE name = ?;" % (Eventstore.BULK_LOADS_TABLE), (checkpoint, name))
+            conn.commit()
+
+    def _get_order_string(self, order, columns):
+        """
+        :param columns: the columns that actually exist in the table. Every row has NULL for any
+        other column, so those (and type__namespace, which is constant within a table) can't affect
+        the order and are left out.
+        :type  columns: dict(string, SqliteColumn)
+        :returns: the ORDER BY clause (without ORDER BY), or the empty string if there is nothing to
+        order by
+        :rtype: string
+        """
         sql_order_elems = []
         for elem in order:
             order_type = 'ASC'
@@ -137,9 +1116,23 @@ class Eventstore(memdam.eventstore.api.Eventstore):
             safe_column_name = elem[0].lower()
             assert SqliteColumn.SQL_NAME_REGEX.match(safe_column_name), "Invalid name for column: %s" % (safe_column_name)
             assert memdam.common.event.Event.field_type(safe_column_name) != memdam.common.field.FieldType.TEXT, "text keys are currently unsupported for ordering. Doesn't make a lot of sense."
+            if safe_column_name not in columns:
+                continue
             sql_order_elems.append("%s %s" % (safe_column_name, order_type))
         return ", ".join(sql_order_elems)
 
+    def _table_columns(self, cur, table_name):
+        """
+        :returns: the columns in the table, from the catalog if possible
+        :rtype: dict(string, SqliteColumn)
+        """
+        columns = self._catalog.columns(table_name)
+        if columns is None:
+            existing_columns = self._query_existing_columns(cur, table_name)
+            self._catalog.update(table_name, existing_columns.values(), self._query_existing_indices(cur, table_name))
+            columns = self._catalog.columns(table_name)
+        return columns
+
     def _all_table_names(self):
         """
         :returns: the names of all tables
@@ -147,43 +1140,265 @@ class Eventstore(memdam.eventstore.api.Eventstore):
         """
         if self.folder == ":memory:":
             #list all tables that are not "__docs"
-            conn = self._get_or_create_memory_connection()
-            cur = conn.cursor()
-            execute_sql(cur, "SELECT * FROM sqlite_master WHERE type='table';")
-            tables = []
-            for row in cur.fetchall():
-                table_name = row[1]
-                if not "__docs" in table_name:
-                    tables.append(table_name)
+            with self._memory_connection() as conn:
+                cur = conn.cursor()
+                execute_sql(cur, "SELECT * FROM sqlite_master WHERE type='table';")
+                tables = []
+                for row in cur.fetchall():
+                    table_name = row[1]
+                    #also skip our own bookkeeping tables, like the id index, rollups, segments and
+                    #change feeds, and the ones that sqlite makes for itself
+                    if not "__docs" in table_name and not table_name.startswith('_') and \
+                       not table_name.startswith('sqlite_') and \
+                       not memdam.eventstore.rollup.is_rollup_table(table_name) and \
+                       not memdam.eventstore.segment.is_segment_table(table_name) and \
+                       not memdam.eventstore.changelog.is_changes_table(table_name):
+                        tables.append(table_name)
         else:
             tables = [r[:-1*len(Eventstore.EXTENSION)] for r in list(os.listdir(self.folder)) if r.endswith(Eventstore.EXTENSION)]
         return [unicode(r) for r in tables]
 
-    def _get_or_create_memory_connection(self):
+    def _table_file(self, table_name):
+        """
+        :returns: the path to the file for this table (only meaningful when not in memory)
+        :rtype: string
+        """
+        if table_name == Eventstore.ID_INDEX_TABLE:
+            return os.path.join(self.folder, table_name + Eventstore.ID_INDEX_EXTENSION)
+        return os.path.join(self.folder, table_name + Eventstore.EXTENSION)
+
+    def _table_exists(self, table_name):
+        """
+        Checked before following the id index to a table, so that a stale entry can't cause an empty
+        table file to be created.
+        """
+        if self._catalog.columns(table_name) is not None:
+            return True
+        if self.folder == ":memory:":
+            with self._memory_connection() as conn:
+                cur = conn.cursor()
+                execute_sql(cur, "SELECT name FROM sqlite_master WHERE type='table' AND name = ?;", (table_name,))
+                return len(cur.fetchall()) > 0
+        return os.path.exists(self._table_file(table_name))
+
+    def _get_events_from_table(self, table_name, event_ids):
+        """
+        :returns: the events in this table with any of these ids (in no particular order)
+        :rtype: list(memdam.common.event.Event)
+        """
+        if not self._table_exists(table_name):
+            return []
+        events = []
+        with self._connection(table_name, read_only=True) as conn:
+            namespace = table_name_to_namespace(table_name)
+            cur = conn.cursor()
+            staged_columns = self._staged_columns(cur, table_name)
+            for start in range(0, len(event_ids), MAX_SQL_VARIABLES):
+                batch = event_ids[start:start+MAX_SQL_VARIABLES]
+                sql = "SELECT * FROM %s WHERE id__id IN (%s);" % (table_name, ", ".join(['?'] * len(batch)))
+                execute_sql(cur, sql, [buffer(event_id.bytes) for event_id in batch])
+                names = [x[0] for x in cur.description]
+                rows = cur.fetchall()
+                texts = _load_text_fields(conn.cursor(), table_name, names, rows, staged_columns)
+                events.extend(_create_event_from_row(row, names, namespace, texts) for row in rows)
+            missing_ids = set(event_ids).difference(event.id__id for event in events)
+            if len(missing_ids) > 0 and self._has_segments(cur, table_name):
+                events.extend(self._get_sealed_events(cur, table_name, missing_ids))
+        return events
+
+    def _get_sealed_events(self, cur, table_name, event_ids):
+        """
+        :returns: the events in the segments of this table with any of these ids. Has to look at
+        the ids in every segment.
+        :rtype: list(memdam.common.event.Event)
+        """
+        id_bytes = set(event_id.bytes for event_id in event_ids)
+        namespace = table_name_to_namespace(table_name)
+        names = list(self._table_columns(cur, table_name))
+        id_index = names.index(u'id__id')
+        events = []
+        for segment_id, _, _, _ in memdam.eventstore.segment.find(cur, table_name):
+            rows = memdam.eventstore.segment.load_rows(cur, table_name, [segment_id], [u'id__id'])
+            if not any(str(row[0]) in id_bytes for row in rows):
+                continue
+            for row in memdam.eventstore.segment.load_rows(cur, table_name, [segment_id], names):
+                if str(row[id_index]) in id_bytes:
+                    events.append(_create_event_from_row(row, names, namespace, {}))
+        return events
+
+    def _lookup_tables(self, event_ids):
+        """
+        :returns: the name of the table that each of these events is in, according to the id index.
+        Events that are not in the index do not exist, and are left out.
+        :rtype: dict(uuid.UUID, unicode)
+        """
+        self._ensure_id_index()
+        table_names = {}
+        with self._connection(Eventstore.ID_INDEX_TABLE, read_only=True) as conn:
+            cur = conn.cursor()
+            for start in range(0, len(event_ids), MAX_SQL_VARIABLES):
+                batch = event_ids[start:start+MAX_SQL_VARIABLES]
+                sql = "SELECT id__id, table_name FROM %s WHERE id__id IN (%s);" % (Eventstore.ID_INDEX_TABLE, ", ".join(['?'] * len(batch)))
+                execute_sql(cur, sql, [buffer(event_id.bytes) for event_id in batch])
+                for row in cur.fetchall():
+                    table_names[uuid.UUID(bytes=str(row[0]))] = row[1]
+        return table_names
+
+    def _index_events(self, table_name, events):
+        """
+        Record that these events are (about to be) stored in this table
+        """
+        self._ensure_id_index()
+        values = [(buffer(event.id__id.bytes), table_name) for event in events]
+        with self._connection(Eventstore.ID_INDEX_TABLE, read_only=False) as conn:
+            cur = conn.cursor()
+            self._begin_write(cur, Eventstore.ID_INDEX_TABLE)
+            sql = "INSERT OR REPLACE INTO %s (id__id, table_name) VALUES (?, ?);" % (Eventstore.ID_INDEX_TABLE)
+            execute_many(cur, sql, values)
+            conn.commit()
+
+    def _unindex_events(self, event_ids):
+        """
+        Forget about these events. Only call this after they have been deleted.
+        """
+        self._ensure_id_index()
+        values = [(buffer(event_id.bytes),) for event_id in event_ids]
+        with self._connection(Eventstore.ID_INDEX_TABLE, read_only=False) as conn:
+            cur = conn.cursor()
+            self._begin_write(cur, Eventstore.ID_INDEX_TABLE)
+            sql = "DELETE FROM %s WHERE id__id = ?;" % (Eventstore.ID_INDEX_TABLE)
+            execute_many(cur, sql, values)
+            conn.commit()
+
+    def _unindex_table(self, table_name):
+        """
+        Forget about every event in this table. Only call this after the table is gone.
+        """
+        self._ensure_id_index()
+        with self._connection(Eventstore.ID_INDEX_TABLE, read_only=False) as conn:
+            cur = conn.cursor()
+            self._begin_write(cur, Eventstore.ID_INDEX_TABLE)
+            execute_sql(cur, "DELETE FROM %s WHERE table_name = ?;" % (Eventstore.ID_INDEX_TABLE), (table_name,))
+            conn.commit()
+
+    def _ensure_id_index(self):
+        """
+        Make sure that the id index exists. If the folder doesn't have one yet, it is built from all
+        of the existing tables, using the same lock and rename approach as table creation so that
+        other processes never see a half-built index.
+        """
+        if self._id_index_ready:
+            return
+        with self._id_index_lock:
+            if self._id_index_ready:
+                return
+            if self.folder == ":memory:":
+                with self._memory_connection() as conn:
+                    _create_id_index(conn.cursor())
+                    conn.commit()
+            else:
+                index_file = self._table_file(Eventstore.ID_INDEX_TABLE)
+                if not os.path.exists(index_file):
+                    lock_file = os.path.join(self.folder, Eventstore.ID_INDEX_TABLE + Eventstore.LOCK_EXTENSION)
+                    with lockfile.LockFile(lock_file):
+                        if not os.path.exists(index_file):
+                            temp_index_file = os.path.join(self.folder, Eventstore.ID_INDEX_TABLE + Eventstore.CREATE_ID_INDEX_EXTENSION)
+                            conn = sqlite3.connect(temp_index_file, isolation_level="EXCLUSIVE")
+                            try:
+                                cur = conn.cursor()
+                                _create_id_index(cur)
+                                self._backfill_id_index(cur)
+                                conn.commit()
+                            finally:
+                                conn.close()
+                            os.rename(temp_index_file, index_file)
+            self._id_index_ready = True
+
+    def _backfill_id_index(self, index_cur):
+        """
+        Add every event in every existing table to the index
+        """
+        sql = "INSERT OR REPLACE INTO %s (id__id, table_name) VALUES (?, ?);" % (Eventstore.ID_INDEX_TABLE)
+        for table_name in self._all_table_names():
+            with self._connection(table_name, read_only=True) as conn:
+                cur = conn.cursor()
+                execute_sql(cur, "SELECT id__id FROM %s;" % (table_name))
+                execute_many(index_cur, sql, ((row[0], table_name) for row in cur if row[0] != None))
+
+    @contextlib.contextmanager
+    def _memory_connection(self):
+        """
+        There is only one in-memory database, so every thread has to share the same connection.
+        Holds a lock for as long as the connection is in use.
+        """
         assert self.folder == ":memory:"
-        #TODO: when all tests are passing again, do we need memory_connection at all? I don't think so...
-        if self.memory_connection == None:
-            self.memory_connection = sqlite3.connect(self.folder, isolation_level="EXCLUSIVE")
-        return self.memory_connection
+        with self._memory_lock:
+            if self.memory_connection == None:
+                self.memory_connection = sqlite3.connect(self.folder, isolation_level="EXCLUSIVE", check_same_thread=False,
+                                                         cached_statements=Eventstore.CACHED_STATEMENTS)
+                self.memory_connection.create_function(RANK_FUNCTION, 1, _rank_match)
+            yield self.memory_connection
 
-    def _connect(self, table_name, read_only=True):
+    def _connection(self, table_name, read_only=True):
         """
-        Connect to the database with this namespace in it.
+        Use as a context manager to borrow a connection to the database with this namespace in it.
+        The connection goes back to the pool when the block exits.
         """
         if self.folder == ":memory:":
-            return self._get_or_create_memory_connection()
-        db_file = os.path.join(self.folder, table_name + Eventstore.EXTENSION)
+            return self._memory_connection()
+        return self._pool.connection(table_name, read_only=read_only)
+
+    def _open_connection(self, table_name, read_only):
+        """
+        Actually open a new connection to the database with this namespace in it. Only called by
+        the ConnectionPool.
+        """
+        db_file = self._table_file(table_name)
         if read_only:
-            conn = sqlite3.connect(db_file, isolation_level="DEFERRED")
-            #TODO: set PRAGMA read_uncommitted = TRUE;
-            #otherwise can't read while writing
-            return conn
+            #note: unless wal is enabled, can't read while writing
+            isolation_level = "DEFERRED"
         else:
-            return sqlite3.connect(db_file, isolation_level="EXCLUSIVE")
+            isolation_level = "EXCLUSIVE"
+        conn = sqlite3.connect(db_file, isolation_level=isolation_level, timeout=self._busy_timeout, check_same_thread=False,
+                               cached_statements=Eventstore.CACHED_STATEMENTS)
+        conn.create_function(RANK_FUNCTION, 1, _rank_match)
+        cur = conn.cursor()
+        if self._wal:
+            #journal_mode is persistent, so this is a no-op for every file except the first time
+            execute_sql(cur, "PRAGMA journal_mode = WAL;")
+            #checkpoints are handled by the Checkpointer, not by whoever happens to be committing
+            execute_sql(cur, "PRAGMA wal_autocheckpoint = 0;")
+        if self._synchronous != None:
+            execute_sql(cur, "PRAGMA synchronous = %s;" % (self._synchronous))
+        return conn
 
-    def _save_events(self, events, table_name):
+    def _begin_write(self, cur, table_name):
+        """
+        Start a write transaction. With write-ahead logging an IMMEDIATE transaction is enough to
+        keep out other writers, and readers are never blocked.
+        """
+        if self._wal:
+            cur.execute("BEGIN IMMEDIATE")
+            self._checkpointer.mark_dirty(table_name)
+        else:
+            cur.execute("BEGIN EXCLUSIVE")
+
+    def _checkpoint(self, table_name, mode='PASSIVE'):
+        """
+        Copy the write-ahead log back into the table file. Called from the Checkpointer thread.
+        """
+        if not os.path.exists(self._table_file(table_name)):
+            #the table was removed (eg, an old partition), so there is nothing left to checkpoint
+            return
+        with self._connection(table_name, read_only=True) as conn:
+            execute_sql(conn.cursor(), "PRAGMA wal_checkpoint(%s);" % (mode))
+
+    def _save_events(self, events, table_name, bulk_load=None):
         """
         Save all events of the same type to the database at once
+
+        :param bulk_load: the name of the bulk load that these events are part of, if any
+        :type  bulk_load: unicode
         """
         memdam.log().debug("Saving %s events to %s" % (len(events), table_name))
         if len(events) <= 0:
@@ -200,7 +1415,48 @@ class Eventstore(memdam.eventstore.api.Eventstore):
             if reserved_name in key_names:
                 key_names.remove(reserved_name)
 
-        should_update_columns = True
+        if not self._catalog.has_columns(table_name, key_names):
+            self._update_schema(table_name, key_names)
+        if _unique_id_index_name(table_name).lower() not in [name.lower() for name in self._catalog.indices(table_name)]:
+            self._add_unique_id_index(table_name)
+        if bulk_load is not None:
+            text_columns = set(_text_column_names(key_names))
+            if table_name not in self._bulk_tables or not text_columns.issubset(self._bulk_tables[table_name][1]):
+                self._begin_bulk_table(bulk_load, table_name, text_columns)
+        elif table_name not in self._bulk_tables:
+            missing_indices = self._missing_composite_indices(table_name)
+            if len(missing_indices) > 0:
+                self._create_indices(table_name, missing_indices)
+
+        if self._rollups:
+            self._ensure_rollups(table_name)
+        if self._changes:
+            self._ensure_changes(table_name)
+
+        #events that were already saved to this table may have been sealed since, and have to be
+        #taken out of their segments. That has to be checked before the new events are indexed.
+        saved_ids = frozenset()
+        with self._connection(table_name, read_only=True) as conn:
+            has_segments = self._has_segments(conn.cursor(), table_name)
+        if has_segments:
+            saved_ids = frozenset(event_id for event_id, saved_table_name in \
+                                  self._lookup_tables([event.id__id for event in events]).items() if saved_table_name == table_name)
+
+        #must be indexed before they are inserted, see the class docstring
+        self._index_events(table_name, events)
+
+        with self._connection(table_name, read_only=False) as conn:
+            cur = conn.cursor()
+            self._begin_write(cur, table_name)
+            self._insert_events(cur, events, key_names, table_name, saved_ids)
+            conn.commit()
+
+    def _update_schema(self, table_name, key_names):
+        """
+        Make sure that the table exists and has a column for every key name, then refresh the
+        catalog with the real schema. Only called when the catalog doesn't already know about all of
+        the columns, so the common write path never has to look at the schema at all.
+        """
         if self.folder != ":memory:":
             #does table not exist?
             db_file = os.path.join(self.folder, table_name + Eventstore.EXTENSION)
@@ -219,7 +1475,6 @@ class Eventstore(memdam.eventstore.api.Eventstore):
                             pass
                     #2. we got the lock BEFORE anyone else, so we're responsible for making the table:
                     else:
-                        should_update_columns = False
                         #make the table and create the columns
                         temp_db_file = os.path.join(self.folder, table_name + Eventstore.CREATE_TABLE_EXTENSION)
                         self._create_database(table_name, key_names, temp_db_file)
@@ -231,20 +1486,80 @@ class Eventstore(memdam.eventstore.api.Eventstore):
                         except:
                             pass
 
-        conn = self._connect(table_name, read_only=False)
-        if should_update_columns:
+        with self._connection(table_name, read_only=False) as conn:
             def update_columns():
                 cur = conn.cursor()
                 existing_columns = self._query_existing_columns(cur, table_name)
                 required_columns = self._generate_columns(cur, key_names, table_name)
-                self._update_columns(cur, existing_columns, required_columns)
+                if self._update_columns(cur, existing_columns, required_columns):
+                    existing_columns = self._query_existing_columns(cur, table_name)
+                self._catalog.update(table_name, existing_columns.values(), self._query_existing_indices(cur, table_name))
             #TODO: use the locking approach for updating as well as creating?
             execute_with_retries(update_columns, 5)
 
-        cur = conn.cursor()
-        cur.execute("BEGIN EXCLUSIVE")
-        self._insert_events(cur, events, key_names, table_name)
-        conn.commit()
+    def _add_unique_id_index(self, table_name):
+        """
+        Migrate a table from before id__id was unique: remove every duplicate event (keeping the one
+        that was saved last) and replace the old index with a unique one.
+        """
+        with self._connection(table_name, read_only=False) as conn:
+            cur = conn.cursor()
+            columns = self._table_columns(cur, table_name)
+            self._begin_write(cur, table_name)
+            execute_sql(cur, "SELECT _id FROM %s WHERE _id NOT IN (SELECT MAX(_id) FROM %s GROUP BY id__id);" % (table_name, table_name))
+            duplicate_rows = [(row[0],) for row in cur.fetchall()]
+            if len(duplicate_rows) > 0:
+                memdam.log().info("Removing %s duplicate events from %s" % (len(duplicate_rows), table_name))
+                for name in _text_column_names(columns):
+                    execute_many(cur, "DELETE FROM %s__%s__docs WHERE docid = ?;" % (table_name, name), duplicate_rows)
+                execute_many(cur, "DELETE FROM %s WHERE _id = ?;" % (table_name), duplicate_rows)
+            execute_sql(cur, "DROP INDEX IF EXISTS %s__id__id__asc;" % (table_name))
+            execute_sql(cur, "CREATE UNIQUE INDEX IF NOT EXISTS %s ON %s (id__id);" % (_unique_id_index_name(table_name), table_name))
+            conn.commit()
+            self._catalog.update(table_name, columns.values(), self._query_existing_indices(cur, table_name))
+
+    def _missing_composite_indices(self, table_name):
+        """
+        :returns: the columns of every composite index from the policy that the table should have,
+        but doesn't (yet). Indices are only created once all of their columns exist.
+        :rtype: list(tuple(string))
+        """
+        columns = self._catalog.columns(table_name)
+        #sqlite index names are case insensitive (and older tables may have been created with __ASC)
+        indices = set(name.lower() for name in self._catalog.indices(table_name))
+        missing = []
+        for index_columns in self._index_policy.composite_indices(table_name_to_namespace(table_name)):
+            if memdam.eventstore.indexing.index_name(table_name, index_columns).lower() in indices:
+                continue
+            if all(column in columns for column in index_columns):
+                missing.append(index_columns)
+        return missing
+
+    def _create_indices(self, table_name, indices):
+        """
+        :param indices: the columns of each index to create
+        :type  indices: list(tuple(string))
+        """
+        with self._connection(table_name, read_only=False) as conn:
+            cur = conn.cursor()
+            columns = self._table_columns(cur, table_name)
+            self._begin_write(cur, table_name)
+            for index_columns in indices:
+                name = memdam.eventstore.indexing.index_name(table_name, index_columns)
+                memdam.log().info("Creating index %s" % (name))
+                execute_sql(cur, "CREATE INDEX IF NOT EXISTS %s ON %s (%s);" % (name, table_name, ", ".join(index_columns)))
+            conn.commit()
+            self._catalog.update(table_name, columns.values(), self._query_existing_indices(cur, table_name))
+        self._advisor.forget(table_name)
+
+    def _build_advised_indices(self):
+        """
+        Create any indices that the advisor decided to build since the last time this was called.
+        Done before queries (rather than in the middle of one) so that no reads are open.
+        """
+        for table_name, index_columns in self._advisor.take_pending():
+            if self._table_exists(table_name):
+                self._create_indices(table_name, [index_columns])
 
     def _create_database(self, table_name, key_names, db_file):
         assert self.folder != ":memory:", 'because we don\'t have to do this with memory'
@@ -276,14 +1591,24 @@ class Eventstore(memdam.eventstore.api.Eventstore):
             columns[col.name] = col
         return columns
 
+    def _query_existing_indices(self, cur, table_name):
+        """
+        :param cur: the current database cursor
+        :type  cur: sqlite3.Cursor
+        :returns: the names of all indices on the table
+        :rtype: list(string)
+        """
+        execute_sql(cur, "PRAGMA index_list(%s);" % (table_name,))
+        return [row[1] for row in cur.fetchall()]
+
     def _create_table(self, cur, table_name):
         """
         Create a table with the default column (sample_time)
         """
         execute_sql(cur, "PRAGMA encoding = 'UTF-8';")
         execute_sql(cur, "CREATE TABLE %s(_id INTEGER PRIMARY KEY, time__time INTEGER, id__id STRING);" % (table_name,))
-        execute_sql(cur, "CREATE INDEX %s__time__time__asc ON %s (time__time ASC);" % (table_name, table_name))
-        execute_sql(cur, "CREATE INDEX %s__id__id__asc ON %s (id__id ASC);" % (table_name, table_name))
+        execute_sql(cur, "CREATE INDEX %s ON %s (time__time ASC);" % (_time_index_name(table_name), table_name))
+        execute_sql(cur, "CREATE UNIQUE INDEX %s ON %s (id__id);" % (_unique_id_index_name(table_name), table_name))
 
     def _generate_columns(self, cur, key_names, table_name):
         """
@@ -299,43 +1624,95 @@ class Eventstore(memdam.eventstore.api.Eventstore):
     def _update_columns(self, cur, existing_column_map, required_columns):
         """
         Modify the schema of the table to include new columns or indices if necessary
+        :returns: True iff any columns were created
+        :rtype: bool
         """
-
+        created = False
         for required_column in required_columns:
             if required_column.name in existing_column_map:
                 existing_column = existing_column_map[required_column.name]
                 assert required_column.sql_type == existing_column.sql_type
             else:
                 required_column.create(cur)
+                created = True
+        return created
 
-    def _insert_events(self, cur, events, key_names, table_name):
+    def _insert_events(self, cur, events, key_names, table_name, saved_ids=frozenset()):
         """
-        Insert all events at once.
+        Insert all events at once, replacing any that are already in the table.
         Assumes that the schema is correct.
+
+        :param saved_ids: the ids of events that were saved to this table before, which are taken
+        out of the segments if they aren't in the table itself
+        :type  saved_ids: frozenset(uuid.UUID)
         """
+        #if the same event is in the batch more than once, the last one wins
+        events = collections.OrderedDict((event.id__id, event) for event in events).values()
+
         #required because of stupid text fields.
         #we need to explicitly set the ids of everything inserted, or iteratively insert and check for lastrowid (which is slow and pathological and will end up doing this effectively anyway I think)
-        #figure out what the next id to insert should be
+        #events that already exist keep their row id, and new events get the next ones
+        existing_row_ids = _query_row_ids(cur, table_name, [event.id__id for event in events])
         cur.execute("SELECT _id FROM %s ORDER BY _id DESC LIMIT 1" % (table_name))
         next_row_id = 1
         results = cur.fetchall()
         if len(results) > 0:
             next_row_id = results[0][0] + 1
+        row_ids = []
+        for event in events:
+            if event.id__id in existing_row_ids:
+                row_ids.append(existing_row_ids[event.id__id])
+            else:
+                row_ids.append(next_row_id)
+                next_row_id += 1
 
-        #need to insert text documents into separate docs tables
+        #need to insert text documents into separate docs tables. Any documents for the events that
+        #are being replaced have to go first, since fts tables don't support INSERT OR REPLACE
+        #during a bulk load, the documents are staged in plain tables instead (see BulkLoad)
+        staged_columns = self._staged_columns(cur, table_name)
+        if len(existing_row_ids) > 0:
+            replaced_rows = [(row_id,) for row_id in existing_row_ids.values()]
+            for name in _text_column_names(self._table_columns(cur, table_name)):
+                execute_many(cur, "DELETE FROM %s__%s__docs WHERE docid = ?;" % (table_name, name), replaced_rows)
+            for name in staged_columns:
+                execute_many(cur, "DELETE FROM %s WHERE docid = ?;" % (_staged_docs_table_name(table_name, name)), replaced_rows)
         for key in key_names:
             if memdam.common.event.Event.field_type(key) == memdam.common.field.FieldType.TEXT:
-                sql = "INSERT INTO %s__%s__docs (docid,data) VALUES (?,?);" % (table_name, key)
-                values = [(next_row_id + i, getattr(events[i], key, None)) for i in range(0, len(events))]
+                if key in staged_columns:
+                    sql = "INSERT OR REPLACE INTO %s (docid,data) VALUES (?,?);" % (_staged_docs_table_name(table_name, key))
+                else:
+                    sql = "INSERT INTO %s__%s__docs (docid,data) VALUES (?,?);" % (table_name, key)
+                values = [(row_ids[i], getattr(events[i], key, None)) for i in range(0, len(events))]
                 execute_many(cur, sql, values)
 
         #finally, insert the actual events into the main table
         column_names = list(key_names)
         column_name_string = ", ".join(column_names)
         value_tuple_string = "(" + ", ".join(['?'] * (len(column_names)+1)) + ")"
-        sql = "INSERT INTO %s (_id, %s) VALUES %s;" % (table_name, column_name_string, value_tuple_string)
-        values = [make_value_tuple(events[i], key_names, next_row_id + i) for i in range(0, len(events))]
+        sql = "INSERT OR REPLACE INTO %s (_id, %s) VALUES %s;" % (table_name, column_name_string, value_tuple_string)
+        values = [make_value_tuple(events[i], key_names, row_ids[i]) for i in range(0, len(events))]
+        #rollups are rebuilt at the end of a bulk load instead
+        update_rollups = self._has_rollups(cur, table_name)
+        replaced_times = []
+        if len(existing_row_ids) > 0 and update_rollups:
+            replaced_times = _query_row_times(cur, table_name, existing_row_ids.values())
+        replaced_ids = set(existing_row_ids)
+        sealed_ids = saved_ids.difference(existing_row_ids)
+        if len(sealed_ids) > 0:
+            unsealed_times = memdam.eventstore.segment.remove(cur, table_name, sealed_ids)
+            replaced_times.extend(unsealed_times.values())
+            replaced_ids.update(unsealed_times)
         execute_many(cur, sql, values)
+        if self._has_changes(cur, table_name):
+            memdam.eventstore.changelog.record(cur, table_name, [event.id__id for event in events], False)
+
+        if update_rollups:
+            new_events = [event for event in events if event.id__id not in replaced_ids]
+            memdam.eventstore.rollup.add(cur, table_name, new_events)
+            if len(replaced_ids) > 0:
+                replaced_times.extend(convert_time_to_long(event.time__time) for event in events if event.id__id in replaced_ids)
+                memdam.eventstore.rollup.recompute(cur, table_name, self._table_columns(cur, table_name), replaced_times,
+                                                   self._sealed_events(cur, table_name))
 
 #TODO: this whole notion of filters needs to be better thought out
 @memdam.vtrace()
@@ -353,6 +1730,41 @@ def _separate_filters(filters):
             field_filters.append(f)
     return field_filters, namespaces
 
+def _find_rank_filter(filters):
+    """
+    :returns: the first top level match filter, which decides how search results are ranked
+    :rtype: memdam.common.query.QueryFilter
+    """
+    for query_filter in filters:
+        if query_filter.operator.lower() == memdam.eventstore.compiler.MATCH_OPERATOR:
+            return query_filter
+    raise Exception("Searches must have at least one (top level) match filter")
+
+#the name of the sql function that ranks full text search results (see _rank_match)
+RANK_FUNCTION = 'memdam_rank'
+
+def _rank_match(matchinfo):
+    """
+    Registered on every connection as RANK_FUNCTION. Scores a row by adding up, for every phrase,
+    the number of times that it appears in the row, weighted by how rare the phrase is in the table
+    (tf-idf), so that scores from different tables can still be compared.
+
+    :param matchinfo: the result of matchinfo(docs table, 'pcnx') for the row
+    :type  matchinfo: buffer
+    :returns: the rank of the row (higher is better)
+    :rtype: float
+    """
+    info = array.array('I', str(matchinfo))
+    num_phrases, num_columns, num_rows = info[0], info[1], info[2]
+    score = 0.0
+    for phrase in range(0, num_phrases):
+        for column in range(0, num_columns):
+            offset = 3 + 3 * (phrase * num_columns + column)
+            hits_in_row, rows_with_hits = info[offset], info[offset + 2]
+            if hits_in_row > 0:
+                score += hits_in_row * math.log(1.0 + float(num_rows) / rows_with_hits)
+    return score
+
 @memdam.vtrace()
 def _matches_namespace_filters(table_name, query):
     _, namespaces = _separate_filters(query.filters)
@@ -360,12 +1772,6 @@ def _matches_namespace_filters(table_name, query):
         return True
     return table_name_to_namespace(table_name) in namespaces
 
-@memdam.vtrace()
-def _get_field_filter_string(field_filters):
-    #TODO (security): lol so bad.
-    filter_string = ' AND '.join(('%s %s %s' % (f.lhs, f.operator, f.rhs) for f in field_filters))
-    return filter_string, ()
-
 @memdam.vtrace()
 def make_value_tuple(event, key_names, event_id):
     """Turns an event into a sql value tuple"""
@@ -373,68 +1779,402 @@ def make_value_tuple(event, key_names, event_id):
     for key in key_names:
         value = getattr(event, key, None)
         if value != None:
-            #convert time to long for more efficient storage (and so it can be used as a primary key)
-            if isinstance(value, datetime.datetime):
-                value = convert_time_to_long(value)
+            field = memdam.common.field.describe(key)
             #convert text tuple entries into references to the actual text data
-            elif memdam.common.event.Event.field_type(key) == memdam.common.field.FieldType.TEXT:
+            if field.type == memdam.common.field.FieldType.TEXT:
                 value = event_id
-            #convert UUIDs to byte representation
-            elif memdam.common.event.Event.field_type(key) == memdam.common.field.FieldType.ID:
-                value = buffer(value.bytes)
-            elif memdam.common.event.Event.field_type(key) == memdam.common.field.FieldType.FILE:
-                value = value.name
+            else:
+                value = field.to_sql(value)
         values.append(value)
     return values
 
-@memdam.vtrace()
-def convert_time_to_long(value):
-    """turns a datetime.datetime into a long"""
-    return long(round(1000000.0 * (value - EPOCH_BEGIN).total_seconds()))
+#times are stored as longs (see memdam.common.timeutils.time_to_long)
+convert_time_to_long = memdam.common.timeutils.time_to_long
+convert_long_to_time = memdam.common.timeutils.long_to_time
 
-@memdam.vtrace()
-def convert_long_to_time(value):
-    """turns a long into a datetime.datetime"""
-    return EPOCH_BEGIN + datetime.timedelta(microseconds=value)
+def _seconds_to_long(seconds):
+    """:returns: the length of time, in the same units as stored times"""
+    return long(seconds) * 1000000L
+
+def _convert_aggregate_value(function, field, value):
+    """
+    :returns: the result of an aggregate function, converted back from the way it is stored
+    """
+    if value is not None and function in ('min', 'max') and \
+       memdam.common.event.Event.field_type(field) == memdam.common.field.FieldType.TIME:
+        return convert_long_to_time(value)
+    return value
 
 @memdam.vtrace()
 def table_name_to_namespace(table_name):
-    return table_name.replace(u'_', u'.')
+    return split_partition(table_name)[0].replace(u'_', u'.')
 
 @memdam.vtrace()
 def namespace_to_table_name(namespace):
     return namespace.replace(u'.', u'_')
 
+#the ways that a namespace can be split into partitions, and how the name of each partition is made
+PARTITION_FORMATS = {
+    'year': '%Y',
+    'month': '%Y%m',
+    'day': '%Y%m%d',
+}
+PARTITION_SEPARATOR = u'__'
+
+def partition_table_name(table_name, time, partition):
+    """
+    :returns: the name of the table for the partition that this time falls in
+    :rtype: unicode
+    """
+    suffix = time.astimezone(pytz.utc).strftime(PARTITION_FORMATS[partition])
+    return table_name + PARTITION_SEPARATOR + unicode(suffix)
+
+def split_partition(table_name):
+    """
+    Namespaces can't contain _, so their table names never contain __ unless they are partitioned.
+
+    :returns: the name of the table without the partition, and the partition (None if the table is
+    not partitioned)
+    :rtype: tuple(unicode, unicode)
+    """
+    parts = table_name.split(PARTITION_SEPARATOR, 1)
+    if len(parts) == 2 and parts[1].isdigit():
+        return parts[0], parts[1]
+    return table_name, None
+
+def partition_time_range(suffix):
+    """
+    :param suffix: the partition part of a table name (see split_partition)
+    :type  suffix: unicode
+    :returns: the (inclusive) start and (exclusive) end times of the partition, as stored (longs)
+    :rtype: tuple(long, long)
+    """
+    year = int(suffix[0:4])
+    if len(suffix) == 4:
+        start = datetime.datetime(year, 1, 1, tzinfo=pytz.utc)
+        end = datetime.datetime(year + 1, 1, 1, tzinfo=pytz.utc)
+    elif len(suffix) == 6:
+        month = int(suffix[4:6])
+        start = datetime.datetime(year, month, 1, tzinfo=pytz.utc)
+        if month == 12:
+            end = datetime.datetime(year + 1, 1, 1, tzinfo=pytz.utc)
+        else:
+            end = datetime.datetime(year, month + 1, 1, tzinfo=pytz.utc)
+    else:
+        assert len(suffix) == 8, "Invalid partition: %s" % (suffix)
+        start = datetime.datetime(year, int(suffix[4:6]), int(suffix[6:8]), tzinfo=pytz.utc)
+        end = start + datetime.timedelta(days=1)
+    return convert_time_to_long(start), convert_time_to_long(end)
+
+@memdam.vtrace()
+def _matches_time_bounds(table_name, time_bounds):
+    """
+    :param time_bounds: see memdam.eventstore.compiler.time_bounds
+    :type  time_bounds: tuple(long, long)
+    :returns: False iff the table is a partition that can't contain any event within the bounds
+    :rtype: bool
+    """
+    _, suffix = split_partition(table_name)
+    if suffix is None:
+        return True
+    lower, upper = time_bounds
+    start, end = partition_time_range(suffix)
+    return (lower is None or lower < end) and (upper is None or upper > start)
+
+#the most ? parameters that sqlite will accept in a single statement (by default)
+MAX_SQL_VARIABLES = 999
+
+def _time_index_name(table_name):
+    """
+    :returns: the name of the index on time__time
+    :rtype: unicode
+    """
+    return table_name + u'__time__time__asc'
+
+def _unique_id_index_name(table_name):
+    """
+    :returns: the name of the unique index on id__id
+    :rtype: unicode
+    """
+    return table_name + u'__id__id__unique'
+
+def _sealable_columns(columns):
+    """
+    :param columns: the columns in a table (see SchemaCatalog.columns)
+    :type  columns: dict(string, SqliteColumn)
+    :returns: just the columns that segments can have (any others were added after sealing)
+    :rtype: dict(string, SqliteColumn)
+    """
+    return dict((name, column) for name, column in columns.items() \
+                if column.data_type in memdam.eventstore.segment.SEALABLE_TYPES)
+
+def _text_column_names(columns):
+    """
+    :param columns: the columns in a table (see SchemaCatalog.columns)
+    :type  columns: dict(string, SqliteColumn)
+    :returns: the names of the TEXT columns, which each have their own docs table
+    :rtype: list(string)
+    """
+    return [name for name in columns if memdam.common.event.Event.field_type(name) == memdam.common.field.FieldType.TEXT]
+
+@memdam.vtrace()
+def _query_row_ids(cur, table_name, event_ids):
+    """
+    :returns: the row (_id) for each of these events that is already in the table
+    :rtype: dict(uuid.UUID, int)
+    """
+    row_ids = {}
+    for start in range(0, len(event_ids), MAX_SQL_VARIABLES):
+        batch = event_ids[start:start+MAX_SQL_VARIABLES]
+        sql = "SELECT id__id, _id FROM %s WHERE id__id IN (%s);" % (table_name, ", ".join(['?'] * len(batch)))
+        execute_sql(cur, sql, [buffer(event_id.bytes) for event_id in batch])
+        for row in cur.fetchall():
+            row_ids[uuid.UUID(bytes=str(row[0]))] = row[1]
+    return row_ids
+
+@memdam.vtrace()
+def _query_row_times(cur, table_name, row_ids):
+    """
+    :returns: the time (as stored) of each of these rows
+    :rtype: list(long)
+    """
+    times = []
+    for start in range(0, len(row_ids), MAX_SQL_VARIABLES):
+        batch = row_ids[start:start+MAX_SQL_VARIABLES]
+        sql = "SELECT time__time FROM %s WHERE _id IN (%s);" % (table_name, ", ".join(['?'] * len(batch)))
+        execute_sql(cur, sql, batch)
+        times.extend(row[0] for row in cur.fetchall())
+    return times
+
+@memdam.vtrace()
+def _create_id_index(cur):
+    """
+    Create the table that maps every event id to the name of the table that holds the event
+    """
+    execute_sql(cur, "CREATE TABLE IF NOT EXISTS %s(id__id BLOB PRIMARY KEY, table_name TEXT NOT NULL);" % (Eventstore.ID_INDEX_TABLE))
+    #so that all of the events in a table can be removed at once (see Eventstore.drop_partitions)
+    execute_sql(cur, "CREATE INDEX IF NOT EXISTS %s__table_name ON %s (table_name);" % (Eventstore.ID_INDEX_TABLE, Eventstore.ID_INDEX_TABLE))
+
+@memdam.vtrace()
+def _create_bulk_loads(cur):
+    """
+    Create the tables (next to the id index) that record every bulk load that hasn't finished yet,
+    how far it has gotten, and which tables it has put into bulk mode
+    """
+    execute_sql(cur, "CREATE TABLE IF NOT EXISTS %s(name TEXT PRIMARY KEY, checkpoint);" % (Eventstore.BULK_LOADS_TABLE))
+    execute_sql(cur, "CREATE TABLE IF NOT EXISTS %s(name TEXT NOT NULL, table_name TEXT NOT NULL, PRIMARY KEY (name, table_name));" % \
+                (Eventstore.BULK_LOAD_TABLES_TABLE))
+
+@memdam.vtrace()
+def _create_bulk_load_state(cur):
+    """
+    Create the table (in a table file) that records everything that a bulk load has changed and
+    has to undo when it finishes: dropped indices (kind 'index', with the sql to create them again)
+    and staged documents (kind 'docs', where object is the TEXT column)
+    """
+    execute_sql(cur, "CREATE TABLE IF NOT EXISTS %s(name TEXT NOT NULL, table_name TEXT NOT NULL, kind TEXT NOT NULL, object TEXT NOT NULL, sql TEXT);" % \
+                (Eventstore.BULK_LOAD_STATE_TABLE))
+
+def _staged_docs_table_name(table_name, column):
+    """
+    :returns: the name of the plain table that holds the documents for a TEXT column during a bulk
+    load (named like the fts table, so that it is skipped in the same way)
+    :rtype: unicode
+    """
+    return u"%s__%s__docs__staging" % (table_name, column)
+
+@memdam.vtrace()
+def _load_text_fields(cur, table_name, names, rows, staged_columns=frozenset()):
+    """
+    Load the documents for every TEXT column in a page of rows, with one query per column (rather
+    than one per row).
+
+    :param cur: a cursor that is NOT being used to read the rows
+    :type  cur: sqlite3.Cursor
+    :param names: the column names for the rows
+    :type  names: list(string)
+    :param rows: the rows that were read from table_name
+    :type  rows: list(tuple)
+    :param staged_columns: the TEXT columns that also have documents in a staging table (see BulkLoad)
+    :type  staged_columns: frozenset(string)
+    :returns: a mapping from column name to a mapping from docid to document
+    :rtype: dict(string, dict(int, unicode))
+    """
+    texts = {}
+    for i in range(0, len(names)):
+        name = names[i]
+        if name == '_id' or memdam.common.event.Event.field_type(name) != memdam.common.field.FieldType.TEXT:
+            continue
+        docids = list(set(row[i] for row in rows if row[i] != None))
+        docs_tables = [u"%s__%s__docs" % (table_name, name)]
+        if name in staged_columns:
+            docs_tables.append(_staged_docs_table_name(table_name, name))
+        documents = {}
+        for docs_table in docs_tables:
+            for start in range(0, len(docids), MAX_SQL_VARIABLES):
+                batch = docids[start:start+MAX_SQL_VARIABLES]
+                sql = "SELECT docid, data FROM %s WHERE docid IN (%s);" % (docs_table, ", ".join(['?'] * len(batch)))
+                execute_sql(cur, sql, batch)
+                documents.update(cur.fetchall())
+        texts[name] = documents
+    return texts
+
 @memdam.vtrace()
-def _create_event_from_row(row, names, namespace, conn):
-    """returns a memdam.common.event.Event, generated from the row"""
+def _create_event_from_row(row, names, namespace, texts):
+    """
+    :param texts: the TEXT documents for this row (and probably others), see _load_text_fields
+    :type  texts: dict(string, dict(int, unicode))
+    :returns: a memdam.common.event.Event, generated from the row
+    """
     data = {}
-    table_name = namespace_to_table_name(namespace)
     for i in range(0, len(names)):
         name = names[i]
         if name == '_id':
             continue
         value = row[i]
         if value != None:
-            field_type = memdam.common.event.Event.field_type(name)
-            if field_type == memdam.common.field.FieldType.TIME:
-                value = convert_long_to_time(value)
-            elif field_type == memdam.common.field.FieldType.TEXT:
-                cur = conn.cursor()
-                execute_sql(cur, "SELECT data FROM %s__%s__docs WHERE docid = '%s';" % (table_name, name, value))
-                value = cur.fetchall()[0][0]
-            elif field_type == memdam.common.field.FieldType.ID:
-                value = uuid.UUID(bytes=value)
-            elif field_type == memdam.common.field.FieldType.BOOL:
-                value = value == 1
-            elif field_type == memdam.common.field.FieldType.FILE:
-                parsed_data = value.split('.')
-                value = memdam.common.blob.BlobReference(uuid.UUID(parsed_data[0]), parsed_data[1])
+            field = memdam.common.field.describe(name)
+            if field.type == memdam.common.field.FieldType.TEXT:
+                #the document can only be missing if the event was being changed while it was read
+                value = texts[name].get(value)
+                if value is None:
+                    continue
+            else:
+                value = field.from_sql(value)
             data[name] = value
     data['type__namespace'] = namespace
-    return memdam.common.event.Event(**data)
+    #everything in the table was checked before it was saved
+    return memdam.common.event.Event.from_trusted_dict(data)
+
+def make_sort_key(order):
+    """
+    :param order: see memdam.common.query.Query.order
+    :type  order: tuple(tuple(unicode, boolean), ...)
+    :returns: function(event) -> a key that sorts events in exactly the same way that sqlite sorts
+    their rows for this order, so that results from different tables can be merged
+    :rtype: function
+    """
+    elems = [(elem[0].lower(), elem[1] != False) for elem in order]
+    def sort_key(event):
+        """:returns: the key for this event"""
+        key = []
+        for name, ascending in elems:
+            value = _sql_sort_value(name, getattr(event, name, None))
+            if not ascending:
+                value = memdam.eventstore.merge.Descending(value)
+            key.append(value)
+        return tuple(key)
+    return sort_key
+
+def _sql_sort_value(name, value):
+    """
+    sqlite sorts NULL first, then numbers, then text, then blobs, so the first element of the
+    result is the storage class, and the second is the value as it is stored.
+    """
+    if value is None:
+        return (0,)
+    field_type = memdam.common.event.Event.field_type(name)
+    if field_type == memdam.common.field.FieldType.TIME:
+        return (1, convert_time_to_long(value))
+    elif field_type in (memdam.common.field.FieldType.NUMBER, memdam.common.field.FieldType.LONG, memdam.common.field.FieldType.BOOL):
+        return (1, value)
+    elif field_type == memdam.common.field.FieldType.ID:
+        return (3, value.bytes)
+    elif field_type == memdam.common.field.FieldType.RAW:
+        return (3, str(value))
+    elif field_type == memdam.common.field.FieldType.FILE:
+        return (2, value.name)
+    return (2, value)
+
+class BulkLoad(memdam.Base):
+    """
+    Saves lots of events (eg, years of history from an import) much faster than Eventstore.save.
+
+    Every table that the bulk load writes to is put into bulk mode until the bulk load finishes:
+    - every index except the unique one on id__id is dropped, and created again at the end
+    - TEXT documents go into plain staging tables, and are added to the fts tables (which are then
+      optimized) at the end, so they can't be searched until then
+    - rollups are not updated, and are calculated again at the end
+    Events are saved batch_size at a time, with one transaction per table.
+
+    Bulk loads are crash-safe and can be resumed. What was changed in each table is recorded in the
+    same transaction that changes it, so finish always puts everything back. Pass a checkpoint
+    (anything that sqlite can store, eg, the position in the file being imported) with the events,
+    and once they are committed it is saved as well. Opening the bulk load again with the same name
+    gives back the last checkpoint, and since saving an event twice is harmless, the import can just
+    carry on from there.
+
+    Use as a context manager to finish the bulk load when the block succeeds (but not if it fails,
+    so it can be resumed).
+    Only one thread should use a bulk load at a time. Other saves to the same tables still work.
+
+    :attr name: identifies the bulk load
+    :type name: unicode
+    :attr checkpoint: the checkpoint of the last events that were committed (None at first)
+    """
+
+    DEFAULT_BATCH_SIZE = 10000
+
+    def __init__(self, eventstore, name, batch_size, checkpoint):
+        """
+        Use Eventstore.bulk_load instead
+        """
+        assert batch_size > 0
+        self._eventstore = eventstore
+        self.name = name
+        self._batch_size = batch_size
+        self.checkpoint = checkpoint
+        self._pending = []
+        self._pending_checkpoint = checkpoint
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.finish()
+
+    def save(self, events, checkpoint=None):
+        """
+        :param events: the events to save. They may not be committed until later calls.
+        :type  events: iterable(memdam.common.event.Event)
+        :param checkpoint: if not None, where to resume from once these events are committed
+        """
+        self._pending.extend(events)
+        if checkpoint is not None:
+            self._pending_checkpoint = checkpoint
+        while len(self._pending) >= self._batch_size:
+            self._save(self._pending[:self._batch_size])
+            self._pending = self._pending[self._batch_size:]
+        if len(self._pending) <= 0:
+            self._commit_checkpoint()
+
+    def flush(self):
+        """
+        Commit every event that has been saved so far (and the latest checkpoint)
+        """
+        if len(self._pending) > 0:
+            self._save(self._pending)
+            self._pending = []
+        self._commit_checkpoint()
+
+    def finish(self):
+        """
+        Commit everything, and take every table out of bulk mode. The bulk load is forgotten, so it
+        should not be used after this.
+        """
+        self.flush()
+        memdam.log().info("Finishing bulk load %s" % (self.name))
+        self._eventstore._finish_bulk_load(self.name)
+
+    def _save(self, events):
+        memdam.log().debug("Bulk loading %s events" % (len(events)))
+        self._eventstore._bulk_save(self.name, events)
 
-EPOCH_BEGIN = datetime.datetime(1970, 1, 1, tzinfo=pytz.UTC)
+    def _commit_checkpoint(self):
+        if self._pending_checkpoint != self.checkpoint:
+            self._eventstore._save_bulk_checkpoint(self.name, self._pending_checkpoint)
+            self.checkpoint = self._pending_checkpoint
 
 class SqliteColumn(memdam.Base):
     """
@@ -445,33 +2185,21 @@ class SqliteColumn(memdam.Base):
     :type name: string
     :attr data_type: the type of data
     :type data_type: memdam.common.field.FieldType
+    :attr field: everything else about the column, from its name
+    :type field: memdam.common.field.FieldDescriptor
     :attr table_name: the name of the table. The namespace for the events
     :type table_name: string
     """
 
     SQL_NAME_REGEX = re.compile(r"[a-z][a-z0-9_]*")
 
-    data_type_to_sql_type = {
-        memdam.common.field.FieldType.NUMBER: 'FLOAT',
-        memdam.common.field.FieldType.STRING: 'TEXT',
-        #this might seems strange, but it's because we store an index to a document in another table
-        memdam.common.field.FieldType.TEXT: 'INTEGER',
-        memdam.common.field.FieldType.ENUM: 'TEXT',
-        memdam.common.field.FieldType.RAW: 'BLOB',
-        memdam.common.field.FieldType.BOOL: 'BOOL',
-        memdam.common.field.FieldType.TIME: 'INTEGER',
-        memdam.common.field.FieldType.ID: 'TEXT',
-        memdam.common.field.FieldType.LONG: 'INTEGER',
-        memdam.common.field.FieldType.FILE: 'TEXT',
-        memdam.common.field.FieldType.NAMESPACE: 'TEXT',
-    }
-
     def __init__(self, column_name, table_name):
         self.column_name = column_name
-        name = memdam.common.event.Event.raw_name(column_name)
+        self.field = memdam.common.field.describe(column_name)
+        name = self.field.raw_name
         assert SqliteColumn.SQL_NAME_REGEX.match(name), "Invalid name for column: %s" % (name)
         self.name = name
-        self.data_type = memdam.common.event.Event.field_type(column_name)
+        self.data_type = self.field.type
         assert SqliteColumn.SQL_NAME_REGEX.match(name), "Invalid name for table: %s" % (table_name)
         self.table_name = table_name
 
@@ -484,15 +2212,12 @@ class SqliteColumn(memdam.Base):
 
     def create(self, cur):
         """
-        Create the column and index.
-        Only call if the column and index don't already exist.
+        Create the column (and the fts table for TEXT columns). Indices are up to the IndexPolicy.
+        Only call if the column doesn't already exist.
         """
         if self.is_text:
             execute_sql(cur, "CREATE VIRTUAL TABLE %s__%s__docs USING fts4(data,tokenize=porter);" % (self.table_name, self.column_name))
         execute_sql(cur, "ALTER TABLE %s ADD COLUMN %s %s;" % (self.table_name, self.column_name, self.sql_type))
-        if self.sql_index != None:
-            index_name = self.table_name + "__" + self.column_name + "__" + self.sql_index
-            execute_sql(cur, "CREATE INDEX %s ON %s (%s %s);" % (index_name, self.table_name, self.column_name, self.sql_index))
 
     def __repr__(self):
         data_type_name = memdam.common.field.FieldType.names[self.data_type]
@@ -507,19 +2232,7 @@ class SqliteColumn(memdam.Base):
         :returns: the sqlite type corresponding to our data_type
         :rtype: string
         """
-        return self.data_type_to_sql_type[self.data_type]
-
-    @property
-    def sql_index(self):
-        """
-        Note: everything returns ASC because the only alternative is FTS, which is handled specially
-        and ends up making an ASC index on the column anyway.
-        :returns: the sqlite type corresponding to our index type
-        :rtype: string
-        """
-        if self.data_type == memdam.common.field.FieldType.RAW:
-            return None
-        return 'ASC'
+        return self.field.sql_type
 
     @staticmethod
     def from_row(row, table_name):
@@ -529,6 +2242,271 @@ class SqliteColumn(memdam.Base):
         column_name = row[1]
         return SqliteColumn(column_name, table_name)
 
+class SchemaCatalog(memdam.Base):
+    """
+    A cache of the columns and indices of every table that we have written to, so that saving
+    events only has to look at the real schema when it sees a column that it hasn't seen before.
+
+    Columns are never removed, so the only time that an entry can be out of date is when someone
+    else (another process, or another Eventstore) added a column. In that case we just think that
+    the column is missing, look at the schema, and refresh the entry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        #table name -> dict(column name -> SqliteColumn)
+        self._columns = {}
+        #table name -> frozenset(index names)
+        self._indices = {}
+
+    def has_columns(self, table_name, column_names):
+        """
+        :returns: True iff the table is known to exist and to have every one of the columns
+        :rtype: bool
+        """
+        with self._lock:
+            columns = self._columns.get(table_name, None)
+        if columns is None:
+            return False
+        for column_name in column_names:
+            if column_name not in columns:
+                return False
+        return True
+
+    def columns(self, table_name):
+        """
+        :returns: the known columns for the table, or None if we don't know about this table
+        :rtype: dict(string, SqliteColumn)
+        """
+        with self._lock:
+            return self._columns.get(table_name, None)
+
+    def indices(self, table_name):
+        """
+        :returns: the names of the known indices for the table, or None if we don't know about it
+        :rtype: frozenset(string)
+        """
+        with self._lock:
+            return self._indices.get(table_name, None)
+
+    def update(self, table_name, columns, indices):
+        """
+        Replace everything that we know about the table.
+        :param columns: every column in the table
+        :type  columns: iterable(SqliteColumn)
+        :param indices: the name of every index on the table
+        :type  indices: iterable(string)
+        """
+        column_map = dict((column.column_name, column) for column in columns)
+        with self._lock:
+            self._columns[table_name] = column_map
+            self._indices[table_name] = frozenset(indices)
+
+    def invalidate(self, table_name):
+        """Forget everything about the table (eg, because it was deleted)"""
+        with self._lock:
+            self._columns.pop(table_name, None)
+            self._indices.pop(table_name, None)
+
+class ConnectionPool(memdam.Base):
+    """
+    Keeps sqlite connections open between calls so that we don't pay for opening the file, parsing
+    the schema and warming up the page cache every time a table is touched.
+
+    Connections are keyed by (table name, read_only, thread), so readers and writers never share a
+    handle, and no connection is ever used by two threads at once. A thread that asks for the same
+    key again while it is still holding that connection (eg, a get() while iterating over a find())
+    simply shares the connection it already has.
+
+    When there are more than max_connections open, the least recently used idle connections are
+    closed. Connections that are currently borrowed are never closed, so the cap can temporarily be
+    exceeded if every connection is in use.
+
+    :attr _connect: function(table_name, read_only) that opens a new sqlite3.Connection
+    :type _connect: function
+    :attr _max_connections: the most connections that will be kept open
+    :type _max_connections: int
+    """
+
+    DEFAULT_MAX_CONNECTIONS = 64
+
+    def __init__(self, connect, max_connections=DEFAULT_MAX_CONNECTIONS):
+        assert max_connections > 0
+        self._connect = connect
+        self._max_connections = max_connections
+        self._lock = threading.Lock()
+        #key -> connection, in least recently used order
+        self._idle = collections.OrderedDict()
+        #key -> [connection, number of times it has been borrowed]
+        self._in_use = {}
+        self._pid = os.getpid()
+
+    @contextlib.contextmanager
+    def connection(self, table_name, read_only=True):
+        """
+        Borrow a connection for the duration of the with block. Any transaction that is still open
+        when the block exits because of an exception is rolled back.
+        """
+        key = (table_name, read_only, threading.current_thread().ident)
+        conn = self._checkout(key)
+        try:
+            yield conn
+        except:
+            self._rollback(key, conn)
+            raise
+        finally:
+            self._checkin(key, conn)
+
+    def close(self):
+        """Close every idle connection. Borrowed connections are closed as soon as they are returned."""
+        with self._lock:
+            idle = list(self._idle.values())
+            self._idle.clear()
+            self._in_use.clear()
+        for conn in idle:
+            _close_quietly(conn)
+
+    def close_table(self, table_name):
+        """Close every idle connection to a particular table (eg, because the file is going away)"""
+        with self._lock:
+            keys = [key for key in self._idle if key[0] == table_name]
+            conns = [self._idle.pop(key) for key in keys]
+        for conn in conns:
+            _close_quietly(conn)
+
+    def _checkout(self, key):
+        with self._lock:
+            self._forget_if_forked()
+            if key in self._in_use:
+                self._in_use[key][1] += 1
+                return self._in_use[key][0]
+            conn = self._idle.pop(key, None)
+        if conn is None:
+            conn = self._connect(key[0], key[1])
+        with self._lock:
+            self._in_use[key] = [conn, 1]
+            evicted = self._evict()
+        for old_conn in evicted:
+            _close_quietly(old_conn)
+        return conn
+
+    def _checkin(self, key, conn):
+        with self._lock:
+            entry = self._in_use.get(key, None)
+            if entry is None:
+                #the pool was closed while this was borrowed
+                _close_quietly(conn)
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self._in_use[key]
+            if entry[0] is not None:
+                self._idle[key] = entry[0]
+            evicted = self._evict()
+        for old_conn in evicted:
+            _close_quietly(old_conn)
+
+    def _rollback(self, key, conn):
+        """If we can't even roll back, the connection is broken, so make sure it is never reused."""
+        try:
+            conn.rollback()
+        except Exception:
+            with self._lock:
+                if key in self._in_use:
+                    self._in_use[key][0] = None
+            _close_quietly(conn)
+
+    def _evict(self):
+        """
+        Must hold the lock.
+        :returns: the least recently used idle connections that are over the limit
+        :rtype: list(sqlite3.Connection)
+        """
+        evicted = []
+        while self._idle and len(self._idle) + len(self._in_use) > self._max_connections:
+            _, conn = self._idle.popitem(last=False)
+            evicted.append(conn)
+        return evicted
+
+    def _forget_if_forked(self):
+        """
+        Must hold the lock.
+        Connections must never be shared with a child process, so start over after a fork.
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle.clear()
+            self._in_use.clear()
+
+class Checkpointer(memdam.Base):
+    """
+    Runs write-ahead log checkpoints in a background thread, so that writers never have to wait for
+    one. Only tables that have been written to since the last checkpoint are checkpointed.
+
+    The thread is started the first time a table is marked as dirty.
+
+    :attr _checkpoint: function(table_name, mode) that actually runs the checkpoint
+    :type _checkpoint: function
+    :attr _interval: the number of seconds between checkpoints
+    :type _interval: float
+    """
+
+    def __init__(self, checkpoint, interval):
+        assert interval > 0
+        self._checkpoint = checkpoint
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def mark_dirty(self, table_name):
+        """Remember that this table needs to be checkpointed"""
+        with self._lock:
+            self._dirty.add(table_name)
+            if self._thread is None and not self._stopped.is_set():
+                self._thread = threading.Thread(name="sqlite-checkpointer", target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self):
+        """Stop the thread, and run one last (blocking) checkpoint on everything that is dirty"""
+        self._stopped.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.checkpoint_all(mode='TRUNCATE')
+
+    def forget(self, table_name):
+        """Stop checkpointing this table (eg, because it is being removed)"""
+        with self._lock:
+            self._dirty.discard(table_name)
+
+    def checkpoint_all(self, mode='PASSIVE'):
+        """Checkpoint every dirty table right now"""
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = set()
+        for table_name in dirty:
+            try:
+                self._checkpoint(table_name, mode)
+            except Exception, e:
+                memdam.log().warn("Failed to checkpoint %s: %s" % (table_name, e))
+                with self._lock:
+                    self._dirty.add(table_name)
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self.checkpoint_all()
+
+def _close_quietly(conn):
+    """Close the connection, ignoring any errors (it might be closed or broken already)"""
+    try:
+        conn.close()
+    except Exception:
+        pass
+
 @memdam.vtrace()
 def execute_with_retries(command, num_retries=3, retry_wait_time=0.1, retry_growth_rate=2.0):
     """
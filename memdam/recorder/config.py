@@ -26,7 +26,15 @@ class Config(object):
         for key, value in kwargs.iteritems():
             self.data[key] = value
 
-    def get(self, key):
+    def get(self, key, *default):
+        """
+        :param key: the name of the setting
+        :type  key: string
+        :param default: if given, returned when the setting is not defined. Otherwise a KeyError is
+        raised.
+        """
+        if default and key not in self.data:
+            return default[0]
         return self.data[key]
 
     def save(self):
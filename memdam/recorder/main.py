@@ -21,6 +21,9 @@ import memdam.blobstore.localfolder
 import memdam.blobstore.https
 import memdam.eventstore.sqlite
 import memdam.eventstore.https
+import memdam.eventstore.groupcommit
+import memdam.eventstore.memtable
+import memdam.eventstore.indexing
 import memdam.recorder.config
 import memdam.recorder.state
 import memdam.recorder.collector.systemstats
@@ -151,12 +154,29 @@ def run(user, config):
     client = memdam.common.client.MemdamClient(server_url, username, password)
     local_blobs = memdam.blobstore.localfolder.Blobstore(local_blob_folder)
     remote_blobs = memdam.blobstore.https.Blobstore(client)
-    local_events = memdam.eventstore.sqlite.Eventstore(local_event_folder)
-    remote_events = memdam.eventstore.https.Eventstore(client)
+    #collectors and sync write constantly while sync is reading, so wal helps a lot here
+    local_events = memdam.eventstore.sqlite.Eventstore(local_event_folder, wal=config.get(u'sqlite_wal', False),
+                                                       partition=config.get(u'sqlite_partition', None),
+                                                       rollups=config.get(u'sqlite_rollups', False),
+                                                       changes=config.get(u'sqlite_changes', False),
+                                                       index_policy=memdam.eventstore.indexing.IndexPolicy(
+                                                           composite=config.get(u'sqlite_indices', None),
+                                                           advisor=config.get(u'sqlite_index_advisor', None)))
+    #most events are synchronized (and deleted) soon after they are collected, so buffering them in
+    #memory means that they never have to be written to sqlite at all
+    if config.get(u'memtable', False):
+        local_events = memdam.eventstore.memtable.Eventstore(local_events, os.path.join(local_folder, "memtable"),
+            flush_interval=config.get(u'memtable_flush_interval', memdam.eventstore.memtable.Eventstore.DEFAULT_FLUSH_INTERVAL),
+            max_events=config.get(u'memtable_max_events', memdam.eventstore.memtable.Eventstore.DEFAULT_MAX_EVENTS))
+    #binary events are much smaller than JSON, which matters on slow or metered connections
+    remote_events = memdam.eventstore.https.Eventstore(client, binary=config.get(u'binary_events', False))
+    #collectors each save a few events at a time from their own threads, so commit those together
+    collected_events = memdam.eventstore.groupcommit.Eventstore(local_events,
+        window=config.get(u'group_commit_window', memdam.eventstore.groupcommit.Eventstore.DEFAULT_WINDOW))
 
     #schedule various collectors
     sched = apscheduler.scheduler.Scheduler(standalone=True)
-    collectors = create_collectors(sched, config, state_folder, local_events, local_blobs)
+    collectors = create_collectors(sched, config, state_folder, collected_events, local_blobs)
 
     #start the synchronizer in the background
     synchronizer = memdam.recorder.sync.Synchronizer(local_events, remote_events, local_blobs, remote_blobs)
@@ -182,6 +202,8 @@ def run(user, config):
             collector.stop()
         #stop synchronizing everything
         synchronizer.stop()
+        #release all of the database connections
+        local_events.close()
         #TODO: cleaner shutdown. Figure out what exception type this is
         memdam.shutdown_log()
 
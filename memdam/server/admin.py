@@ -9,6 +9,7 @@ import memdam.common.query
 import memdam.blobstore.localfolder
 import memdam.eventstore.sqlite
 import memdam.server.web_server
+import memdam.server.web.utils
 from memdam.server.web import app
 
 def setup():
@@ -30,6 +31,10 @@ def create_archive(username, password):
     return archive
 
 def _get_archive(username, must_exist=True):
+    """
+    Archives in folders are shared with the web server (see memdam.server.web.utils.get_archive),
+    so that every call doesn't leave another Eventstore (and its checkpoint thread) open.
+    """
     assert re.compile(r'^[A-Za-z0-9_]+$').match(username)
     db_file = app.config['DATABASE_FOLDER']
     if db_file != ':memory:' and db_file != '':
@@ -39,7 +44,12 @@ def _get_archive(username, must_exist=True):
                 raise Exception('Archive does not exist: ' + str(db_file))
             else:
                 os.makedirs(db_file)
-    archive = memdam.eventstore.sqlite.Eventstore(db_file)
+        return memdam.server.web.utils.get_archive(username)
+    archive = memdam.eventstore.sqlite.Eventstore(db_file, wal=app.config['DATABASE_WAL'],
+                                                  partition=app.config['DATABASE_PARTITION'],
+                                                  rollups=app.config['DATABASE_ROLLUPS'],
+                                                  changes=app.config['DATABASE_CHANGES'],
+                                                  index_policy=memdam.server.web.utils.make_index_policy())
     if db_file == ':memory:':
         archives = getattr(flask.g, '_archives', {})
         archives[username] = archive
@@ -90,6 +100,19 @@ def delete_events(username, events):
             blobstore.delete(blob_ref)
         archive.delete(event.id__id)
 
+def seal_events(username, namespace, before):
+    """
+    Move old events from a sampling namespace into compressed segments (see
+    memdam.eventstore.sqlite.Eventstore.seal)
+
+    :param before: events from before this time are sealed
+    :type  before: datetime.datetime
+    :returns: the number of events that were sealed
+    :rtype: int
+    """
+    archive = _get_archive(username)
+    return archive.seal(namespace, before)
+
 #TODO: for some reason, it doesn't work if I do this. Have to call it from the ipython prompt manually...
 #if __name__ == '__main__':
 #    setup()
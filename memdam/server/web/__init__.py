@@ -7,6 +7,12 @@ flask_bootstrap.Bootstrap(app)
 
 app.config.update(dict(
     DATABASE_FOLDER=':memory:',
+    DATABASE_WAL=False,
+    DATABASE_PARTITION=None,
+    DATABASE_ROLLUPS=False,
+    DATABASE_CHANGES=False,
+    DATABASE_INDICES=None,
+    DATABASE_INDEX_ADVISOR=None,
     BLOBSTORE_FOLDER='/tmp',
     DEBUG=True,
     SECRET_KEY='development key',
@@ -0,0 +1,27 @@
+import json
+
+import flask
+
+import memdam.common.change
+import memdam.server.web.errors
+import memdam.server.web.utils
+import memdam.server.web.auth
+
+blueprint = flask.Blueprint('changes', __name__)
+
+@blueprint.route('', methods = ['GET'])
+@memdam.server.web.auth.requires_auth
+def changes():
+    """
+    Read the change feed (see memdam.eventstore.api.Eventstore.changes_since). The cursor argument is
+    a JSON Cursor, and limit is the most Changes to return. Results in a list of Changes.
+    """
+    cursor = None
+    if 'cursor' in flask.request.args:
+        cursor = memdam.common.change.Cursor.from_json_dict(json.loads(flask.request.args['cursor']))
+    limit = flask.request.args.get('limit', None, type=int)
+    if limit is not None and limit <= 0:
+        raise memdam.server.web.errors.BadRequest("limit must be positive")
+    archive = memdam.server.web.utils.get_archive(flask.request.authorization.username)
+    result = archive.changes_since(cursor, limit)
+    return flask.Response(json.dumps([change.to_json_dict() for change in result]), mimetype='application/json')
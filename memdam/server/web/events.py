@@ -3,18 +3,38 @@ import uuid
 
 import flask
 
-import memdam.common.event
+import memdam.common.client
+import memdam.common.jsoncodec
+import memdam.common.bincodec
 import memdam.server.web.errors
 import memdam.server.web.utils
 import memdam.server.web.auth
 
 blueprint = flask.Blueprint('events', __name__)
 
+@blueprint.route('', methods = ['POST'])
+@memdam.server.web.auth.requires_auth
+def save_events():
+    """
+    Save many Events at once, sent as binary events (see memdam.common.bincodec) or as a JSON list.
+    """
+    if memdam.server.web.utils.is_binary_request():
+        new_events = memdam.common.bincodec.decode_event_list(flask.request.get_data())
+    elif flask.request.json is not None:
+        new_events = memdam.common.jsoncodec.decode_events(flask.request.json)
+    else:
+        raise memdam.server.web.errors.BadRequest("Must send JSON or binary events.")
+    archive = memdam.server.web.utils.get_archive(flask.request.authorization.username)
+    if len(new_events) > 0:
+        archive.save(new_events)
+    return '', 204
+
 @blueprint.route('/<unsafe_event_id>', methods = ['PUT', 'GET', 'DELETE'])
 @memdam.server.web.auth.requires_auth
 def events(unsafe_event_id):
     """
-    The only way to create new Events on the server.
+    Create (or replace), get or delete a single Event. Events may be sent and received as binary
+    events (see memdam.common.bincodec) instead of JSON.
 
     For now, we just create the blob resources separately. Maybe someday they can be created inline too.
     """
@@ -22,11 +42,21 @@ def events(unsafe_event_id):
     archive = memdam.server.web.utils.get_archive(flask.request.authorization.username)
     if flask.request.method == 'GET':
         event = archive.get(event_id)
-        event_json = event.to_json_dict()
+        content_type = memdam.server.web.utils.response_type('application/json', memdam.common.client.BINARY_CONTENT_TYPE)
+        if content_type == memdam.common.client.BINARY_CONTENT_TYPE:
+            data = memdam.common.bincodec.encode_event_list([event])
+            return flask.Response(data, mimetype=memdam.common.client.BINARY_CONTENT_TYPE)
+        event_json = memdam.common.jsoncodec.encode_event(event)
         return flask.jsonify(event_json)
     elif flask.request.method == 'DELETE':
         archive.delete(event_id)
         return '', 204
+    elif memdam.server.web.utils.is_binary_request():
+        new_events = memdam.common.bincodec.decode_event_list(flask.request.get_data())
+        assert len(new_events) == 1, "Must send exactly one event"
+        assert new_events[0].id__id == event_id, "id__id field must be equal to the id in the event"
+        archive.save(new_events)
+        return '', 204
     else:
         if not flask.request.json:
             raise memdam.server.web.errors.BadRequest("Must send JSON for events.")
@@ -34,6 +64,6 @@ def events(unsafe_event_id):
             "id__id field must be undefined or equal to the id in the event"
         flask.request.json['id__id'] = event_id.hex
         #TODO: run more validation on event json
-        event = memdam.common.event.Event.from_json_dict(flask.request.json)
+        event = memdam.common.jsoncodec.decode_event(flask.request.json)
         archive.save([event])
         return '', 204
@@ -1,7 +1,12 @@
 
+import json
+
 import flask
 
 import memdam.common.query
+import memdam.common.jsoncodec
+import memdam.common.bincodec
+import memdam.common.client
 import memdam.server.web.utils
 import memdam.server.web.auth
 
@@ -20,5 +25,41 @@ def query_events():
         flask.abort(400)
     query = memdam.common.query.Query.from_json_dict(flask.request.json)
     archive = memdam.server.web.utils.get_archive(flask.request.authorization.username)
+    content_type = memdam.server.web.utils.response_type('application/json', memdam.common.client.NDJSON_CONTENT_TYPE,
+                                                         memdam.common.client.BINARY_CONTENT_TYPE)
+    #both of these are streamed, so that huge results never have to be in memory all at once
+    if content_type == memdam.common.client.BINARY_CONTENT_TYPE:
+        chunks = memdam.common.bincodec.encode_events(archive.find_iter(query))
+        return flask.Response(chunks, mimetype=memdam.common.client.BINARY_CONTENT_TYPE)
+    if content_type == memdam.common.client.NDJSON_CONTENT_TYPE:
+        lines = (memdam.common.jsoncodec.encode_line(event) for event in archive.find_iter(query))
+        return flask.Response(lines, mimetype=memdam.common.client.NDJSON_CONTENT_TYPE)
     events = archive.find(query)
-    return flask.jsonify(events)
+    return flask.Response(memdam.common.jsoncodec.encode_events(events), mimetype='application/json')
+
+@blueprint.route('/search', methods = ['POST'])
+@memdam.server.web.auth.requires_auth
+def search_events():
+    """
+    Full text search. The Query must have a match filter. Results in a list of SearchResults, best
+    matches first.
+    """
+    if not flask.request.json:
+        flask.abort(400)
+    query = memdam.common.query.Query.from_json_dict(flask.request.json)
+    archive = memdam.server.web.utils.get_archive(flask.request.authorization.username)
+    results = archive.search(query)
+    return flask.Response(json.dumps([result.to_json_dict() for result in results]), mimetype='application/json')
+
+@blueprint.route('/aggregate', methods = ['POST'])
+@memdam.server.web.auth.requires_auth
+def aggregate_events():
+    """
+    Evaluate an AggregateQuery, which results in a list of AggregateRows (one per bucket and group)
+    """
+    if not flask.request.json:
+        flask.abort(400)
+    query = memdam.common.query.AggregateQuery.from_json_dict(flask.request.json)
+    archive = memdam.server.web.utils.get_archive(flask.request.authorization.username)
+    rows = archive.aggregate(query)
+    return flask.Response(json.dumps([row.to_json_dict() for row in rows]), mimetype='application/json')
@@ -34,10 +34,14 @@ class EventQueryForm(Form):
     start_time = JSDateTimeField('Start', validators=[validators.optional()], description='If specified, all events must occur at or after this time')
     end_time = JSDateTimeField('End', validators=[validators.optional()], description='If specified, all events must occur before this time')
     namespace = TextField('Namespace', description='If specified, all events must be from this namespace')
+    search_field = TextField('Text field', description='The TEXT field to search (eg, body__text)')
+    search = TextField('Search', description='If specified, all events must contain these words in the text field, and the best matches are shown first')
     submit = SubmitField('Submit')
 
-def _make_query(start, end, namespace):
+def _make_query(start, end, namespace, search_field=None, search=None):
     filters = []
+    if search is not None:
+        filters.append(memdam.common.query.QueryFilter(search_field, 'match', search))
     if namespace is not None:
         filters.append(memdam.common.query.QueryFilter('namespace__namespace', '=', namespace))
     if start is not None:
@@ -54,14 +58,26 @@ def main_interface():
     """
     form = EventQueryForm()
     events = {}
+    snippets = []
     if form.validate_on_submit():
         start = form.start_time.data
         end = form.end_time.data
         namespace = form.namespace.data
         if namespace == u'':
             namespace = None
-        query = _make_query(start, end, namespace)
+        search = form.search.data
+        if search == u'':
+            search = None
+        query = _make_query(start, end, namespace, form.search_field.data, search)
         archive = memdam.server.web.utils.get_archive(flask.request.authorization.username)
-        events = archive.find(query)
-        events = sorted(events, key=lambda x: x.time__time)
-    return flask.render_template('index.html', name=flask.request.authorization.username, form=form, events=events, json=json)
+        if search is not None and not form.search_field.data:
+            form.search_field.errors.append(u'Required when searching')
+        elif search is None:
+            events = archive.find(query)
+            events = sorted(events, key=lambda x: x.time__time)
+        else:
+            #already sorted by how well they match
+            results = archive.search(query)
+            events = [result.event for result in results]
+            snippets = [u' '.join(result.snippets.values()) for result in results]
+    return flask.render_template('index.html', name=flask.request.authorization.username, form=form, events=events, snippets=snippets, json=json)
@@ -1,12 +1,22 @@
 
 import os
+import json
+import threading
 
 import flask
 
+import memdam.common.client
 import memdam.blobstore.localfolder
 import memdam.eventstore.sqlite
+import memdam.eventstore.indexing
 from memdam.server.web import app
 
+#(folder, archive options) -> memdam.eventstore.sqlite.Eventstore, so that connections can be reused
+#between requests. Archives from before the options were changed stay open until close_archives, since
+#other requests may still be using them.
+_archives = {}
+_archives_lock = threading.Lock()
+
 def get_archive(username):
     """
     :param username: the name of the user for which we should get the event archive
@@ -20,11 +30,58 @@ def get_archive(username):
 
     assert db_file != ''
     db_file = os.path.join(db_file, username)
-    if not os.path.exists(db_file):
-        os.makedirs(db_file)
-    archive = memdam.eventstore.sqlite.Eventstore(db_file)
+    key = (db_file, _archive_options_key())
+    with _archives_lock:
+        archive = _archives.get(key, None)
+        if archive is None:
+            if not os.path.exists(db_file):
+                os.makedirs(db_file)
+            archive = memdam.eventstore.sqlite.Eventstore(db_file, wal=app.config['DATABASE_WAL'],
+                                                          partition=app.config['DATABASE_PARTITION'],
+                                                          rollups=app.config['DATABASE_ROLLUPS'],
+                                                          changes=app.config['DATABASE_CHANGES'],
+                                                          index_policy=make_index_policy())
+            _archives[key] = archive
     return archive
 
+def _archive_options_key():
+    """
+    :returns: every config option that an archive is created with, so that changing any of them
+    gives a new archive instead of the cached one
+    :rtype: tuple
+    """
+    return (app.config['DATABASE_WAL'], app.config['DATABASE_PARTITION'], app.config['DATABASE_ROLLUPS'],
+            app.config['DATABASE_CHANGES'], json.dumps(app.config['DATABASE_INDICES'], sort_keys=True),
+            app.config['DATABASE_INDEX_ADVISOR'])
+
+def make_index_policy():
+    """
+    :returns: the index policy from the config
+    :rtype: memdam.eventstore.indexing.IndexPolicy
+    """
+    return memdam.eventstore.indexing.IndexPolicy(composite=app.config['DATABASE_INDICES'],
+                                                  advisor=app.config['DATABASE_INDEX_ADVISOR'])
+
+def close_archives():
+    """Close all of the cached archives. Call when the server is shutting down."""
+    with _archives_lock:
+        for archive in _archives.values():
+            archive.close()
+        _archives.clear()
+
+def is_binary_request():
+    """:returns: True iff the body of the request is binary events (see memdam.common.bincodec)"""
+    return flask.request.mimetype == memdam.common.client.BINARY_CONTENT_TYPE
+
+def response_type(*content_types):
+    """
+    :param content_types: the content types that the response can be sent as, in order of preference
+    :type  content_types: list(string)
+    :returns: whichever of those the client would like best
+    :rtype: string
+    """
+    return flask.request.accept_mimetypes.best_match(content_types) or content_types[0]
+
 def get_blobstore(username):
     """
     :param username: the name of the user for which we should get the blobstore folder.
@@ -11,6 +11,7 @@ from funcy import *
 
 import memdam.server.admin
 import memdam.server.web.urls
+import memdam.server.web.utils
 
 def _load_config_from_file(config_file, config_source):
     '''Loads the configuration file if defined'''
@@ -103,8 +104,13 @@ def _run_server():
             server.start()
         except KeyboardInterrupt:
             server.stop()
+        finally:
+            memdam.server.web.utils.close_archives()
     else:
-        memdam.server.web.urls.app.run(debug=True, use_reloader=False)
+        try:
+            memdam.server.web.urls.app.run(debug=True, use_reloader=False)
+        finally:
+            memdam.server.web.utils.close_archives()
 
 def run(**kwargs):
     '''Parses configuration and runs the server'''
@@ -135,6 +141,16 @@ def read_commandline_args():
                         help='the folder where the databases should be stored')
     parser.add_argument('--blobs', dest='BLOBSTORE_FOLDER', type=str,
                         help='the folder where the blobs should be stored')
+    parser.add_argument('--wal', dest='DATABASE_WAL', type=bool,
+                        help='if present, use write-ahead logging so that queries are not blocked by writes')
+    parser.add_argument('--partition', dest='DATABASE_PARTITION', type=str, choices=('year', 'month', 'day'),
+                        help='if present, split each namespace into one database per period of time')
+    parser.add_argument('--rollups', dest='DATABASE_ROLLUPS', type=bool,
+                        help='if present, keep per-minute, hour and day summaries so that aggregates are fast')
+    parser.add_argument('--changes', dest='DATABASE_CHANGES', type=bool,
+                        help='if present, keep a change feed so that clients can read new events without polling')
+    parser.add_argument('--index-advisor', dest='DATABASE_INDEX_ADVISOR', type=str, choices=('suggest', 'build'),
+                        help='if present, suggest (or build) indices for queries that keep scanning whole tables')
     #hack for ipython admin interface:
     argv = sys.argv
     if '--' in sys.argv:
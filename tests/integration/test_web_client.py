@@ -1,5 +1,8 @@
 
 import uuid
+import json
+import datetime
+import StringIO
 
 import nose.tools
 
@@ -7,9 +10,11 @@ import memdam.common.utils
 import memdam.common.timeutils
 import memdam.common.blob
 import memdam.common.event
+import memdam.common.query
 import memdam.common.client
 import memdam.blobstore.https
 import memdam.eventstore.https
+import memdam.eventstore.jsonl
 import memdam.server.web.urls
 
 import tests.integration
@@ -44,6 +49,27 @@ def test_save_and_get_event_with_file():
     saved_event = remote_eventstore.get(event.id__id)
     nose.tools.eq_(event, saved_event)
 
+    #test finding events
+    query = memdam.common.query.Query(filters=(memdam.common.query.QueryFilter(u'namespace__namespace', u'=', u"some.data.type"),))
+    nose.tools.eq_(remote_eventstore.find(query), [event])
+    nose.tools.eq_(list(remote_eventstore.find_iter(query)), [event])
+
+    #test the same things with binary events
+    binary_eventstore = memdam.eventstore.https.Eventstore(client, binary=True)
+    other_event = memdam.common.event.new(u"some.data.type", cpu__number__percent=0.1)
+    binary_eventstore.save([other_event])
+    nose.tools.eq_(binary_eventstore.get(other_event.id__id), other_event)
+    nose.tools.eq_(set(binary_eventstore.find(query)), set([event, other_event]))
+
+    #test exporting a range of time from the server (so the query has to be sent as JSON)
+    exported_event = memdam.common.event.new(u"some.exported.type", time__time=event.time__time + datetime.timedelta(days=1))
+    remote_eventstore.save([exported_event])
+    output = StringIO.StringIO()
+    export_query = memdam.eventstore.jsonl.make_query(start=exported_event.time__time,
+                                                      end=exported_event.time__time + datetime.timedelta(seconds=1))
+    nose.tools.eq_(memdam.eventstore.jsonl.export_events(remote_eventstore, output, export_query), 1)
+    nose.tools.eq_(json.loads(output.getvalue())[u'id__id'], exported_event.id__id.hex)
+
     tests.integration.stop_server(server)
 
 def run_server():
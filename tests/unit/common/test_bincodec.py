@@ -0,0 +1,60 @@
+import uuid
+import struct
+
+import nose.tools
+
+import memdam.common.timeutils
+import memdam.common.blob
+import memdam.common.event
+import memdam.common.jsoncodec
+import memdam.common.bincodec
+
+def _make_events():
+    return [
+        memdam.common.event.new(
+            u"some.data.type",
+            cpu__number__percent=0.567,
+            a1_2__string__rfc123=u"Didnt+Look+Up+This+Data+Format \u2603",
+            b__text=u"string for searching",
+            c__enum__country=u"USA",
+            d__bool=True,
+            e__time=memdam.common.timeutils.now(),
+            f__id=uuid.uuid4(),
+            g__long=-184467440737095516L,
+            h__file=memdam.common.blob.BlobReference(uuid.uuid4(), u"txt"),
+            i__namespace=u"some.thing",
+            j__raw=buffer(uuid.uuid4().bytes)
+        ),
+        memdam.common.event.new(u"some.data.type", x__long=1L),
+        memdam.common.event.new(u"some.data.type", x__long=2L),
+    ]
+
+def test_round_trip():
+    """Every type of value should survive being encoded and decoded"""
+    events = _make_events()
+    data = memdam.common.bincodec.encode_event_list(events)
+    nose.tools.eq_(memdam.common.bincodec.decode_event_list(data), events)
+    nose.tools.ok_(len(data) < len(memdam.common.jsoncodec.encode_events(events)))
+
+def test_chunks():
+    """Events should be decoded no matter how the stream is split up"""
+    events = _make_events()
+    data = memdam.common.bincodec.encode_event_list(events)
+    for size in (1, 7, 100):
+        chunks = (data[i:i + size] for i in range(0, len(data), size))
+        nose.tools.eq_(list(memdam.common.bincodec.decode_events(chunks)), events)
+
+@nose.tools.raises(AssertionError)
+def test_truncated():
+    """Streams that end in the middle of an event should fail"""
+    data = memdam.common.bincodec.encode_event_list(_make_events())
+    list(memdam.common.bincodec.decode_events([data[:-1]]))
+
+@nose.tools.raises(AssertionError)
+def test_invalid_namespace_value():
+    """Values that can be invalid even with the right type should still be checked"""
+    event = memdam.common.event.new(u"some.data.type", i__namespace=u"some.thing")
+    data = memdam.common.bincodec.encode_event_list([event])
+    encoded = struct.pack('>I', len(u"some.thing")) + "some.thing"
+    data = data.replace(encoded, struct.pack('>I', len(u"some thing")) + "some thing")
+    memdam.common.bincodec.decode_event_list(data)
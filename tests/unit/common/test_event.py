@@ -1,6 +1,7 @@
 
 import json
 import uuid
+import pickle
 
 import nose.tools
 
@@ -41,5 +42,46 @@ def test_max_long():
     """Should throw an AssertionError if a long attr is >= 2**64"""
     memdam.common.event.new("some.data.type", temp__long=2**64)
 
+def test_layouts_are_shared():
+    """Events from the same namespace with the same fields should share one layout, and have no dict"""
+    first = memdam.common.event.new(u"some.data.type", x__long=1L)
+    second = memdam.common.event.new(u"some.data.type", x__long=2L)
+    nose.tools.ok_(first._layout is second._layout)
+    nose.tools.ok_(not hasattr(first, '__dict__'))
+    nose.tools.eq_(second.x__long, 2L)
+    nose.tools.eq_(first.keys, frozenset((u'type__namespace', u'id__id', u'time__time', u'x__long')))
+    nose.tools.eq_(getattr(first, 'y__long', None), None)
+
+def test_pickle():
+    """Events should survive pickling, eg, to be sent to another process"""
+    event = memdam.common.event.new(u"some.data.type", x__long=1L, f__file=memdam.common.blob.BlobReference(uuid.uuid4(), u"txt"))
+    nose.tools.eq_(pickle.loads(pickle.dumps(event)), event)
+    nose.tools.eq_(pickle.loads(pickle.dumps(event, pickle.HIGHEST_PROTOCOL)), event)
+
+def test_from_trusted_dict():
+    """Trusted data should make exactly the same event as the normal constructor"""
+    event = memdam.common.event.new(u"some.data.type", x__long=1L)
+    data = dict((key, getattr(event, key)) for key in event.keys)
+    nose.tools.eq_(memdam.common.event.Event.from_trusted_dict(data), event)
+
+def test_equality_and_hash():
+    """Events with the same fields and values should be equal and hash the same, and nothing else should"""
+    event = memdam.common.event.new(u"some.data.type", x__long=1L, r__raw=buffer('abc'))
+    same = memdam.common.event.new(u"some.data.type", id__id=event.id__id, time__time=event.time__time,
+                                   x__long=1L, r__raw=buffer('abc'))
+    nose.tools.eq_(event, same)
+    nose.tools.ok_(not event != same)
+    nose.tools.eq_(hash(event), hash(same))
+    nose.tools.eq_(len(set([event, same])), 1)
+    different_value = memdam.common.event.new(u"some.data.type", id__id=event.id__id, time__time=event.time__time,
+                                              x__long=2L, r__raw=buffer('abc'))
+    different_fields = memdam.common.event.new(u"some.data.type", id__id=event.id__id, time__time=event.time__time,
+                                               x__long=1L)
+    different_namespace = memdam.common.event.new(u"some.other.type", id__id=event.id__id,
+                                                  time__time=event.time__time, x__long=1L, r__raw=buffer('abc'))
+    for other in (different_value, different_fields, different_namespace, None):
+        nose.tools.ok_(event != other)
+    nose.tools.eq_(len(set([event, different_value, different_fields, different_namespace])), 4)
+
 if __name__ == '__main__':
     test_serialization()
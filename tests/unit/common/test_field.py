@@ -0,0 +1,34 @@
+import uuid
+import datetime
+
+import pytz
+import nose.tools
+
+import memdam.common.field
+
+def test_describe_is_shared():
+    """Every name should be parsed only once"""
+    descriptor = memdam.common.field.describe(u'cpu__number__percent')
+    nose.tools.ok_(descriptor is memdam.common.field.describe(u'cpu__number__percent'))
+    nose.tools.eq_(descriptor.raw_name, u'cpu')
+    nose.tools.eq_(descriptor.type, memdam.common.field.FieldType.NUMBER)
+    nose.tools.eq_(descriptor.secondary_type, u'PERCENT')
+    nose.tools.eq_(descriptor.sql_type, 'FLOAT')
+
+def test_codecs_round_trip():
+    """Values should survive being converted to JSON and to sqlite and back"""
+    values = {
+        u'a__time': datetime.datetime(2014, 6, 1, 2, 3, 4, 5000, tzinfo=pytz.UTC),
+        u'a__id': uuid.uuid4(),
+        u'a__raw': buffer('\x00\x01binary'),
+        u'a__long': 12L,
+    }
+    for name, value in values.items():
+        descriptor = memdam.common.field.describe(name)
+        nose.tools.eq_(descriptor.from_json(descriptor.to_json(value)), value)
+        nose.tools.eq_(descriptor.from_sql(descriptor.to_sql(value)), value)
+
+@nose.tools.raises(AttributeError)
+def test_invalid_type():
+    """Names without a valid type should not be described"""
+    memdam.common.field.describe(u'cpu__nonsense')
@@ -0,0 +1,56 @@
+import json
+import uuid
+import datetime
+
+import pytz
+import nose.tools
+
+import memdam.common.timeutils
+import memdam.common.blob
+import memdam.common.event
+import memdam.common.jsoncodec
+
+def _make_event():
+    return memdam.common.event.new(
+        u"some.data.type",
+        cpu__number__percent=0.567,
+        b__text=u"string for searching",
+        d__bool=True,
+        e__time=memdam.common.timeutils.now(),
+        f__id=uuid.uuid4(),
+        g__long=184467440737095516L,
+        h__file=memdam.common.blob.BlobReference(uuid.uuid4(), u"txt"),
+        j__raw=buffer(uuid.uuid4().bytes)
+        )
+
+def test_same_as_event():
+    """The codec should read and write exactly what Event.to_json_dict and from_json_dict do"""
+    event = _make_event()
+    json_dict = json.loads(json.dumps(event.to_json_dict()))
+    nose.tools.eq_(memdam.common.jsoncodec.encode_event(event), event.to_json_dict())
+    nose.tools.eq_(memdam.common.jsoncodec.decode_event(json_dict), event)
+    nose.tools.eq_(memdam.common.jsoncodec.decode_line(memdam.common.jsoncodec.encode_line(event)), event)
+
+def test_lists():
+    """Lists of events should round trip in one call"""
+    events = [_make_event() for _ in range(0, 3)]
+    events.append(memdam.common.event.new(u"some.other.type", x__long=1L))
+    nose.tools.eq_(memdam.common.jsoncodec.decode_events(memdam.common.jsoncodec.encode_events(events)), events)
+
+@nose.tools.raises(AssertionError)
+def test_values_are_checked():
+    """Values of the wrong type should still be rejected"""
+    json_dict = _make_event().to_json_dict()
+    json_dict[u'd__bool'] = u"yes"
+    memdam.common.jsoncodec.decode_event(json_dict)
+
+def test_parse_time():
+    """The fast path should give the same times as dateutil, which is still used for anything else"""
+    times = [
+        datetime.datetime(2014, 6, 1, 2, 3, 4, tzinfo=pytz.UTC),
+        datetime.datetime(2014, 6, 1, 2, 3, 4, 5000, tzinfo=pytz.UTC),
+        datetime.datetime(2014, 6, 1, 2, 3, 4, 5000, tzinfo=pytz.timezone('US/Pacific').localize(datetime.datetime(2014, 6, 1)).tzinfo),
+    ]
+    for value in times:
+        nose.tools.eq_(memdam.common.timeutils.parse_time(unicode(value.isoformat())), value)
+    nose.tools.eq_(memdam.common.timeutils.parse_time(u"2014-06-01T02:03:04.5Z"), times[0] + datetime.timedelta(microseconds=500000))
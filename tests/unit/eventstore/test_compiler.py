@@ -0,0 +1,71 @@
+
+import uuid
+import datetime
+
+import pytz
+import nose.tools
+
+import memdam.common.query
+import memdam.eventstore.sqlite
+import memdam.eventstore.compiler
+
+QueryFilter = memdam.common.query.QueryFilter
+
+def test_compile_binds_values():
+    """Values should never be formatted into the sql"""
+    compiler = memdam.eventstore.compiler.QueryCompiler()
+    filters = [QueryFilter(u'time__time', u'>=', 5L), QueryFilter(u'x__string', u'=', u"'; DROP TABLE x; --")]
+    sql, args = compiler.compile(filters, [u'time__time', u'x__string'], u"com.test")
+    nose.tools.eq_(sql, u"time__time >= ? AND x__string = ?")
+    nose.tools.eq_(args, (5L, u"'; DROP TABLE x; --"))
+
+def test_compile_converts_values():
+    """Values should be stored the same way as the column that they are compared to"""
+    compiler = memdam.eventstore.compiler.QueryCompiler()
+    now = datetime.datetime(2014, 1, 1, tzinfo=pytz.utc)
+    event_id = uuid.uuid4()
+    filters = [QueryFilter(u'time__time', u'<', now), QueryFilter(event_id, u'=', u'id__id')]
+    _, args = compiler.compile(filters, [u'time__time', u'id__id'], u"com.test")
+    nose.tools.eq_(args, (memdam.eventstore.sqlite.convert_time_to_long(now), buffer(event_id.bytes)))
+
+def test_compile_nested():
+    """Nested filters should be grouped, and the namespace bound as a value"""
+    compiler = memdam.eventstore.compiler.QueryCompiler()
+    query_filter = QueryFilter(QueryFilter(u'namespace__namespace', u'=', u"com.a"), u'or', QueryFilter(u'x__long', u'>', 1L))
+    sql, args = compiler.compile([query_filter], [u'x__long'], u"com.b")
+    nose.tools.eq_(sql, u"(? = ? OR x__long > ?)")
+    nose.tools.eq_(args, (u"com.b", u"com.a", 1L))
+
+def test_compile_missing_column():
+    """Columns that the table doesn't have should be NULL"""
+    compiler = memdam.eventstore.compiler.QueryCompiler()
+    sql, _ = compiler.compile([QueryFilter(u'x__long', u'>', 1L)], [u'time__time'], u"com.test")
+    nose.tools.eq_(sql, u"NULL > ?")
+
+def test_compile_is_cached():
+    """Queries that only differ by their values should share the same compiled form"""
+    compiler = memdam.eventstore.compiler.QueryCompiler()
+    compiler.compile([QueryFilter(u'time__time', u'>=', 1L)], [u'time__time'], u"com.a")
+    compiler.compile([QueryFilter(u'time__time', u'>=', 2L)], [u'time__time', u'x__long'], u"com.b")
+    nose.tools.eq_(len(compiler._cache), 1)
+
+@nose.tools.raises(AssertionError)
+def test_compile_rejects_bad_operator():
+    memdam.eventstore.compiler.QueryCompiler().compile([QueryFilter(u'time__time', u'; DELETE', 1L)], [], u"com.test")
+
+def test_time_bounds():
+    """Only the comparisons with time__time that must be true should limit the range"""
+    QueryFilter = memdam.common.query.QueryFilter
+    filters = [QueryFilter(5L, u'<=', u'time__time'),
+               QueryFilter(QueryFilter(u'time__time', u'<', 10L), u'and', QueryFilter(u'x__long', u'=', 1L)),
+               QueryFilter(QueryFilter(u'time__time', u'<', 7L), u'or', QueryFilter(u'x__long', u'=', 1L))]
+    nose.tools.eq_(memdam.eventstore.compiler.time_bounds(filters), (5L, 10L))
+    nose.tools.eq_(memdam.eventstore.compiler.time_bounds([QueryFilter(u'time__time', u'=', 3L)]), (3L, 4L))
+    nose.tools.eq_(memdam.eventstore.compiler.time_bounds([]), (None, None))
+
+def test_compile_match():
+    """match should search the fts table for the field"""
+    compiler = memdam.eventstore.compiler.QueryCompiler()
+    sql, args = compiler.compile([QueryFilter(u'body__text', u'match', u"hello")], [u'body__text'], u"com.test", u"com_test")
+    nose.tools.eq_(sql, u"_id IN (SELECT docid FROM com_test__body__text__docs WHERE data MATCH ?)")
+    nose.tools.eq_(args, (u"hello",))
@@ -0,0 +1,64 @@
+
+import threading
+
+import nose.tools
+
+import memdam.common.event
+import memdam.common.query
+import memdam.eventstore.sqlite
+import memdam.eventstore.groupcommit
+
+NAMESPACE = u"com.memdam.test"
+
+class CountingEventstore(memdam.eventstore.sqlite.Eventstore):
+    """Remembers how many times save was called"""
+    def __init__(self, *args, **kwargs):
+        memdam.eventstore.sqlite.Eventstore.__init__(self, *args, **kwargs)
+        self.num_saves = 0
+
+    def save(self, events):
+        self.num_saves += 1
+        memdam.eventstore.sqlite.Eventstore.save(self, events)
+
+def _save_concurrently(archive, event_lists):
+    errors = []
+    def save(events):
+        try:
+            archive.save(events)
+        except Exception, e:
+            errors.append(e)
+    threads = [threading.Thread(target=save, args=(events,)) for events in event_lists]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+def test_concurrent_saves_are_combined():
+    """Saves from many threads at once should be committed together"""
+    backing = CountingEventstore(":memory:")
+    archive = memdam.eventstore.groupcommit.Eventstore(backing, window=0.5)
+    event_lists = [[memdam.common.event.new(NAMESPACE, x__long=long(i))] for i in range(0, 10)]
+    errors = _save_concurrently(archive, event_lists)
+    nose.tools.eq_(errors, [])
+    assert backing.num_saves < len(event_lists)
+    saved = archive.find(memdam.common.query.Query())
+    nose.tools.eq_(set(saved), set(events[0] for events in event_lists))
+
+def test_full_batch_is_saved_immediately():
+    """Batches that reach the max size should not wait for the window"""
+    backing = CountingEventstore(":memory:")
+    archive = memdam.eventstore.groupcommit.Eventstore(backing, window=60.0, max_batch_size=2)
+    events = [memdam.common.event.new(NAMESPACE), memdam.common.event.new(NAMESPACE)]
+    archive.save(events)
+    nose.tools.eq_(archive.get(events[0].id__id), events[0])
+
+def test_errors_reach_every_caller():
+    """If the combined save fails, every caller should find out"""
+    class FailingEventstore(CountingEventstore):
+        def save(self, events):
+            raise Exception("disk full")
+    archive = memdam.eventstore.groupcommit.Eventstore(FailingEventstore(":memory:"), window=0.2)
+    event_lists = [[memdam.common.event.new(NAMESPACE)] for _ in range(0, 3)]
+    errors = _save_concurrently(archive, event_lists)
+    nose.tools.eq_(len(errors), 3)
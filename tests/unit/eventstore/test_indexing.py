@@ -0,0 +1,46 @@
+import sqlite3
+
+import nose.tools
+
+import memdam.common.query
+import memdam.eventstore.indexing
+
+QueryFilter = memdam.common.query.QueryFilter
+
+def test_candidate_columns():
+    """Equality columns should come first, then one range column, ignoring ORs and missing columns"""
+    filters = [
+        QueryFilter(u'x__long', u'>', 5L),
+        QueryFilter(u'host__string', u'=', u"a"),
+        QueryFilter(QueryFilter(u'y__long', u'=', 1L), u'or', QueryFilter(u'y__long', u'=', 2L)),
+        QueryFilter(u'missing__string', u'=', u"b"),
+    ]
+    columns = [u'x__long', u'y__long', u'host__string', u'time__time']
+    nose.tools.eq_(memdam.eventstore.indexing.candidate_columns(filters, columns), (u'host__string', u'x__long'))
+
+def test_index_name():
+    """Single column indices should have the same names as they always have"""
+    nose.tools.eq_(memdam.eventstore.indexing.index_name(u'com_x', (u'time__time',)), u'com_x__time__time__asc')
+
+@nose.tools.raises(AssertionError)
+def test_policy_rejects_bad_fields():
+    memdam.eventstore.indexing.IndexPolicy(composite={u'com.x': [[u'x__long; DROP TABLE x']]})
+
+def test_advisor():
+    """Repeated table scans should be suggested once, and index usage counted"""
+    conn = sqlite3.connect(":memory:")
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE t (_id INTEGER PRIMARY KEY, time__time INTEGER, x__long INTEGER);")
+    cur.execute("CREATE INDEX t__time__time__asc ON t (time__time ASC);")
+    policy = memdam.eventstore.indexing.IndexPolicy(advisor='build', advisor_threshold=2)
+    advisor = memdam.eventstore.indexing.IndexAdvisor(policy)
+    columns = [u'time__time', u'x__long']
+    scan_filters = [QueryFilter(u'x__long', u'=', 1L)]
+    time_filters = [QueryFilter(u'time__time', u'>', 1L)]
+    for _ in range(3):
+        advisor.observe(cur, u't', "SELECT * FROM t WHERE x__long = ?;", (1L,), scan_filters, columns)
+    advisor.observe(cur, u't', "SELECT * FROM t WHERE time__time > ?;", (1L,), time_filters, columns)
+    nose.tools.eq_(advisor.suggestions(), [(u't', (u'x__long',), 3)])
+    nose.tools.eq_(advisor.take_pending(), [(u't', (u'x__long',))])
+    nose.tools.eq_(advisor.take_pending(), [])
+    nose.tools.eq_(advisor.uses(u't'), {u't__time__time__asc': 1})
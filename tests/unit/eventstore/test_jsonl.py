@@ -0,0 +1,88 @@
+import os
+import json
+import shutil
+import datetime
+import StringIO
+
+import pytz
+import nose.tools
+
+import memdam.common.utils
+import memdam.common.event
+import memdam.common.query
+import memdam.eventstore.sqlite
+import memdam.eventstore.jsonl
+
+NAMESPACE = u"com.memdam.test"
+OTHER_NAMESPACE = u"com.memdam.other"
+
+def _make_events():
+    start = datetime.datetime(2014, 6, 1, tzinfo=pytz.UTC)
+    events = []
+    for i in range(0, 5):
+        time = start + datetime.timedelta(seconds=i)
+        events.append(memdam.common.event.new(NAMESPACE, time__time=time, x__long=long(i), body__text=u"cat"))
+        events.append(memdam.common.event.new(OTHER_NAMESPACE, time__time=time, y__number=float(i)))
+    return events
+
+def _make_archive(events=()):
+    archive = memdam.eventstore.sqlite.Eventstore(":memory:")
+    archive.save(events)
+    return archive
+
+def _all_events(archive):
+    return set(archive.find(memdam.common.query.Query()))
+
+def test_round_trip_compressed():
+    """Exporting to a .gz file and importing it again should give back exactly the same events"""
+    events = _make_events()
+    temp_folder = memdam.common.utils.make_temp_path()
+    os.mkdir(temp_folder)
+    path = os.path.join(temp_folder, 'events.jsonl.gz')
+    output = memdam.eventstore.jsonl.open_file(path, 'w')
+    count = memdam.eventstore.jsonl.export_events(_make_archive(events), output, memdam.eventstore.jsonl.make_query())
+    output.close()
+    nose.tools.eq_(count, len(events))
+    archive = _make_archive()
+    lines = memdam.eventstore.jsonl.open_file(path, 'r')
+    nose.tools.eq_(memdam.eventstore.jsonl.import_events(archive, lines, batch_size=3), len(events))
+    lines.close()
+    shutil.rmtree(temp_folder)
+    nose.tools.eq_(_all_events(archive), set(events))
+
+def test_export_selects_namespace_and_time():
+    """Only events from the namespaces and time range should be exported, in order of time"""
+    events = _make_events()
+    output = StringIO.StringIO()
+    query = memdam.eventstore.jsonl.make_query([NAMESPACE], events[2].time__time, events[8].time__time)
+    memdam.eventstore.jsonl.export_events(_make_archive(events), output, query)
+    exported = [json.loads(line)[u'id__id'] for line in output.getvalue().splitlines()]
+    nose.tools.eq_(exported, [events[i].id__id.hex for i in (2, 4, 6)])
+    #the same query should work after being sent to a server
+    sent = memdam.common.query.Query.from_json_dict(json.loads(json.dumps(query.to_json_dict())))
+    output = StringIO.StringIO()
+    memdam.eventstore.jsonl.export_events(_make_archive(events), output, sent)
+    nose.tools.eq_([json.loads(line)[u'id__id'] for line in output.getvalue().splitlines()], exported)
+
+def test_import_selects_namespace_and_time():
+    """Only events from the namespaces and time range should be imported"""
+    events = _make_events()
+    lines = [json.dumps(event.to_json_dict()) for event in events] + ['']
+    archive = _make_archive()
+    count = memdam.eventstore.jsonl.import_events(archive, lines, [OTHER_NAMESPACE], end=events[4].time__time)
+    nose.tools.eq_(count, 2)
+    nose.tools.eq_(_all_events(archive), set((events[1], events[3])))
+
+def test_bulk_import_resumes():
+    """Importing again with the same bulk load name should skip the lines that were committed"""
+    events = _make_events()
+    lines = [json.dumps(event.to_json_dict()) for event in events]
+    archive = _make_archive()
+    session = archive.bulk_load(u"restore")
+    session.save([], checkpoint=4)
+    session.flush()
+    count = memdam.eventstore.jsonl.import_events(archive, lines, batch_size=2, bulk_load=u"restore")
+    nose.tools.eq_(count, len(events) - 4)
+    nose.tools.eq_(_all_events(archive), set(events[4:]))
+    match = memdam.common.query.Query(filters=[memdam.common.query.QueryFilter(u'body__text', u'match', u"cat")])
+    nose.tools.eq_(len(archive.search(match)), 3)
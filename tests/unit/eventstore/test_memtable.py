@@ -0,0 +1,105 @@
+import os
+import shutil
+import unittest
+import datetime
+
+import pytz
+import nose.tools
+
+import memdam.common.utils
+import memdam.common.event
+import memdam.common.query
+import memdam.eventstore.sqlite
+import memdam.eventstore.memtable
+
+NAMESPACE = u"com.memdam.test"
+
+class CountingEventstore(memdam.eventstore.sqlite.Eventstore):
+    """Remembers every event that was saved"""
+    def __init__(self, *args, **kwargs):
+        memdam.eventstore.sqlite.Eventstore.__init__(self, *args, **kwargs)
+        self.saved = []
+
+    def save(self, events):
+        self.saved.extend(events)
+        memdam.eventstore.sqlite.Eventstore.save(self, events)
+
+def _make_events(count):
+    start = datetime.datetime(2014, 6, 1, tzinfo=pytz.UTC)
+    return [memdam.common.event.new(NAMESPACE, time__time=start + datetime.timedelta(seconds=i), x__long=long(i))
+            for i in range(0, count)]
+
+def _by_time(limit=None):
+    return memdam.common.query.Query(order=[(u'time__time', True)], limit=limit)
+
+class MemtableTest(unittest.TestCase):
+    def setUp(self):
+        self.log_folder = memdam.common.utils.make_temp_path()
+        self.backing = CountingEventstore(":memory:")
+        self.archive = memdam.eventstore.memtable.Eventstore(self.backing, self.log_folder, flush_interval=3600)
+        self.closed = False
+
+    def tearDown(self):
+        if not self.closed:
+            self.archive.close()
+        shutil.rmtree(self.log_folder)
+
+    def test_reads_see_buffered_events(self):
+        """Events should be found before they are flushed, merged with the flushed ones in order"""
+        events = _make_events(6)
+        self.archive.save(events[::2])
+        self.archive.flush()
+        self.archive.save(events[1::2])
+        nose.tools.eq_(len(self.backing.saved), 3)
+        nose.tools.eq_(self.archive.get(events[1].id__id), events[1])
+        nose.tools.eq_(self.archive.get_many([events[3].id__id, events[2].id__id]), [events[3], events[2]])
+        nose.tools.eq_(self.archive.find(_by_time()), events)
+        nose.tools.eq_(self.archive.find(_by_time(limit=4)), events[:4])
+
+    def test_buffered_events_hide_flushed_versions(self):
+        """Saving an event again should replace the flushed version in every result"""
+        events = _make_events(3)
+        self.archive.save(events)
+        self.archive.flush()
+        replacement = memdam.common.event.new(NAMESPACE, id__id=events[0].id__id, time__time=events[0].time__time,
+                                              x__long=100L)
+        self.archive.save([replacement])
+        nose.tools.eq_(self.archive.get(events[0].id__id), replacement)
+        nose.tools.eq_(self.archive.find(_by_time(limit=2)), [replacement, events[1]])
+
+    def test_deleted_before_flush_is_never_saved(self):
+        """Events that are deleted while still in the memtable should never reach the wrapped Eventstore"""
+        events = _make_events(4)
+        self.archive.save(events)
+        self.archive.delete(events[0].id__id)
+        self.archive.delete(events[2].id__id)
+        nose.tools.eq_(self.archive.find(_by_time()), [events[1], events[3]])
+        self.archive.close()
+        self.closed = True
+        nose.tools.eq_(self.backing.saved, [events[1], events[3]])
+        nose.tools.eq_(os.listdir(self.log_folder), [])
+
+    def test_aggregate_flushes_first(self):
+        """aggregate should include the buffered events"""
+        self.archive.save(_make_events(5))
+        query = memdam.common.query.AggregateQuery(filters=[], aggregates=[(u'sum', u'x__long')])
+        nose.tools.eq_(self.archive.aggregate(query)[0].values, [10])
+        nose.tools.eq_(len(self.backing.saved), 5)
+
+    def test_logs_are_replayed(self):
+        """Events that were never flushed (because the process died) should be saved when reopened"""
+        events = _make_events(5)
+        self.archive.save(events[:2])
+        self.archive.flush()
+        self.archive.save(events[2:])
+        self.archive.delete(events[3].id__id)
+        #as if the process had died right now
+        crashed_folder = memdam.common.utils.make_temp_path()
+        shutil.copytree(self.log_folder, crashed_folder)
+        backing = CountingEventstore(":memory:")
+        archive = memdam.eventstore.memtable.Eventstore(backing, crashed_folder, flush_interval=3600)
+        nose.tools.eq_(set(backing.saved), set((events[2], events[4])))
+        archive.save(events[:1])
+        archive.close()
+        nose.tools.eq_(os.listdir(crashed_folder), [])
+        shutil.rmtree(crashed_folder)
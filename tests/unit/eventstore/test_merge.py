@@ -0,0 +1,31 @@
+
+import nose.tools
+
+import memdam.eventstore.merge
+
+def test_merge_sorted():
+    """Should merge sorted lists into one sorted list"""
+    merged = memdam.eventstore.merge.merge_sorted([[1, 4, 7], [2, 3], [], [5, 6]], key=lambda x: x)
+    nose.tools.eq_(list(merged), [1, 2, 3, 4, 5, 6, 7])
+
+def test_merge_sorted_limit():
+    """Should stop pulling items as soon as the limit is reached"""
+    def numbers():
+        for i in range(0, 1000):
+            pulled.append(i)
+            yield i
+    pulled = []
+    merged = memdam.eventstore.merge.merge_sorted([numbers(), [0.5]], key=lambda x: x, limit=3)
+    nose.tools.eq_(list(merged), [0, 0.5, 1])
+    assert len(pulled) <= 3
+
+def test_merge_without_key():
+    """Without a key, should simply concatenate (up to the limit)"""
+    merged = memdam.eventstore.merge.merge_sorted([[3, 1], [2]], limit=2)
+    nose.tools.eq_(list(merged), [3, 1])
+
+def test_descending():
+    """Descending should reverse the order of its values"""
+    Descending = memdam.eventstore.merge.Descending
+    key = lambda x: (Descending(x[0]), x[1])
+    nose.tools.eq_(sorted([(1, 2), (2, 1), (1, 1)], key=key), [(2, 1), (1, 1), (1, 2)])
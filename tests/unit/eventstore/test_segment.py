@@ -0,0 +1,54 @@
+import uuid
+import sqlite3
+
+import nose.tools
+
+import memdam.eventstore.segment
+
+def test_columns_round_trip():
+    """Every type of column should decode to exactly what was encoded, NULLs included"""
+    columns = {
+        u'time__time': [1388534400000000L, 1388534410000000L, None, 1388534430000000L],
+        u'cpu__number': [0.5, None, -1.25, 1e100],
+        u'count__long': [None, 3L, -9223372036854775808L, 9223372036854775807L],
+        u'up__bool': [1, 0, None, 1],
+        u'id__id': [buffer(uuid.uuid4().bytes), None, buffer(uuid.uuid4().bytes), buffer(uuid.uuid4().bytes)],
+    }
+    for name, values in columns.items():
+        nulls, data = memdam.eventstore.segment.encode_column(name, values)
+        decoded = memdam.eventstore.segment.decode_column(name, len(values), nulls, data)
+        nose.tools.eq_([str(value) for value in decoded], [str(value) for value in values])
+
+def test_samples_compress():
+    """Regular samples should take up far less space than rows (which need at least 50 bytes)"""
+    times = [1388534400000000L + 10000000L * i for i in range(0, 4096)]
+    nulls, data = memdam.eventstore.segment.encode_column(u'time__time', times)
+    nose.tools.eq_(nulls, None)
+    assert len(data) < 100
+    nulls, data = memdam.eventstore.segment.encode_column(u'cpu__number', [float(i % 7) for i in range(0, 4096)])
+    assert len(data) < 400
+
+def test_batches():
+    """Batches ordered by time should only be split where segments don't overlap"""
+    segments = [(1, 0, 10, 3), (2, 11, 20, 3), (3, 15, 30, 3), (4, 31, 40, 3)]
+    nose.tools.eq_(memdam.eventstore.segment.batches(segments, False, max_rows=3), [[1], [2], [3], [4]])
+    nose.tools.eq_(memdam.eventstore.segment.batches(segments, True, max_rows=3), [[1], [2, 3], [4]])
+    nose.tools.eq_(memdam.eventstore.segment.batches(segments, True), [[1, 2, 3, 4]])
+
+def test_seal_and_remove():
+    """Sealing should move old rows into segments, and removing should take them back out"""
+    cur = sqlite3.connect(":memory:").cursor()
+    cur.execute("CREATE TABLE samples(_id INTEGER PRIMARY KEY, id__id TEXT, time__time INTEGER, x__long INTEGER);")
+    ids = [uuid.uuid4() for i in range(0, 5)]
+    cur.executemany("INSERT INTO samples (id__id, time__time, x__long) VALUES (?, ?, ?);",
+                    [(buffer(ids[i].bytes), 100L * i, long(i)) for i in range(0, 5)])
+    memdam.eventstore.segment.create(cur, u'samples')
+    nose.tools.eq_(memdam.eventstore.segment.seal(cur, u'samples', 400L, segment_size=2), 4)
+    cur.execute("SELECT x__long FROM samples;")
+    nose.tools.eq_(cur.fetchall(), [(4,)])
+    segments = memdam.eventstore.segment.find(cur, u'samples', 150L, 250L)
+    nose.tools.eq_([segment[1:] for segment in segments], [(200L, 300L, 2)])
+    nose.tools.eq_(memdam.eventstore.segment.remove(cur, u'samples', [ids[2], ids[4]]), {ids[2]: 200L})
+    segment_ids = [segment[0] for segment in memdam.eventstore.segment.find(cur, u'samples')]
+    rows = memdam.eventstore.segment.load_rows(cur, u'samples', segment_ids, [u'time__time', u'x__long', u'y__long'])
+    nose.tools.eq_(sorted(rows), [(0L, 0L, None), (100L, 1L, None), (300L, 3L, None)])
@@ -1,9 +1,11 @@
 
 import shutil
 import uuid
+import datetime
 import os
 import unittest
 
+import pytz
 import nose.tools
 
 import memdam
@@ -12,9 +14,25 @@ import memdam.common.timeutils
 import memdam.common.blob
 import memdam.common.event
 import memdam.common.query
+import memdam.common.change
 import memdam.eventstore.sqlite
+import memdam.eventstore.segment
+import memdam.eventstore.rollup
+import memdam.eventstore.indexing
 
 NAMESPACE = u"somedatatype"
+SAMPLE_NAMESPACE = u"com.memdam.samples"
+
+def _new_samples(count):
+    """:returns: events like those from a sampling collector, every 10 seconds"""
+    start = datetime.datetime(2014, 1, 1, tzinfo=pytz.utc)
+    events = []
+    for i in range(0, count):
+        fields = dict(time__time=start + datetime.timedelta(seconds=10*i), cpu__number=i / 10.0, up__bool=i % 2 == 0)
+        if i % 3 != 0:
+            fields['n__long'] = long(i)
+        events.append(memdam.common.event.new(SAMPLE_NAMESPACE, **fields))
+    return events
 
 class SqliteBase(unittest.TestCase):
     """
@@ -85,6 +103,63 @@ class SqliteBase(unittest.TestCase):
         returned_events = set(self.archive.find(memdam.common.query.Query()))
         nose.tools.eq_(returned_events, set(events))
 
+    def test_save_is_idempotent(self):
+        """Saving the same events again should not duplicate them"""
+        self.archive.save([self.simple_event, self.complex_event])
+        self.archive.save([self.complex_event, self.complex_event])
+        returned_events = self.archive.find(memdam.common.query.Query())
+        nose.tools.eq_(len(returned_events), 2)
+        nose.tools.eq_(set(returned_events), set([self.simple_event, self.complex_event]))
+        nose.tools.eq_(self.archive.get(self.complex_event.id__id), self.complex_event)
+
+    def test_old_tables_are_deduplicated(self):
+        """Tables with duplicate events from before id__id was unique should be cleaned up"""
+        self.archive.save([self.simple_event])
+        table_name = self.archive._table_name_for_event(self.simple_event)
+        with self.archive._connection(table_name, read_only=False) as conn:
+            cur = conn.cursor()
+            cur.execute("DROP INDEX %s__id__id__unique;" % (table_name))
+            cur.execute("CREATE INDEX %s__id__id__asc ON %s (id__id ASC);" % (table_name, table_name))
+            cur.execute("INSERT INTO %s SELECT _id + 1, time__time, id__id, cpu__number__percent FROM %s;" % (table_name, table_name))
+            conn.commit()
+        self.archive._catalog.invalidate(table_name)
+        nose.tools.eq_(len(self.archive.find(memdam.common.query.Query())), 2)
+        self.archive.save([self.complex_event, self.simple_event])
+        returned_events = self.archive.find(memdam.common.query.Query())
+        nose.tools.eq_(len(returned_events), 2)
+        nose.tools.eq_(set(returned_events), set([self.simple_event, self.complex_event]))
+
+    def test_find_many_text_events(self):
+        """TEXT fields should be loaded correctly for results that span several pages"""
+        num_events = memdam.eventstore.sqlite.Eventstore.PAGE_SIZE * 2 + 1
+        events = [memdam.common.event.new(NAMESPACE, body__text=u"message %s" % (i)) for i in range(0, num_events)]
+        self.archive.save(events)
+        returned_events = set(self.archive.find(memdam.common.query.Query()))
+        nose.tools.eq_(returned_events, set(events))
+
+    def test_schema_is_cached(self):
+        """Saving events should only look at the schema when there is a new column"""
+        self.archive.save([self.complex_event])
+        calls = []
+        original = self.archive._query_existing_columns
+        def counting_query_existing_columns(*args):
+            calls.append(args)
+            return original(*args)
+        self.archive._query_existing_columns = counting_query_existing_columns
+        self.archive.save([memdam.common.event.new(NAMESPACE, cpu__number__percent=0.1)])
+        nose.tools.eq_(len(calls), 0)
+        new_event = memdam.common.event.new(NAMESPACE, brand_new__long=5)
+        self.archive.save([new_event])
+        assert len(calls) > 0
+        nose.tools.eq_(self.archive.get(new_event.id__id), new_event)
+
+    def test_find_iter(self):
+        """Iterating over the results should yield the same events as find"""
+        self.archive.save([self.simple_event, self.complex_event])
+        returned_events = self.archive.find_iter(memdam.common.query.Query())
+        assert not isinstance(returned_events, list)
+        nose.tools.eq_(set(returned_events), set([self.simple_event, self.complex_event]))
+
     def test_find_query_limit(self):
         """Queries should respect the limit parameter"""
         events = [self.simple_event, self.complex_event]
@@ -104,6 +179,102 @@ class SqliteBase(unittest.TestCase):
         nose.tools.eq_(self.archive.find(memdam.common.query.Query(order=[(u'key__string', True)]))[0], c)
         nose.tools.eq_(self.archive.find(memdam.common.query.Query(order=[(u'key__string', False)]))[0], b)
 
+    def test_find_query_order_across_namespaces(self):
+        """Order and limit should apply to all events, not just to the events within each namespace"""
+        start = memdam.common.timeutils.now()
+        namespaces = [u"a.b", u"c.d", u"a.b", u"e.f", u"c.d"]
+        events = [memdam.common.event.new(namespaces[i], time__time=start + datetime.timedelta(seconds=i), cpu__number=float(i)) \
+                  for i in range(0, len(namespaces))]
+        self.archive.save(events)
+        nose.tools.eq_(self.archive.find(memdam.common.query.Query(order=[(u'time__time', True)], limit=3)), events[:3])
+        nose.tools.eq_(self.archive.find(memdam.common.query.Query(order=[(u'time__time', False)], limit=2)), [events[4], events[3]])
+        nose.tools.eq_(len(self.archive.find(memdam.common.query.Query(limit=2))), 2)
+
+    def test_find_query_order_by_missing_column(self):
+        """Ordering by a column that only exists in some namespaces should treat it as NULL elsewhere"""
+        a = memdam.common.event.new(u"a.b", cpu__number=0.2)
+        b = memdam.common.event.new(u"c.d", memory__number=0.1)
+        self.archive.save([a, b])
+        nose.tools.eq_(self.archive.find(memdam.common.query.Query(order=[(u'cpu__number', True)])), [b, a])
+        nose.tools.eq_(self.archive.find(memdam.common.query.Query(order=[(u'type__namespace', False)])), [b, a])
+
+    def test_find_query_filters(self):
+        """Queries should only return the events that match all of their filters"""
+        a = memdam.common.event.new(NAMESPACE, cpu__number=0.1, key__string=u"aaa")
+        b = memdam.common.event.new(NAMESPACE, cpu__number=0.2, key__string=u"b'b")
+        c = memdam.common.event.new(u"com.other", x__long=3L)
+        self.archive.save([a, b, c])
+        QueryFilter = memdam.common.query.QueryFilter
+        def find(*filters):
+            return set(self.archive.find(memdam.common.query.Query(filters=filters)))
+        nose.tools.eq_(find(QueryFilter(u'cpu__number', u'>', 0.15)), set([b]))
+        nose.tools.eq_(find(QueryFilter(u'key__string', u'=', u"b'b")), set([b]))
+        nose.tools.eq_(find(QueryFilter(u'time__time', u'<=', b.time__time), QueryFilter(u'id__id', u'=', a.id__id)), set([a]))
+        nose.tools.eq_(find(QueryFilter(QueryFilter(u'cpu__number', u'<', 0.15), u'or', QueryFilter(u'x__long', u'=', 3L))), set([a, c]))
+
+    def test_find_text_match(self):
+        """match filters should find the events whose TEXT field contains the words"""
+        a = memdam.common.event.new(NAMESPACE, body__text=u"running through the fields", x__long=1L)
+        b = memdam.common.event.new(NAMESPACE, body__text=u"sitting quietly", x__long=2L)
+        self.archive.save([a, b, self.simple_event])
+        QueryFilter = memdam.common.query.QueryFilter
+        def find(*filters):
+            return self.archive.find(memdam.common.query.Query(filters=filters))
+        #porter stemming means that run matches running
+        nose.tools.eq_(find(QueryFilter(u'body__text', u'match', u"run")), [a])
+        nose.tools.eq_(find(QueryFilter(u'body__text', u'match', u"run"), QueryFilter(u'x__long', u'>', 1L)), [])
+        nose.tools.eq_(find(QueryFilter(u'other__text', u'match', u"run")), [])
+
+    def test_search(self):
+        """Search results should be ranked by how well they match, with snippets"""
+        a = memdam.common.event.new(NAMESPACE, body__text=u"a cat and a dog")
+        b = memdam.common.event.new(NAMESPACE, body__text=u"cat cat cat")
+        c = memdam.common.event.new(u"com.other", body__text=u"cat and more cat")
+        d = memdam.common.event.new(NAMESPACE, body__text=u"nothing to see here")
+        self.archive.save([a, b, c, d])
+        match = memdam.common.query.QueryFilter(u'body__text', u'match', u"cat")
+        results = self.archive.search(memdam.common.query.Query(filters=[match]))
+        nose.tools.eq_([x.event for x in results], [b, c, a])
+        assert results[0].rank > results[1].rank > results[2].rank
+        nose.tools.eq_(results[2].snippets, {u'body__text': u"a <b>cat</b> and a dog"})
+        limited = self.archive.search(memdam.common.query.Query(filters=[match], limit=1))
+        nose.tools.eq_([x.event for x in limited], [b])
+
+    def test_aggregate(self):
+        """Aggregates should be calculated per bucket and group, across namespaces"""
+        start = datetime.datetime(2014, 1, 1, tzinfo=pytz.utc)
+        def new(namespace, minutes, **kwargs):
+            return memdam.common.event.new(namespace, time__time=start + datetime.timedelta(minutes=minutes), **kwargs)
+        self.archive.save([
+            new(NAMESPACE, 1, cpu__number=0.5, host__string=u"a"),
+            new(NAMESPACE, 2, cpu__number=1.5, host__string=u"a"),
+            new(NAMESPACE, 3, cpu__number=1.0, host__string=u"b"),
+            new(NAMESPACE, 61, cpu__number=2.0, host__string=u"a"),
+            new(u"com.other", 62, cpu__number=4.0),
+        ])
+        AggregateQuery = memdam.common.query.AggregateQuery
+        AggregateRow = memdam.common.query.AggregateRow
+        aggregates = ((u'count', None), (u'avg', u'cpu__number'), (u'max', u'time__time'))
+        rows = self.archive.aggregate(AggregateQuery(aggregates=aggregates, bucket=3600))
+        nose.tools.eq_(rows, [
+            AggregateRow(start, None, [3, 1.0, start + datetime.timedelta(minutes=3)]),
+            AggregateRow(start + datetime.timedelta(hours=1), None, [2, 3.0, start + datetime.timedelta(minutes=62)]),
+        ])
+        namespace_filter = memdam.common.query.QueryFilter(u'namespace__namespace', u'=', NAMESPACE)
+        rows = self.archive.aggregate(AggregateQuery(filters=[namespace_filter], aggregates=[(u'sum', u'cpu__number')], group_by=u'host__string'))
+        nose.tools.eq_(rows, [AggregateRow(None, u"a", [4.0]), AggregateRow(None, u"b", [1.0])])
+
+    @nose.tools.raises(AssertionError)
+    def test_aggregate_rejects_bad_fields(self):
+        self.archive.aggregate(memdam.common.query.AggregateQuery(aggregates=[(u'sum', u'x__string')]))
+
+    def test_aggregate_rejects_bad_buckets(self):
+        """Buckets have to be a whole number of seconds"""
+        self.archive.save([self.simple_event])
+        for bucket in (0.5, 0, -60, 1.5, float('inf'), u"60"):
+            query = memdam.common.query.AggregateQuery(aggregates=[(u'count', None)], bucket=bucket)
+            nose.tools.assert_raises(AssertionError, self.archive.aggregate, query)
+
     def test_delete(self):
         self.archive.save([self.simple_event])
         self.archive.delete(self.simple_event.id__id)
@@ -116,7 +287,183 @@ class SqliteBase(unittest.TestCase):
         returned_events = set(self.archive.find(memdam.common.query.Query()))
         nose.tools.eq_(len(returned_events), 0)
 
+    def test_get_many(self):
+        """Getting several Events by id should return them in the same order"""
+        other_event = memdam.common.event.new(u"com.other", x__long=1L)
+        self.archive.save([self.simple_event, self.complex_event, other_event])
+        ids = [other_event.id__id, self.simple_event.id__id, self.complex_event.id__id]
+        nose.tools.eq_(self.archive.get_many(ids), [other_event, self.simple_event, self.complex_event])
+
+    @nose.tools.raises(Exception)
+    def test_get_many_fails_with_bad_id(self):
+        self.archive.save([self.simple_event])
+        self.archive.get_many([self.simple_event.id__id, uuid.uuid4()])
+
+    @nose.tools.raises(Exception)
+    def test_get_fails_after_delete(self):
+        self.archive.save([self.simple_event])
+        self.archive.delete(self.simple_event.id__id)
+        self.archive.get(self.simple_event.id__id)
+
+    def test_get_only_reads_one_table(self):
+        """Looking up an event by id should not touch the tables for other namespaces"""
+        other_event = memdam.common.event.new(u"com.other", x__long=1L)
+        self.archive.save([self.simple_event, other_event])
+        read_tables = []
+        original_get_events_from_table = self.archive._get_events_from_table
+        def recording_get_events_from_table(table_name, event_ids):
+            read_tables.append(table_name)
+            return original_get_events_from_table(table_name, event_ids)
+        self.archive._get_events_from_table = recording_get_events_from_table
+        nose.tools.eq_(self.archive.get(other_event.id__id), other_event)
+        nose.tools.eq_([memdam.eventstore.sqlite.table_name_to_namespace(x) for x in read_tables], [u"com.other"])
+
+    def test_delete_missing_event(self):
+        """Deleting an event that doesn't exist should do nothing"""
+        self.archive.save([self.simple_event])
+        self.archive.delete(uuid.uuid4())
+        nose.tools.eq_(self.archive.find(memdam.common.query.Query()), [self.simple_event])
+
     #TODO: decide whether attributes with the same name and different types are allowed, and make a test
+    def test_only_time_and_id_are_indexed(self):
+        """Other columns should not be indexed unless the policy asks for it"""
+        self.archive.save([self.complex_event])
+        for table_name, stats in self.archive.index_stats().items():
+            nose.tools.eq_(sorted(stats.keys()), [table_name + u'__id__id__unique', table_name + u'__time__time__asc'])
+
+    def test_composite_indices(self):
+        """Indices from the policy should be created once their columns exist, and can be dropped"""
+        policy = memdam.eventstore.indexing.IndexPolicy(composite={NAMESPACE: [[u'cpu__number__percent', u'time__time']]})
+        self.archive._index_policy = policy
+        self.archive.save([self.simple_event])
+        table_name = self.archive._all_table_names()[0]
+        index_name = table_name + u'__cpu__number__percent__time__time__asc'
+        nose.tools.ok_(index_name in self.archive.index_stats()[table_name])
+        query_filter = memdam.common.query.QueryFilter(u'cpu__number__percent', u'=', 0.567)
+        nose.tools.eq_(self.archive.find(memdam.common.query.Query(filters=[query_filter])), [self.simple_event])
+        nose.tools.eq_(self.archive.index_stats()[table_name][index_name], 1)
+        self.archive.drop_index(table_name, index_name)
+        nose.tools.ok_(index_name not in self.archive.index_stats()[table_name])
+
+    def test_composite_indices_ignore_case(self):
+        """An existing index whose name only differs in case should not be created again"""
+        self.archive.save([self.simple_event])
+        table_name = self.archive._all_table_names()[0]
+        with self.archive._connection(table_name, read_only=False) as conn:
+            cur = conn.cursor()
+            cur.execute("CREATE INDEX %s__cpu__number__percent__time__time__ASC ON %s (cpu__number__percent, time__time);" % (table_name, table_name))
+            conn.commit()
+            self.archive._catalog.update(table_name, self.archive._table_columns(cur, table_name).values(),
+                                         self.archive._query_existing_indices(cur, table_name))
+        self.archive._index_policy = memdam.eventstore.indexing.IndexPolicy(composite={NAMESPACE: [[u'cpu__number__percent', u'time__time']]})
+        nose.tools.eq_(self.archive._missing_composite_indices(table_name), [])
+
+    def test_index_advisor_builds_indices(self):
+        """Queries that keep scanning a whole table should get an index"""
+        self.archive._advisor = memdam.eventstore.indexing.IndexAdvisor(memdam.eventstore.indexing.IndexPolicy(advisor='build', advisor_threshold=2))
+        self.archive.save([self.simple_event])
+        query = memdam.common.query.Query(filters=[memdam.common.query.QueryFilter(u'cpu__number__percent', u'>', 0.5)])
+        for _ in range(3):
+            nose.tools.eq_(self.archive.find(query), [self.simple_event])
+        table_name = self.archive._all_table_names()[0]
+        nose.tools.eq_(self.archive.index_stats()[table_name][table_name + u'__cpu__number__percent__asc'], 1)
+
+    def test_bulk_load(self):
+        """Bulk loaded events should only be fully indexed and searchable once the load finishes"""
+        events = [memdam.common.event.new(NAMESPACE, body__text=u"cat number %s" % (i), x__long=i) for i in range(5)]
+        match = memdam.common.query.Query(filters=[memdam.common.query.QueryFilter(u'body__text', u'match', u"cat")])
+        with self.archive.bulk_load(u"import", batch_size=2) as session:
+            session.save(events[:3])
+            session.save(events[3:])
+            session.flush()
+            nose.tools.eq_(set(self.archive.find(memdam.common.query.Query())), set(events))
+            nose.tools.eq_(self.archive.search(match), [])
+            for table_name, stats in self.archive.index_stats().items():
+                nose.tools.eq_(stats.keys(), [table_name + u'__id__id__unique'])
+            #replacing an event during the load should replace its document too
+            events[0] = memdam.common.event.new(NAMESPACE, id__id=events[0].id__id, time__time=events[0].time__time, body__text=u"dog")
+            session.save([events[0]])
+        nose.tools.eq_(set(result.event for result in self.archive.search(match)), set(events[1:]))
+        for table_name, stats in self.archive.index_stats().items():
+            nose.tools.eq_(sorted(stats.keys()), [table_name + u'__id__id__unique', table_name + u'__time__time__asc'])
+
+    def test_bulk_load_resumes(self):
+        """A bulk load that didn't finish should carry on from its last checkpoint"""
+        events = [memdam.common.event.new(NAMESPACE, body__text=u"cat", x__long=i) for i in range(4)]
+        session = self.archive.bulk_load(u"import")
+        nose.tools.eq_(session.checkpoint, None)
+        session.save(events[:2], checkpoint=2)
+        session.flush()
+        session.save(events[2:3], checkpoint=3)
+        resumed = self.archive.bulk_load(u"import")
+        nose.tools.eq_(resumed.checkpoint, 2)
+        resumed.save(events[resumed.checkpoint:], checkpoint=4)
+        resumed.finish()
+        nose.tools.eq_(set(self.archive.find(memdam.common.query.Query())), set(events))
+        match = memdam.common.query.Query(filters=[memdam.common.query.QueryFilter(u'body__text', u'match', u"cat")])
+        nose.tools.eq_(len(self.archive.search(match)), 4)
+        nose.tools.eq_(self.archive.bulk_load(u"import").checkpoint, None)
+
+    def test_seal(self):
+        """Sealed events should be found, gotten and aggregated exactly as before"""
+        events = _new_samples(25)
+        self.archive.save(events)
+        self.archive.save([self.complex_event])
+        aggregates = ((u'count', None), (u'sum', u'cpu__number'), (u'min', u'n__long'), (u'avg', u'n__long'))
+        aggregate_query = memdam.common.query.AggregateQuery(aggregates=aggregates, bucket=60)
+        expected_aggregates = self.archive.aggregate(aggregate_query)
+        nose.tools.eq_(self.archive.seal(SAMPLE_NAMESPACE, events[20].time__time, segment_size=8), 20)
+        #only samples can be sealed
+        nose.tools.eq_(self.archive.seal(NAMESPACE, events[-1].time__time), 0)
+        nose.tools.eq_(set(self.archive.find(memdam.common.query.Query())), set(events + [self.complex_event]))
+        nose.tools.eq_(self.archive.get(events[3].id__id), events[3])
+        nose.tools.eq_(self.archive.aggregate(aggregate_query), expected_aggregates)
+        samples = memdam.common.query.QueryFilter(u'namespace__namespace', u'=', SAMPLE_NAMESPACE)
+        latest = memdam.common.query.Query(filters=[samples], order=[(u'time__time', False)], limit=7)
+        nose.tools.eq_(self.archive.find(latest), events[-7:][::-1])
+        def find(*filters):
+            return self.archive.find(memdam.common.query.Query(filters=filters, order=[(u'time__time', True)]))
+        start = memdam.common.query.QueryFilter(u'time__time', u'>=', events[5].time__time)
+        end = memdam.common.query.QueryFilter(u'time__time', u'<', events[22].time__time)
+        nose.tools.eq_(find(start, end), events[5:22])
+        cpu = memdam.common.query.QueryFilter(u'cpu__number', u'>', 1.75)
+        up = memdam.common.query.QueryFilter(u'up__bool', u'=', True)
+        nose.tools.eq_(find(cpu, up), [events[i] for i in (18, 20, 22, 24)])
+
+    def test_sealed_order_across_batches(self):
+        """Sealed events ordered by something other than time should be in order, even across batches"""
+        start = datetime.datetime(2014, 1, 1, tzinfo=pytz.utc)
+        values = [9, 3, 0, 11, 5, 2, 7, 1, 10, 4, 8, 6]
+        events = [memdam.common.event.new(SAMPLE_NAMESPACE, time__time=start + datetime.timedelta(seconds=10*i),
+                                          cpu__number=float(value)) for i, value in enumerate(values)]
+        self.archive.save(events)
+        self.archive.seal(SAMPLE_NAMESPACE, events[-1].time__time + datetime.timedelta(seconds=1), segment_size=2)
+        batches = memdam.eventstore.segment.batches
+        memdam.eventstore.segment.batches = lambda segments, ordered_by_time: batches(segments, ordered_by_time, max_rows=4)
+        try:
+            by_cpu = sorted(events, key=lambda event: event.cpu__number)
+            def find(ascending, limit=None):
+                return self.archive.find(memdam.common.query.Query(order=[(u'cpu__number', ascending)], limit=limit))
+            nose.tools.eq_(find(True), by_cpu)
+            nose.tools.eq_(find(True, limit=3), by_cpu[:3])
+            nose.tools.eq_(find(False, limit=3), by_cpu[::-1][:3])
+        finally:
+            memdam.eventstore.segment.batches = batches
+
+    def test_sealed_events_can_be_replaced_and_deleted(self):
+        """Saving or deleting a sealed event should take it out of its segment"""
+        events = _new_samples(10)
+        self.archive.save(events)
+        self.archive.seal(SAMPLE_NAMESPACE, events[-1].time__time, segment_size=4)
+        events[2] = memdam.common.event.new(SAMPLE_NAMESPACE, id__id=events[2].id__id, time__time=events[7].time__time, cpu__number=7.0)
+        self.archive.save([events[2]])
+        deleted = events.pop(5)
+        self.archive.delete(deleted.id__id)
+        nose.tools.eq_(sorted(self.archive.find(memdam.common.query.Query()), key=lambda event: event.id__id),
+                       sorted(events, key=lambda event: event.id__id))
+        nose.tools.eq_(self.archive.get(events[2].id__id), events[2])
+        nose.tools.assert_raises(Exception, self.archive.get, deleted.id__id)
+
     #TODO: decide whether these query objects make any sense, or if we should just use raw sql, or some other approach...
     #TODO (far future) test query filters
 
@@ -133,12 +480,356 @@ class LocalFileTest(SqliteBase):
     def setUp(self, ):
         self._temp_file = memdam.common.utils.make_temp_path()
         os.mkdir(self._temp_file)
-        self.archive = memdam.eventstore.sqlite.Eventstore(self._temp_file)
+        self.archive = memdam.eventstore.sqlite.Eventstore(self._temp_file, **self.archive_kwargs())
+
+    def archive_kwargs(self):
+        """:returns: any extra options for creating the archive"""
+        return {}
 
     def tearDown(self):
+        self.archive.close()
         if os.path.exists(self._temp_file):
             shutil.rmtree(self._temp_file)
 
+    def test_id_index_is_rebuilt(self):
+        """Folders without an id index (eg, from older versions) should get one the first time"""
+        self.archive.save([self.simple_event, self.complex_event])
+        self.archive.close()
+        os.remove(os.path.join(self._temp_file, u"_event_ids.idx"))
+        self.archive = memdam.eventstore.sqlite.Eventstore(self._temp_file, **self.archive_kwargs())
+        nose.tools.eq_(self.archive.get(self.complex_event.id__id), self.complex_event)
+
+    def test_bulk_load_survives_restart(self):
+        """Indices dropped by a bulk load should come back even if it is finished by another process"""
+        session = self.archive.bulk_load(u"import")
+        session.save([self.simple_event], checkpoint=u"done")
+        session.flush()
+        self.archive.close()
+        self.archive = memdam.eventstore.sqlite.Eventstore(self._temp_file, **self.archive_kwargs())
+        session = self.archive.bulk_load(u"import")
+        nose.tools.eq_(session.checkpoint, u"done")
+        session.finish()
+        table_name = self.archive._all_table_names()[0]
+        nose.tools.eq_(sorted(self.archive.index_stats()[table_name].keys()), [table_name + u'__id__id__unique', table_name + u'__time__time__asc'])
+
+    def test_sealed_by_another_instance(self):
+        """Events sealed through another Eventstore on the same folder (eg, by the admin tool) should still be found and replaced"""
+        events = _new_samples(10)
+        self.archive.save(events)
+        other = memdam.eventstore.sqlite.Eventstore(self._temp_file, **self.archive_kwargs())
+        nose.tools.eq_(other.seal(SAMPLE_NAMESPACE, events[8].time__time), 8)
+        other.close()
+        nose.tools.eq_(set(self.archive.find(memdam.common.query.Query())), set(events))
+        nose.tools.eq_(self.archive.get(events[0].id__id), events[0])
+        events[0] = memdam.common.event.new(SAMPLE_NAMESPACE, id__id=events[0].id__id, time__time=events[0].time__time, cpu__number=9.0)
+        self.archive.save([events[0]])
+        nose.tools.eq_(set(self.archive.find(memdam.common.query.Query())), set(events))
+
+    def test_bulk_load_read_by_another_instance(self):
+        """Documents staged by a bulk load should be found through another Eventstore on the same folder"""
+        events = [memdam.common.event.new(NAMESPACE, body__text=u"cat number %s" % (i), x__long=i) for i in range(3)]
+        session = self.archive.bulk_load(u"import")
+        session.save(events)
+        session.flush()
+        other = memdam.eventstore.sqlite.Eventstore(self._temp_file, **self.archive_kwargs())
+        try:
+            nose.tools.eq_(set(other.find(memdam.common.query.Query())), set(events))
+            nose.tools.eq_(other.get(events[1].id__id), events[1])
+            events[0] = memdam.common.event.new(NAMESPACE, id__id=events[0].id__id, time__time=events[0].time__time, body__text=u"dog")
+            other.save([events[0]])
+        finally:
+            other.close()
+        session.finish()
+        nose.tools.eq_(set(self.archive.find(memdam.common.query.Query())), set(events))
+
+class WalTest(LocalFileTest):
+    """Run all sqlite archive tests with the on-disk database in write-ahead logging mode"""
+    def archive_kwargs(self):
+        return dict(wal=True, checkpoint_interval=0.1)
+
+    def test_read_while_writing(self):
+        """Readers should not be blocked by an open write transaction"""
+        self.archive.save([self.simple_event])
+        table_name = memdam.eventstore.sqlite.namespace_to_table_name(NAMESPACE)
+        with self.archive._connection(table_name, read_only=False) as conn:
+            conn.cursor().execute("BEGIN IMMEDIATE")
+            nose.tools.eq_(self.archive.find(memdam.common.query.Query()), [self.simple_event])
+            conn.rollback()
+
+class PartitionTest(LocalFileTest):
+    """Run all sqlite archive tests with the on-disk database, partitioned by month"""
+    def archive_kwargs(self):
+        return dict(partition='month')
+
+    def _new_event(self, year, month, **kwargs):
+        return memdam.common.event.new(NAMESPACE, time__time=datetime.datetime(year, month, 15, tzinfo=pytz.utc), **kwargs)
+
+    def test_save_into_partitions(self):
+        """Events from different months should go into different tables"""
+        events = [self._new_event(2014, 1), self._new_event(2014, 2), self._new_event(2014, 2)]
+        self.archive.save(events)
+        table_name = memdam.eventstore.sqlite.namespace_to_table_name(NAMESPACE)
+        nose.tools.eq_(sorted(self.archive._all_table_names()), [table_name + u'__201401', table_name + u'__201402'])
+        nose.tools.eq_(set(self.archive.find(memdam.common.query.Query())), set(events))
+        nose.tools.eq_(self.archive.get(events[0].id__id), events[0])
+
+    def test_find_skips_partitions(self):
+        """Partitions outside of the time__time filters should not even be looked at"""
+        january = self._new_event(2014, 1)
+        february = self._new_event(2014, 2)
+        self.archive.save([january, february])
+        read_tables = []
+        original_find = self.archive._find_matching_events_in_table
+        def recording_find(table_name, query):
+            read_tables.append(table_name)
+            return original_find(table_name, query)
+        self.archive._find_matching_events_in_table = recording_find
+        start = memdam.common.query.QueryFilter(u'time__time', u'>=', datetime.datetime(2014, 2, 1, tzinfo=pytz.utc))
+        nose.tools.eq_(self.archive.find(memdam.common.query.Query(filters=[start])), [february])
+        nose.tools.eq_(read_tables, [memdam.eventstore.sqlite.namespace_to_table_name(NAMESPACE) + u'__201402'])
+
+    def test_drop_partitions(self):
+        """Dropping old partitions should remove only their events"""
+        january = self._new_event(2014, 1)
+        february = self._new_event(2014, 2)
+        self.archive.save([january, february])
+        dropped = self.archive.drop_partitions(NAMESPACE, datetime.datetime(2014, 2, 10, tzinfo=pytz.utc))
+        nose.tools.eq_(dropped, [memdam.eventstore.sqlite.namespace_to_table_name(NAMESPACE) + u'__201401'])
+        nose.tools.eq_(self.archive.find(memdam.common.query.Query()), [february])
+        nose.tools.assert_raises(Exception, self.archive.get, january.id__id)
+
+    def test_archive_partitions(self):
+        """Archived partitions should be readable from their new folder"""
+        january = self._new_event(2014, 1)
+        february = self._new_event(2014, 2)
+        self.archive.save([january, february])
+        destination = os.path.join(self._temp_file, u"archive")
+        os.mkdir(destination)
+        self.archive.archive_partitions(NAMESPACE, datetime.datetime(2014, 2, 1, tzinfo=pytz.utc), destination)
+        nose.tools.eq_(self.archive.find(memdam.common.query.Query()), [february])
+        archived = memdam.eventstore.sqlite.Eventstore(destination)
+        try:
+            nose.tools.eq_(archived.find(memdam.common.query.Query()), [january])
+            nose.tools.eq_(archived.get(january.id__id), january)
+        finally:
+            archived.close()
+
+class RollupTest(LocalFileTest):
+    """Run all sqlite archive tests with the on-disk database, with rollups"""
+    def archive_kwargs(self):
+        return dict(rollups=True)
+
+    def _new_event(self, minutes, **kwargs):
+        start = datetime.datetime(2014, 1, 1, tzinfo=pytz.utc)
+        return memdam.common.event.new(NAMESPACE, time__time=start + datetime.timedelta(minutes=minutes), **kwargs)
+
+    def _aggregate_both_ways(self, query):
+        """:returns: the results of the query from the rollups (which must be used), and from the events"""
+        original_aggregate_table = self.archive._aggregate_table
+        def failing_aggregate_table(table_name, query, accumulator):
+            raise Exception("Should have used the rollups for %s" % (table_name))
+        self.archive._aggregate_table = failing_aggregate_table
+        from_rollups = self.archive.aggregate(query)
+        self.archive._aggregate_table = original_aggregate_table
+        self.archive._rollups = False
+        from_events = self.archive.aggregate(query)
+        self.archive._rollups = True
+        return from_rollups, from_events
+
+    def test_aggregate_from_rollups(self):
+        """Aggregates over whole hours should come from the rollups, and match the events exactly"""
+        events = [
+            self._new_event(1, cpu__number=0.5, count__long=3),
+            self._new_event(2, cpu__number=1.5),
+            self._new_event(61, cpu__number=2.0, count__long=-1),
+            self._new_event(60*25, count__long=7),
+        ]
+        self.archive.save(events)
+        #replacing an event should replace its values
+        events[1] = self._new_event(2, id__id=events[1].id__id, cpu__number=5.0)
+        self.archive.save([events[1]])
+        self.archive.delete(events[2].id__id)
+        self.archive.save([self._new_event(62, cpu__number=1.0)])
+        aggregates = ((u'count', None), (u'avg', u'cpu__number'), (u'min', u'count__long'), (u'max', u'cpu__number'), (u'sum', u'count__long'))
+        start = memdam.common.query.QueryFilter(u'time__time', u'>=', datetime.datetime(2014, 1, 1, tzinfo=pytz.utc))
+        for query in (memdam.common.query.AggregateQuery(aggregates=aggregates, bucket=3600),
+                      memdam.common.query.AggregateQuery(aggregates=aggregates, bucket=86400, group_by=u'namespace__namespace'),
+                      memdam.common.query.AggregateQuery(filters=[start], aggregates=aggregates)):
+            from_rollups, from_events = self._aggregate_both_ways(query)
+            nose.tools.eq_(from_rollups, from_events)
+        nose.tools.eq_(from_rollups, [memdam.common.query.AggregateRow(None, None, [4, 13.0/6, 3, 5.0, 10])])
+
+    def test_aggregate_uses_events_when_necessary(self):
+        """Anything that the rollups can't answer exactly should still be calculated from the events"""
+        self.archive.save([self._new_event(1, cpu__number=0.5), self._new_event(90, cpu__number=1.5)])
+        middle = memdam.common.query.QueryFilter(u'time__time', u'<', datetime.datetime(2014, 1, 1, 1, 29, 30, tzinfo=pytz.utc))
+        query = memdam.common.query.AggregateQuery(filters=[middle], aggregates=[(u'sum', u'cpu__number')])
+        nose.tools.eq_(memdam.eventstore.rollup.choose_grain(query, [middle]), None)
+        nose.tools.eq_(self.archive.aggregate(query), [memdam.common.query.AggregateRow(None, None, [0.5])])
+
+    def test_rollups_are_created_for_existing_tables(self):
+        """Turning rollups on should summarize the events that were already saved"""
+        self.archive.close()
+        self.archive = memdam.eventstore.sqlite.Eventstore(self._temp_file)
+        self.archive.save([self._new_event(1, cpu__number=0.5)])
+        self.archive.close()
+        self.archive = memdam.eventstore.sqlite.Eventstore(self._temp_file, **self.archive_kwargs())
+        self.archive.save([self._new_event(2, cpu__number=1.5)])
+        query = memdam.common.query.AggregateQuery(aggregates=[(u'count', None), (u'sum', u'cpu__number')], bucket=60)
+        from_rollups, from_events = self._aggregate_both_ways(query)
+        nose.tools.eq_(from_rollups, from_events)
+        nose.tools.eq_(len(from_rollups), 2)
+
+    def test_rollups_include_sealed_events(self):
+        """Rollups should still match the events after sealing, even when sealed events change"""
+        self.archive.close()
+        self.archive = memdam.eventstore.sqlite.Eventstore(self._temp_file)
+        events = _new_samples(30)
+        self.archive.save(events)
+        self.archive.seal(SAMPLE_NAMESPACE, events[20].time__time, segment_size=8)
+        self.archive.close()
+        self.archive = memdam.eventstore.sqlite.Eventstore(self._temp_file, **self.archive_kwargs())
+        self.archive.save([memdam.common.event.new(SAMPLE_NAMESPACE, id__id=events[1].id__id, time__time=events[1].time__time, cpu__number=9.0)])
+        self.archive.delete(events[4].id__id)
+        query = memdam.common.query.AggregateQuery(aggregates=[(u'count', None), (u'max', u'cpu__number'), (u'sum', u'n__long')], bucket=60)
+        from_rollups, from_events = self._aggregate_both_ways(query)
+        nose.tools.eq_(from_rollups, from_events)
+        nose.tools.eq_(from_rollups[0].values, [5, 9.0, 2 + 5])
+
+    def test_rollups_kept_current_without_option(self):
+        """Saves and deletes through an Eventstore without rollups turned on should still update the existing rollups"""
+        events = [self._new_event(1, cpu__number=1.0), self._new_event(2, cpu__number=2.0)]
+        self.archive.save(events[:1])
+        other = memdam.eventstore.sqlite.Eventstore(self._temp_file)
+        other.save(events[1:])
+        other.save([self._new_event(3, cpu__number=4.0)])
+        other.delete(self.archive.find(memdam.common.query.Query(order=[(u'time__time', True)]))[-1].id__id)
+        other.close()
+        query = memdam.common.query.AggregateQuery(aggregates=[(u'count', None), (u'sum', u'cpu__number')], bucket=3600)
+        from_rollups, from_events = self._aggregate_both_ways(query)
+        nose.tools.eq_(from_rollups, from_events)
+        nose.tools.eq_(from_rollups[0].values, [2, 3.0])
+
+    def test_rollups_are_hidden_in_memory(self):
+        """Rollup tables should never be mistaken for namespaces"""
+        archive = memdam.eventstore.sqlite.Eventstore(":memory:", rollups=True)
+        archive.save([self.simple_event])
+        nose.tools.eq_(archive._all_table_names(), [memdam.eventstore.sqlite.namespace_to_table_name(NAMESPACE)])
+        archive.close()
+
+class ChangesTest(LocalFileTest):
+    """Run all sqlite archive tests with the on-disk database, with a change feed"""
+    def archive_kwargs(self):
+        return dict(changes=True)
+
+    def _changed_ids(self, changes):
+        return [(change.event_id, change.deleted) for change in changes]
+
+    def test_changes_since(self):
+        """Every save and delete should be in the feed, and each event only once, with its latest change"""
+        events = _new_samples(4)
+        self.archive.save(events[:2])
+        changes = self.archive.changes_since()
+        nose.tools.eq_(self._changed_ids(changes), [(events[0].id__id, False), (events[1].id__id, False)])
+        nose.tools.eq_(changes[0].namespace, SAMPLE_NAMESPACE)
+        cursor = memdam.common.change.Cursor().advance(changes)
+        self.archive.save(events[2:])
+        self.archive.save([events[0]])
+        self.archive.delete(events[2].id__id)
+        changes = self.archive.changes_since(cursor)
+        nose.tools.eq_(self._changed_ids(changes), [(events[3].id__id, False), (events[0].id__id, False), (events[2].id__id, True)])
+        nose.tools.eq_(self._changed_ids(self.archive.changes_since(cursor, limit=1)), [(events[3].id__id, False)])
+        cursor = cursor.advance(changes)
+        nose.tools.eq_(self.archive.changes_since(cursor), [])
+        #only the tombstone goes away
+        nose.tools.eq_(self.archive.trim_changes(cursor), 1)
+        nose.tools.eq_(self._changed_ids(self.archive.changes_since()), [(events[1].id__id, False), (events[3].id__id, False), (events[0].id__id, False)])
+
+    def test_changes_start_with_existing_events(self):
+        """Turning on the change feed should start it with every event that is already there, even if it is sealed"""
+        self.archive.close()
+        self.archive = memdam.eventstore.sqlite.Eventstore(self._temp_file)
+        events = _new_samples(10)
+        self.archive.save(events[:9])
+        self.archive.seal(SAMPLE_NAMESPACE, events[5].time__time)
+        self.archive.close()
+        self.archive = memdam.eventstore.sqlite.Eventstore(self._temp_file, **self.archive_kwargs())
+        self.archive.save(events[9:])
+        nose.tools.eq_([change.event_id for change in self.archive.changes_since()], [event.id__id for event in events])
+        self.archive.delete(events[1].id__id)
+        nose.tools.eq_(self._changed_ids(self.archive.changes_since())[-1], (events[1].id__id, True))
+
+    def test_changes_recorded_without_option(self):
+        """Saves and deletes through an Eventstore without the change feed turned on should still be in the existing feed"""
+        events = _new_samples(2)
+        self.archive.save(events[:1])
+        other = memdam.eventstore.sqlite.Eventstore(self._temp_file)
+        other.save(events[1:])
+        other.delete(events[0].id__id)
+        other.close()
+        nose.tools.eq_(self._changed_ids(self.archive.changes_since()), [(events[1].id__id, False), (events[0].id__id, True)])
+
+    def test_changes_are_hidden_in_memory(self):
+        """Change feeds (and the sqlite_sequence table behind them) should never be mistaken for namespaces"""
+        archive = memdam.eventstore.sqlite.Eventstore(":memory:", changes=True)
+        archive.save([self.simple_event])
+        nose.tools.eq_(archive._all_table_names(), [memdam.eventstore.sqlite.namespace_to_table_name(NAMESPACE)])
+        nose.tools.eq_(self._changed_ids(archive.changes_since()), [(self.simple_event.id__id, False)])
+        archive.close()
+
+class ConnectionPoolTest(unittest.TestCase):
+    """Check that connections are reused, capped and closed"""
+
+    def setUp(self):
+        self.opened = []
+        def connect(table_name, read_only):
+            conn = FakeConnection(table_name, read_only)
+            self.opened.append(conn)
+            return conn
+        self.pool = memdam.eventstore.sqlite.ConnectionPool(connect, max_connections=2)
+
+    def test_reuse(self):
+        """Borrowing the same table twice from the same thread should reuse the connection"""
+        with self.pool.connection(u"a", read_only=True) as first:
+            pass
+        with self.pool.connection(u"a", read_only=True) as second:
+            pass
+        nose.tools.eq_(first, second)
+        nose.tools.eq_(len(self.opened), 1)
+
+    def test_separate_readers_and_writers(self):
+        """Readers and writers should never share a connection"""
+        with self.pool.connection(u"a", read_only=True) as reader:
+            with self.pool.connection(u"a", read_only=False) as writer:
+                assert reader is not writer
+
+    def test_evicts_least_recently_used(self):
+        """Should close the least recently used connection when there are too many"""
+        for table_name in (u"a", u"b", u"a", u"c"):
+            with self.pool.connection(table_name):
+                pass
+        nose.tools.eq_([conn.closed for conn in self.opened], [False, True, False])
+
+    def test_close(self):
+        """Closing the pool should close every connection, even ones that were borrowed"""
+        with self.pool.connection(u"a"):
+            with self.pool.connection(u"b"):
+                self.pool.close()
+        nose.tools.eq_([conn.closed for conn in self.opened], [True, True])
+
+class FakeConnection(object):
+    """Just tracks whether it was closed"""
+    def __init__(self, table_name, read_only):
+        self.table_name = table_name
+        self.read_only = read_only
+        self.closed = False
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
 if __name__ == '__main__':
     tester = LocalFileTest()
     tester.setUp()
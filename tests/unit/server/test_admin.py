@@ -0,0 +1,33 @@
+import os
+import shutil
+import unittest
+
+import nose.tools
+
+import memdam.common.utils
+import memdam.server.admin
+import memdam.server.web.utils
+from memdam.server.web import app
+
+class AdminTest(unittest.TestCase):
+    def setUp(self):
+        self._database_folder = app.config['DATABASE_FOLDER']
+        self._temp_folder = memdam.common.utils.make_temp_path()
+        os.mkdir(self._temp_folder)
+        app.config['DATABASE_FOLDER'] = self._temp_folder
+
+    def tearDown(self):
+        memdam.server.web.utils.close_archives()
+        app.config['DATABASE_FOLDER'] = self._database_folder
+        shutil.rmtree(self._temp_folder)
+
+    def test_archives_are_reused(self):
+        """Admin commands should share one archive per folder with the server, rather than leaving new ones open"""
+        archive = memdam.server.admin.create_archive(u'someguy', u'randopass')
+        nose.tools.ok_(memdam.server.admin._get_archive(u'someguy') is archive)
+        nose.tools.ok_(memdam.server.web.utils.get_archive(u'someguy') is archive)
+        nose.tools.eq_(len(memdam.server.admin.find_range(u'someguy')), 1)
+
+    @nose.tools.raises(Exception)
+    def test_missing_archive(self):
+        memdam.server.admin.find_range(u'nobody')
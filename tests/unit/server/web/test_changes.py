@@ -0,0 +1,38 @@
+import json
+
+import nose.tools
+
+import memdam.common.event
+import memdam.common.change
+import memdam.eventstore.sqlite
+import memdam.server.web.utils
+import memdam.server.web.changes
+
+import tests.unit.server.web
+
+NAMESPACE = u"whatever"
+
+class ChangesTest(tests.unit.server.web.FlaskResourceTestCase):
+    def setUp(self):
+        tests.unit.server.web.FlaskResourceTestCase.setUp(self)
+        self.app.config['DATABASE_CHANGES'] = True
+
+    def tearDown(self):
+        self.app.config['DATABASE_CHANGES'] = False
+
+    def runTest(self):
+        """GETting the changes after a cursor returns a JSON list of the Changes since then"""
+        events = [memdam.common.event.new(NAMESPACE, x__long=long(i)) for i in range(0, 3)]
+        #after the first event
+        cursor = memdam.common.change.Cursor({memdam.eventstore.sqlite.namespace_to_table_name(NAMESPACE): 1})
+        query_string = dict(cursor=json.dumps(cursor.to_json_dict()), limit=3)
+        with self.context('/api/v1/changes', method='GET', query_string=query_string, headers=self.headers):
+            archive = memdam.server.web.utils.get_archive(self.username)
+            archive.save(events)
+            result = memdam.server.web.changes.changes()
+            # pylint: disable=E1103
+            nose.tools.eq_(result.status_code, 200)
+            changes = [memdam.common.change.Change.from_json_dict(x) for x in json.loads(result.data)]
+            #the cursor doesn't have a position for the user's authentication, so that comes first
+            nose.tools.eq_(len(changes), 3)
+            nose.tools.eq_([change.event_id for change in changes if change.namespace == NAMESPACE], [events[1].id__id, events[2].id__id])
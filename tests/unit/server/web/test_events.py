@@ -5,6 +5,8 @@ import json
 import nose.tools
 
 import memdam.common.event
+import memdam.common.client
+import memdam.common.bincodec
 import memdam.common.timeutils
 import memdam.server.web.utils
 import memdam.server.web.events
@@ -39,6 +41,37 @@ class FetchTest(tests.unit.server.web.FlaskResourceTestCase):
             assert result.status_code == 200
             assert memdam.common.event.Event.from_json_dict(json.loads(result.data)) == event
 
+class BinaryCreateTest(tests.unit.server.web.FlaskResourceTestCase):
+    def runTest(self):
+        """PUTting a binary Event succeeds"""
+        self.headers['Content-Type'] = memdam.common.client.BINARY_CONTENT_TYPE
+        data = memdam.common.bincodec.encode_event_list([event])
+        with self.context('/api/v1/events/' + event.id__id.hex, method='PUT', data=data, headers=self.headers):
+            nose.tools.eq_(memdam.server.web.events.events(event.id__id.hex), ('', 204))
+            nose.tools.eq_(memdam.server.web.utils.get_archive(self.username).get(event.id__id), event)
+
+class BinaryFetchTest(tests.unit.server.web.FlaskResourceTestCase):
+    def runTest(self):
+        """GETting an Event that accepts binary returns it as binary"""
+        self.headers['Accept'] = memdam.common.client.BINARY_CONTENT_TYPE
+        with self.context('/api/v1/events/' + event.id__id.hex, method='GET', headers=self.headers):
+            memdam.server.web.utils.get_archive(self.username).save([event])
+            result = memdam.server.web.events.events(event.id__id.hex)
+            # pylint: disable=E1103
+            nose.tools.eq_(result.mimetype, memdam.common.client.BINARY_CONTENT_TYPE)
+            nose.tools.eq_(memdam.common.bincodec.decode_event_list(result.data), [event])
+
+class SaveManyTest(tests.unit.server.web.FlaskResourceTestCase):
+    def runTest(self):
+        """POSTing binary Events saves all of them"""
+        self.headers['Content-Type'] = memdam.common.client.BINARY_CONTENT_TYPE
+        new_events = [memdam.common.event.new(u"whatever", x__long=long(i)) for i in range(0, 3)]
+        data = memdam.common.bincodec.encode_event_list(new_events)
+        with self.context('/api/v1/events', method='POST', data=data, headers=self.headers):
+            nose.tools.eq_(memdam.server.web.events.save_events(), ('', 204))
+            archive = memdam.server.web.utils.get_archive(self.username)
+            nose.tools.eq_(archive.get_many([e.id__id for e in new_events]), new_events)
+
 class NoAuthenticationTest(tests.unit.server.web.FlaskResourceTestCase):
     def runTest(self):
         """GETting an Event fails without authentication"""
@@ -0,0 +1,79 @@
+
+import json
+
+import nose.tools
+
+import memdam.common.event
+import memdam.common.query
+import memdam.common.client
+import memdam.common.bincodec
+import memdam.server.web.utils
+import memdam.server.web.queries
+
+import tests.unit.server.web
+
+NAMESPACE = u"whatever"
+event = memdam.common.event.new(NAMESPACE, cpu__number__percent=0.567)
+query = memdam.common.query.Query(filters=(memdam.common.query.QueryFilter(u'namespace__namespace', u'=', NAMESPACE),))
+query_json = json.dumps(query.to_json_dict())
+
+class QueryTest(tests.unit.server.web.FlaskResourceTestCase):
+    def runTest(self):
+        """POSTing a Query returns a JSON list of the matching Events"""
+        with self.context('/api/v1/queries', method='POST', data=query_json, headers=self.headers):
+            memdam.server.web.utils.get_archive(self.username).save([event])
+            result = memdam.server.web.queries.query_events()
+            # pylint: disable=E1103
+            nose.tools.eq_(result.status_code, 200)
+            events = [memdam.common.event.Event.from_json_dict(x) for x in json.loads(result.data)]
+            nose.tools.eq_(events, [event])
+
+class StreamingQueryTest(tests.unit.server.web.FlaskResourceTestCase):
+    def runTest(self):
+        """POSTing a Query that accepts newline-delimited JSON streams one Event per line"""
+        self.headers['Accept'] = memdam.common.client.NDJSON_CONTENT_TYPE
+        with self.context('/api/v1/queries', method='POST', data=query_json, headers=self.headers):
+            memdam.server.web.utils.get_archive(self.username).save([event])
+            result = memdam.server.web.queries.query_events()
+            # pylint: disable=E1103
+            nose.tools.eq_(result.mimetype, memdam.common.client.NDJSON_CONTENT_TYPE)
+            lines = [line for line in result.data.split('\n') if line]
+            events = [memdam.common.event.Event.from_json_dict(json.loads(line)) for line in lines]
+            nose.tools.eq_(events, [event])
+
+class BinaryQueryTest(tests.unit.server.web.FlaskResourceTestCase):
+    def runTest(self):
+        """POSTing a Query that accepts binary events streams them back as binary"""
+        self.headers['Accept'] = memdam.common.client.BINARY_CONTENT_TYPE
+        with self.context('/api/v1/queries', method='POST', data=query_json, headers=self.headers):
+            memdam.server.web.utils.get_archive(self.username).save([event])
+            result = memdam.server.web.queries.query_events()
+            # pylint: disable=E1103
+            nose.tools.eq_(result.mimetype, memdam.common.client.BINARY_CONTENT_TYPE)
+            nose.tools.eq_(memdam.common.bincodec.decode_event_list(result.data), [event])
+
+class SearchTest(tests.unit.server.web.FlaskResourceTestCase):
+    def runTest(self):
+        """POSTing a Query with a match filter returns a JSON list of SearchResults"""
+        text_event = memdam.common.event.new(NAMESPACE, body__text=u"the quick brown fox")
+        search_query = memdam.common.query.Query(filters=(memdam.common.query.QueryFilter(u'body__text', u'match', u'fox'),))
+        with self.context('/api/v1/queries/search', method='POST', data=json.dumps(search_query.to_json_dict()), headers=self.headers):
+            memdam.server.web.utils.get_archive(self.username).save([event, text_event])
+            result = memdam.server.web.queries.search_events()
+            # pylint: disable=E1103
+            nose.tools.eq_(result.status_code, 200)
+            results = [memdam.common.query.SearchResult.from_json_dict(x) for x in json.loads(result.data)]
+            nose.tools.eq_([x.event for x in results], [text_event])
+            nose.tools.eq_(results[0].snippets, {u'body__text': u"the quick brown <b>fox</b>"})
+
+class AggregateTest(tests.unit.server.web.FlaskResourceTestCase):
+    def runTest(self):
+        """POSTing an AggregateQuery returns a JSON list of AggregateRows"""
+        aggregate_query = memdam.common.query.AggregateQuery(filters=query.filters, aggregates=[(u'count', None), (u'min', u'time__time')])
+        with self.context('/api/v1/queries/aggregate', method='POST', data=json.dumps(aggregate_query.to_json_dict()), headers=self.headers):
+            memdam.server.web.utils.get_archive(self.username).save([event])
+            result = memdam.server.web.queries.aggregate_events()
+            # pylint: disable=E1103
+            nose.tools.eq_(result.status_code, 200)
+            rows = [memdam.common.query.AggregateRow.from_json_dict(x, aggregate_query) for x in json.loads(result.data)]
+            nose.tools.eq_(rows, [memdam.common.query.AggregateRow(None, None, [1, event.time__time])])
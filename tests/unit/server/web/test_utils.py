@@ -0,0 +1,35 @@
+import os
+import shutil
+import unittest
+
+import nose.tools
+
+import memdam.common.utils
+import memdam.server.web.utils
+from memdam.server.web import app
+
+class GetArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self._config = dict((key, app.config[key]) for key in ('DATABASE_FOLDER', 'DATABASE_ROLLUPS', 'DATABASE_INDICES'))
+        self._temp_folder = memdam.common.utils.make_temp_path()
+        os.mkdir(self._temp_folder)
+        app.config['DATABASE_FOLDER'] = self._temp_folder
+
+    def tearDown(self):
+        memdam.server.web.utils.close_archives()
+        app.config.update(self._config)
+        shutil.rmtree(self._temp_folder)
+
+    def test_archives_are_cached(self):
+        archive = memdam.server.web.utils.get_archive(u'someguy')
+        nose.tools.ok_(memdam.server.web.utils.get_archive(u'someguy') is archive)
+        nose.tools.ok_(memdam.server.web.utils.get_archive(u'otherguy') is not archive)
+
+    def test_changed_options_give_new_archive(self):
+        """Changing the archive options in the config should not keep returning an archive without them"""
+        archive = memdam.server.web.utils.get_archive(u'someguy')
+        app.config['DATABASE_ROLLUPS'] = True
+        rollup_archive = memdam.server.web.utils.get_archive(u'someguy')
+        nose.tools.ok_(rollup_archive is not archive)
+        app.config['DATABASE_INDICES'] = {u'*': [[u'cpu__number', u'time__time']]}
+        nose.tools.ok_(memdam.server.web.utils.get_archive(u'someguy') is not rollup_archive)